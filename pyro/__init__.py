@@ -3,6 +3,7 @@ from __future__ import absolute_import, division, print_function
 import copy
 import logging
 import numbers
+import os
 import warnings
 from collections import OrderedDict
 from contextlib import contextmanager
@@ -17,7 +18,9 @@ from pyro.distributions.distribution import Distribution
 from pyro.params import _MODULE_NAMESPACE_DIVIDER, _PYRO_PARAM_STORE, param_with_module_name
 from pyro.poutine import _PYRO_STACK, condition, do  # noqa: F401
 from pyro.poutine.indep_poutine import _DIM_ALLOCATOR
-from pyro.util import am_i_wrapped, apply_stack, deep_getattr, ones, set_rng_seed, zeros  # noqa: F401
+from pyro.poutine.poutine import Message
+from pyro.util import (_SUBSAMPLE_EPOCHS, am_i_wrapped, apply_stack, deep_getattr, ones, set_rng_seed,  # noqa: F401
+                       zeros)
 
 __version__ = '0.1.2'
 
@@ -35,7 +38,9 @@ def get_param_store():
 def clear_param_store():
     """
     Clears the ParamStore. This is especially useful if you're working in a REPL.
+    This also restarts the epochs of subsampling iaranges and iranges.
     """
+    _SUBSAMPLE_EPOCHS.clear()
     return _PYRO_PARAM_STORE.clear()
 
 
@@ -67,28 +72,14 @@ def sample(name, fn, *args, **kwargs):
     # if stack not empty, apply everything in the stack?
     else:
         # initialize data structure to pass up/down the stack
-        msg = {
-            "type": "sample",
-            "name": name,
-            "fn": fn,
-            "is_observed": False,
-            "args": args,
-            "kwargs": kwargs,
-            "value": None,
-            "infer": infer,
-            "scale": 1.0,
-            "cond_indep_stack": (),
-            "done": False,
-            "stop": False,
-            "continuation": None
-        }
+        msg = Message(type="sample", name=name, fn=fn, args=args, kwargs=kwargs, infer=infer)
         # handle observation
         if obs is not None:
-            msg["value"] = obs
-            msg["is_observed"] = True
+            msg.value = obs
+            msg.is_observed = True
         # apply the stack and return its return value
         apply_stack(msg)
-        return msg["value"]
+        return msg.value
 
 
 def observe(name, fn, obs, *args, **kwargs):
@@ -104,6 +95,43 @@ def observe(name, fn, obs, *args, **kwargs):
     return sample(name, fn, *args, **kwargs)
 
 
+class _SubsampleEpochs(object):
+    """
+    Walks shuffled permutations of a range of indices in minibatches, so that
+    each epoch is a pass over the range without replacement.
+
+    Internal use only. This should only be used by `_Subsample`.
+    """
+
+    def __init__(self, size):
+        """
+        :param int size: the size of the range to subsample from
+        """
+        self.size = size
+        self.epoch = 0
+        self.pid = os.getpid()  # the process whose rng drew the permutation
+        self._perm = None
+        self._position = 0
+
+    def next_batch(self, batch_size):
+        """
+        :param int batch_size: the size of the minibatch
+        :returns: the next minibatch of the current epoch
+        :rtype: torch.LongTensor
+        """
+        if self._perm is None:
+            self._perm = torch.randperm(self.size)
+            self._position = 0
+        result = self._perm[self._position:self._position + batch_size]
+        self._position += batch_size
+        if self._position + batch_size > self.size:
+            # the epoch is complete; the leftover indices are skipped, which is
+            # unbiased since they are a uniformly random subset of the range
+            self.epoch += 1
+            self._perm = None
+        return result
+
+
 class _Subsample(Distribution):
     """
     Randomly select a subsample of a range of indices.
@@ -111,15 +139,17 @@ class _Subsample(Distribution):
     Internal use only. This should only be used by `iarange`.
     """
 
-    def __init__(self, size, subsample_size, use_cuda=None):
+    def __init__(self, size, subsample_size, use_cuda=None, epochs=None):
         """
         :param int size: the size of the range to subsample from
         :param int subsample_size: the size of the returned subsample
         :param bool use_cuda: whether to use cuda tensors
+        :param _SubsampleEpochs epochs: the state of epoch-based subsampling of the range
         """
         self.size = size
         self.subsample_size = subsample_size
         self.use_cuda = torch.Tensor.is_cuda if use_cuda is None else use_cuda
+        self.epochs = _SubsampleEpochs(size) if epochs is None else epochs
 
     def sample(self, sample_shape=torch.Size()):
         """
@@ -132,9 +162,9 @@ class _Subsample(Distribution):
         if subsample_size is None or subsample_size > self.size:
             subsample_size = self.size
         if subsample_size == self.size:
-            result = torch.LongTensor(list(range(self.size)))
+            result = torch.arange(self.size, dtype=torch.long)
         else:
-            result = torch.randperm(self.size)[:self.subsample_size]
+            result = self.epochs.next_batch(subsample_size)
         return result.cuda() if self.use_cuda else result
 
     def log_prob(self, x):
@@ -144,6 +174,30 @@ class _Subsample(Distribution):
         return result.cuda() if self.use_cuda else result
 
 
+def subsample_epoch(name, size=None, subsample_size=None):
+    """
+    Returns the number of complete epochs, i.e. passes over the whole range
+    without replacement, made by the minibatches of the subsampling
+    :class:`iarange` or :class:`irange` of the given name. This can be used
+    to detect epoch boundaries in a training loop. Epochs are restarted by
+    :func:`~pyro.util.set_rng_seed` and :func:`clear_param_store`.
+
+    :param str name: the name of the iarange or irange
+    :param int size: its size, needed if several subsampling ranges share the name
+    :param int subsample_size: its subsample size, needed if several subsampling
+        ranges share the name and size
+    :rtype: int
+    """
+    pid = os.getpid()
+    matches = [epochs for (other_name, other_size, other_subsample_size), epochs in _SUBSAMPLE_EPOCHS.items()
+               if other_name == name and epochs.pid == pid and
+               size in (None, other_size) and subsample_size in (None, other_subsample_size)]
+    if len(matches) > 1:
+        raise ValueError("there are several subsampling ranges named '{}', "
+                         "specify their size and subsample_size".format(name))
+    return matches[0].epoch if matches else 0
+
+
 def _subsample(name, size=None, subsample_size=None, subsample=None, use_cuda=None):
     """
     Helper function for iarange and irange. See their docstrings for details.
@@ -154,7 +208,14 @@ def _subsample(name, size=None, subsample_size=None, subsample=None, use_cuda=No
         size = -1  # This is PyTorch convention for "arbitrary size"
         subsample_size = -1
     elif subsample is None:
-        subsample = sample(name, _Subsample(size, subsample_size, use_cuda))
+        epochs = None
+        if subsample_size is not None and subsample_size < size:
+            key = name, size, subsample_size
+            epochs = _SUBSAMPLE_EPOCHS.get(key)
+            if epochs is None or epochs.pid != os.getpid():
+                # forked processes, e.g. Hogwild workers, walk permutations of their own
+                epochs = _SUBSAMPLE_EPOCHS[key] = _SubsampleEpochs(size)
+        subsample = sample(name, _Subsample(size, subsample_size, use_cuda, epochs))
 
     if subsample_size is None:
         subsample_size = len(subsample)
@@ -325,22 +386,10 @@ def param(name, *args, **kwargs):
     if not am_i_wrapped():
         return _PYRO_PARAM_STORE.get_param(name, *args, **kwargs)
     else:
-        msg = {
-            "type": "param",
-            "name": name,
-            "args": args,
-            "kwargs": kwargs,
-            "infer": {},
-            "scale": 1.0,
-            "cond_indep_stack": (),
-            "value": None,
-            "done": False,
-            "stop": False,
-            "continuation": None
-        }
+        msg = Message(type="param", name=name, args=args, kwargs=kwargs)
         # apply the stack and return its return value
         apply_stack(msg)
-        return msg["value"]
+        return msg.value
 
 
 def module(name, nn_module, update_module_params=False):
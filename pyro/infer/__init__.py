@@ -6,6 +6,7 @@ from pyro.infer.enum import config_enumerate
 from pyro.infer.importance import Importance
 from pyro.infer.search import Search
 from pyro.infer.svi import SVI
+from pyro.infer.distributed_svi import DistributedSVI
 from pyro.infer.advi import ADVI, ADVIMultivariateNormal, ADVIDiagonalNormal
 
 # flake8: noqa
@@ -0,0 +1,229 @@
+from __future__ import absolute_import, division, print_function
+
+import multiprocessing
+import socket
+import traceback
+
+import torch
+import torch.distributed as dist
+from six.moves.queue import Empty
+
+import pyro
+from pyro.infer.svi import SVI
+
+# seconds to wait for a result from the workers before checking that they are still alive
+_WORKER_POLL_TIMEOUT = 1.0
+
+
+class DistributedSVI(SVI):
+    """
+    Data-parallel :class:`~pyro.infer.svi.SVI` across the processes of a
+    ``torch.distributed`` process group, e.g. CPU worker processes using the
+    ``gloo`` backend.
+
+    Each worker computes the loss and gradients on its own shard of the
+    minibatch. The gradients of the active params (and the loss) are then
+    averaged across workers with a single all-reduce, and each worker takes the
+    same optimizer step, so that the param stores of all workers stay
+    identical. Params that are lazily created during a step are broadcast from
+    worker 0, and the loss and gradients of that step are recomputed, so they
+    need not be initialized identically by each worker.
+
+    Since gradients are averaged, each worker's loss should be an unbiased
+    estimate of the loss on the whole minibatch, e.g. by scaling its shard with
+    ``iarange``::
+
+        def model(data, ind):
+            with pyro.iarange("data", len(data), subsample=ind):
+                ...
+
+        svi = DistributedSVI(model, guide, optim, loss="ELBO")
+        shard = torch.arange(svi.rank, len(data), svi.world_size).long()
+        svi.step(data[shard], shard)
+
+    All workers must create and update the same set of params at each step.
+    See :func:`spawn` to run worker processes on a single machine, and
+    :func:`hogwild` for asynchronous training without all-reduce.
+
+    :param model: the model (callable containing Pyro primitives)
+    :param guide: the guide (callable containing Pyro primitives)
+    :param optim: a wrapper a for a PyTorch optimizer
+    :type optim: pyro.optim.PyroOptim
+    :param loss: the loss, as for :class:`~pyro.infer.svi.SVI`
+    :param loss_and_grads: the loss and gradients, as for :class:`~pyro.infer.svi.SVI`
+    :param kwargs: keyword arguments, as for :class:`~pyro.infer.svi.SVI`
+    """
+    def __init__(self,
+                 model,
+                 guide,
+                 optim,
+                 loss,
+                 loss_and_grads=None,
+                 **kwargs):
+        if not dist.is_initialized():
+            raise RuntimeError("DistributedSVI requires torch.distributed.init_process_group() to be called first")
+        super(DistributedSVI, self).__init__(model, guide, optim, loss, loss_and_grads, **kwargs)
+        self.rank = dist.get_rank()
+        self.world_size = dist.get_world_size()
+        self._synced_param_names = set()
+
+    def step(self, *args, **kwargs):
+        """
+        :returns: estimate of the loss, averaged across workers
+        :rtype: float
+
+        Take a gradient step on the loss function, with gradients averaged
+        across workers. Any args or kwargs are passed to the model and guide.
+        """
+        # get loss and compute gradients
+        loss = self.loss_and_grads(self.model, self.guide, *args, **kwargs)
+
+        # get active params, in the same order in all workers
+        param_store = pyro.get_param_store()
+        params = param_store.get_active_params()
+        named_params = sorted((param_store.param_name(p), p) for p in params)
+
+        new_params = [p for name, p in named_params if name not in self._synced_param_names]
+        if new_params:
+            # broadcast the values of lazily created params from worker 0,
+            # then recompute the loss and gradients at those values
+            buffer = _flatten([p.detach() for p in new_params])
+            dist.broadcast(buffer, 0)
+            with torch.no_grad():
+                _unflatten(buffer, new_params)
+            self._synced_param_names.update(name for name, p in named_params)
+            pyro.util.zero_grads(params)
+            loss = self.loss_and_grads(self.model, self.guide, *args, **kwargs)
+
+        # average gradients and loss across workers with a single all-reduce
+        for name, p in named_params:
+            if p.grad is None:
+                p.grad = torch.zeros_like(p)
+        grads = [p.grad.data for name, p in named_params]
+        buffer = _flatten(grads + [torch.tensor([float(loss)])])
+        dist.all_reduce(buffer)
+        buffer /= self.world_size
+        _unflatten(buffer, grads)
+        loss = buffer[-1].item()
+
+        # actually perform gradient steps
+        # torch.optim objects gets instantiated for any params that haven't been seen yet
+        self.optim(params)
+
+        # zero gradients
+        pyro.util.zero_grads(params)
+
+        # mark parameters in the param store as inactive
+        param_store.mark_params_inactive(params)
+
+        return loss
+
+
+def _flatten(tensors):
+    return torch.cat([t.contiguous().view(-1) for t in tensors])
+
+
+def _unflatten(buffer, tensors):
+    offset = 0
+    for t in tensors:
+        t.copy_(buffer[offset:offset + t.numel()].view_as(t))
+        offset += t.numel()
+
+
+def spawn(fn, num_workers, args=(), backend="gloo"):
+    """
+    Run ``fn(rank, *args)`` in each of ``num_workers`` new processes, which form
+    a process group on the local machine, e.g. to train with
+    :class:`DistributedSVI` on a single machine.
+
+    :param callable fn: the function to run in each worker
+    :param int num_workers: the number of worker processes
+    :param tuple args: the arguments to ``fn`` after the worker rank
+    :param str backend: the ``torch.distributed`` backend of the process group,
+        or None to not create a process group
+    :returns: the return values of ``fn``, ordered by worker rank
+    :rtype: list
+    """
+    init_method = None
+    if backend is not None:
+        # find a free port for the process group to rendezvous on
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.bind(("127.0.0.1", 0))
+        init_method = "tcp://127.0.0.1:{}".format(sock.getsockname()[1])
+        sock.close()
+
+    results = multiprocessing.Queue()
+    # workers stay alive until their results are received, since tensors may be sent via shared memory
+    done = multiprocessing.Event()
+    workers = [multiprocessing.Process(target=_run_worker,
+                                       args=(fn, args, rank, num_workers, backend, init_method, results, done))
+               for rank in range(num_workers)]
+    for worker in workers:
+        worker.start()
+    outputs = {}
+    exited = set()
+    try:
+        while len(outputs) < num_workers:
+            try:
+                rank, ok, output = results.get(timeout=_WORKER_POLL_TIMEOUT)
+            except Empty:
+                # a worker that exited without reporting has died, e.g. it was killed by the OS. Its
+                # result may still be in flight, so it is only reported at the next timeout.
+                for rank, worker in enumerate(workers):
+                    if rank not in outputs and not worker.is_alive():
+                        if rank in exited:
+                            raise RuntimeError("worker {} exited unexpectedly with exit code {}"
+                                               .format(rank, worker.exitcode))
+                        exited.add(rank)
+                continue
+            if not ok:
+                raise RuntimeError("worker {} failed:\n{}".format(rank, output))
+            outputs[rank] = output
+    finally:
+        done.set()
+        for worker in workers:
+            if len(outputs) < num_workers:
+                # the other workers may be blocked waiting for the failed one, e.g. in an all-reduce
+                worker.terminate()
+            worker.join()
+    return [outputs[rank] for rank in range(num_workers)]
+
+
+def _run_worker(fn, args, rank, world_size, backend, init_method, results, done):
+    try:
+        if backend is not None:
+            dist.init_process_group(backend, init_method=init_method, world_size=world_size, rank=rank)
+        results.put((rank, True, fn(rank, *args)))
+    except Exception:
+        results.put((rank, False, traceback.format_exc()))
+    done.wait()
+
+
+def hogwild(fn, num_workers, args=()):
+    """
+    Run ``fn(rank, *args)`` in each of ``num_workers`` new processes that share
+    the params of the ParamStore, for Hogwild-style asynchronous training.
+
+    The params are moved to shared memory, and each worker typically runs
+    :meth:`SVI.step <pyro.infer.svi.SVI.step>` on its own data shard with its
+    own optimizer, updating the shared params in place without locking. This
+    suits models whose steps update sparse, mostly disjoint parts of the params.
+    All params must be created before calling this, e.g. by running the guide
+    and model once, since params created by a worker are not shared. Each worker
+    is seeded from the current rng state, so that the workers draw different
+    samples and minibatches.
+
+    :param callable fn: the function to run in each worker
+    :param int num_workers: the number of worker processes
+    :param tuple args: the arguments to ``fn`` after the worker rank
+    :returns: the return values of ``fn``, ordered by worker rank
+    :rtype: list
+    """
+    pyro.get_param_store().share_memory()
+    seeds = torch.randint(0, 2 ** 31, (num_workers,)).long().tolist()
+    return spawn(_run_seeded, num_workers, (fn, seeds) + tuple(args), backend=None)
+
+
+def _run_seeded(rank, fn, seeds, *args):
+    pyro.set_rng_seed(seeds[rank])
+    return fn(rank, *args)
@@ -1,5 +1,7 @@
 from __future__ import absolute_import, division, print_function
 
+from pyro.infer.util import TraceStructure, get_iarange_stacks
+
 
 class ELBO(object):
     """
@@ -15,6 +17,12 @@ class ELBO(object):
         :func:`pyro.iarange` contexts. This is only required to enumerate over
         sample sites in parallel, e.g. if a site sets
         ``infer={"enumerate": "parallel"}``.
+    :param bool freeze_structure: Whether to assume that the sample sites of
+        the model and guide, their shapes and their :func:`pyro.iarange`
+        contexts are the same at every step. The structure of the traces is
+        captured on the first step; on later steps, validation checks and
+        subsample pruning plans are reused as long as the site names and
+        shapes still match. Defaults to False.
 
     References
 
@@ -27,9 +35,35 @@ class ELBO(object):
 
     def __init__(self,
                  num_particles=1,
-                 max_iarange_nesting=float('inf')):
+                 max_iarange_nesting=float('inf'),
+                 freeze_structure=False):
         self.num_particles = num_particles
         self.max_iarange_nesting = max_iarange_nesting
+        self.freeze_structure = freeze_structure
+        self._structure = None
+
+    def _get_structure(self, model_trace, guide_trace):
+        """
+        :returns: None unless ``freeze_structure`` is set. Otherwise, the
+            :class:`~pyro.infer.util.TraceStructure` captured on an earlier
+            step if it matches the given unpruned traces, else a newly
+            captured one that has not been validated yet.
+        """
+        if not self.freeze_structure:
+            return None
+        if self._structure is None or not self._structure.matches(model_trace, guide_trace):
+            self._structure = TraceStructure(model_trace, guide_trace)
+        return self._structure
+
+    def _get_iarange_stacks(self, model_trace):
+        """
+        Like :func:`~pyro.infer.util.get_iarange_stacks`, but reuses the stacks
+        of the frozen structure, which always matches the traces most recently
+        produced by ``_get_traces``.
+        """
+        if self._structure is not None:
+            return self._structure.iarange_stacks
+        return get_iarange_stacks(model_trace)
 
     @staticmethod
     def make(trace_graph=False, enum_discrete=False, **kwargs):
@@ -1,28 +1,60 @@
 from __future__ import absolute_import, division, print_function
 
-from six.moves.queue import LifoQueue
-
 from pyro import poutine
-from pyro.poutine.trace import Trace
-
-
-def _iter_discrete_escape(trace, msg):
-    return ((msg["type"] == "sample") and
-            (not msg["is_observed"]) and
-            (msg["infer"].get("enumerate") == "sequential") and  # only sequential
-            (msg["name"] not in trace))
+from pyro.poutine.poutine import Messenger, Poutine
 
 
-def _iter_discrete_extend(trace, site, **ignored):
-    values = site["fn"].enumerate_support()
-    for i, value in enumerate(values):
-        extended_site = site.copy()
-        extended_site["infer"] = site["infer"].copy()
-        extended_site["infer"]["_enum_total"] = len(values)
-        extended_site["value"] = value
-        extended_trace = trace.copy()
-        extended_trace.add_node(site["name"], **extended_site)
-        yield extended_trace
+class _SequentialEnumMessenger(Messenger):
+    """
+    Enumerates depth-first over sample sites marked
+    ``infer={"enumerate": "sequential"}``, one complete execution per branch.
+
+    Pending branches are kept on a LIFO stack. Each branch is a persistent
+    linked list ``((name, value, infer), parent)`` of the sample sites that
+    precede it, so that sibling branches share their common prefix rather
+    than copying it. An execution replays the values of the branch it was
+    started from. At each new sequential site it takes the last value in the
+    support and pushes the others as new branches, so that the remaining
+    values are enumerated by later executions.
+
+    :param list stack: the stack of pending branches, initially ``[None]``
+    """
+    def __init__(self, stack):
+        super(_SequentialEnumMessenger, self).__init__()
+        self.stack = stack
+        self.chain = None
+        self.prefix = None
+
+    def __enter__(self):
+        self.chain = self.stack.pop()
+        self.prefix = {}
+        node = self.chain
+        while node is not None:
+            (name, value, infer), node = node
+            self.prefix[name] = value, infer
+        return super(_SequentialEnumMessenger, self).__enter__()
+
+    def _pyro_sample(self, msg):
+        if msg["is_observed"]:
+            return None
+        name = msg["name"]
+        if name in self.prefix:
+            msg["value"], msg["infer"] = self.prefix[name]
+            msg["done"] = True
+        elif msg["infer"].get("enumerate") == "sequential":
+            values = msg["fn"].enumerate_support()
+            infer = msg["infer"].copy()
+            infer["_enum_total"] = len(values)
+            for value in values[:-1]:
+                self.stack.append(((name, value, infer), self.chain))
+            msg["value"] = values[-1]
+            msg["infer"] = infer
+            msg["done"] = True
+        return None
+
+    def _postprocess_message(self, msg):
+        if msg["type"] == "sample" and not msg["is_observed"] and msg["name"] not in self.prefix:
+            self.chain = (msg["name"], msg["value"], msg["infer"]), self.chain
 
 
 def iter_discrete_traces(graph_type, fn, *args, **kwargs):
@@ -35,16 +67,16 @@ def iter_discrete_traces(graph_type, fn, *args, **kwargs):
     This yields traces scaled by the probability of the discrete choices made
     in the `trace`.
 
+    The function is executed once per yielded trace. Values sampled before an
+    enumerated site are shared by all traces that branch at that site.
+
     :param str graph_type: The type of the graph, e.g. "flat" or "dense".
     :param callable fn: A stochastic function.
     :returns: An iterator over traces pairs.
     """
-    queue = LifoQueue()
-    queue.put(Trace())
-    traced_fn = poutine.trace(
-        poutine.queue(fn, queue, escape_fn=_iter_discrete_escape, extend_fn=_iter_discrete_extend),
-        graph_type=graph_type)
-    while not queue.empty():
+    stack = [None]
+    traced_fn = poutine.trace(Poutine(_SequentialEnumMessenger(stack), fn), graph_type=graph_type)
+    while stack:
         yield traced_fn.get_trace(*args, **kwargs)
 
 
@@ -6,15 +6,90 @@ import math
 import torch
 from torch.distributions import biject_to, constraints
 
-import pyro
-import pyro.distributions as dist
 import pyro.poutine as poutine
+from pyro.distributions.util import scale_tensor
 from pyro.infer.mcmc.trace_kernel import TraceKernel
 from pyro.ops.dual_averaging import DualAveraging
-from pyro.ops.integrator import velocity_verlet, single_step_velocity_verlet
+from pyro.ops.integrator import potential_grad, velocity_verlet, single_step_velocity_verlet
+from pyro.ops.welford import WelfordCovariance
+from pyro.poutine.indep_poutine import ParticleMessenger
+from pyro.poutine.poutine import Messenger
+from pyro.poutine.trace import Trace
+from pyro.poutine.util import site_is_subsample
 from pyro.util import is_nan, is_inf
 
 
+class _StructureChanged(Exception):
+    """
+    Raised when a model runs a latent sample site that is not in the layout of
+    the integrator state.
+    """
+    pass
+
+
+class _LazyTrace(Trace):
+    """
+    Sample trace that is only recorded, by calling ``record()``, when it is
+    first read. This avoids running the model for samples that are never read,
+    e.g. those drawn during warmup.
+
+    :param callable record: returns the recorded :class:`~pyro.poutine.trace.Trace`
+    """
+    __slots__ = ("_record",)
+
+    def __init__(self, record):
+        self._record = record
+
+    def __getattr__(self, name):
+        # only called for unset slots, i.e. before the trace has been recorded
+        record = self._record
+        if record is None:
+            raise AttributeError(name)
+        trace = record()
+        self._record = None
+        self.graph_type = trace.graph_type
+        self.nodes = trace.nodes
+        self._succ = trace._succ
+        self._pred = trace._pred
+        return getattr(self, name)
+
+
+class _LogJointMessenger(Messenger):
+    """
+    Single-purpose handler that runs a model at given values of its latent
+    sites and accumulates the log joint probability, without recording a trace.
+
+    :param dict values: the values of all latent sites, including subsample sites
+    :param callable sum_chains: reduces the log probability of a site to that of
+        each chain
+    """
+    def __init__(self, values, sum_chains):
+        super(_LogJointMessenger, self).__init__()
+        self.values = values
+        self.sum_chains = sum_chains
+        self.log_joint = 0.
+        self.num_latent_sites = 0
+
+    def _pyro_sample(self, msg):
+        if msg["is_observed"]:
+            return None
+        try:
+            msg["value"] = self.values[msg["name"]]
+        except KeyError:
+            raise _StructureChanged(msg["name"])
+        msg["done"] = True
+        return None
+
+    def _postprocess_message(self, msg):
+        if msg["type"] != "sample" or site_is_subsample(msg):
+            return None
+        if not msg["is_observed"]:
+            self.num_latent_sites += 1
+        log_prob = msg["fn"].log_prob(msg["value"], *msg["args"], **msg["kwargs"])
+        self.log_joint = self.log_joint + self.sum_chains(scale_tensor(log_prob, msg["scale"]))
+        return None
+
+
 class HMC(TraceKernel):
     """
     Simple Hamiltonian Monte Carlo kernel, where ``step_size`` and ``num_steps``
@@ -44,11 +119,46 @@ class HMC(TraceKernel):
         If not specified and the model has sites with constrained support,
         automatic transformations will be applied, as specified in
         :mod:`torch.distributions.constraint_registry`.
+    :param int num_chains: The number of chains to run in lockstep, vectorized
+        under an extra batch dimension to the left of all :func:`pyro.iarange`
+        dims, so that a single run of the model computes the potential energy of
+        all chains. Each chain has its own Metropolis correction, while the step
+        size (and its adaptation) is shared. The values in the sampled traces
+        then have a leftmost dimension of size ``num_chains``.
+    :param int max_iarange_nesting: Optional bound on max number of nested
+        :func:`pyro.iarange` contexts in the model. This is required if
+        ``num_chains > 1``.
+    :param bool compile_potential: Whether to compute the potential energy by
+        running the model under a single lightweight handler that substitutes
+        the values of latent sites and sums their log probabilities, rather than
+        recording and replaying a full trace at each step. If the model runs a
+        latent site that was not in its initial trace, the kernel falls back to
+        the trace-based computation for the rest of the run.
+    :param bool adapt_mass_matrix: A flag to decide if we want to adapt the
+        mass matrix during warm-up phase, from the (co)variance of the samples
+        in a sequence of doubling windows as in Stan. The step size adaptation
+        restarts at the end of each window. This requires the kernel to be run
+        by :class:`~pyro.infer.mcmc.MCMC`, which sets the schedule.
+    :param bool full_mass: A flag to decide if the mass matrix is dense rather
+        than diagonal.
+    :param int rng_seed: Optional seed of the random number generator of the
+        kernel, from which the momenta and the Metropolis correction are drawn
+        without going through the Pyro stack. If not specified, it is seeded
+        from the global torch random number generator at :meth:`setup`, so
+        :func:`pyro.set_rng_seed` still makes runs reproducible.
     """
 
     def __init__(self, model, step_size=None, trajectory_length=None,
-                 num_steps=None, adapt_step_size=False, transforms=None):
+                 num_steps=None, adapt_step_size=False, transforms=None,
+                 num_chains=1, max_iarange_nesting=float('inf'), compile_potential=True,
+                 adapt_mass_matrix=False, full_mass=False, rng_seed=None):
+        if num_chains > 1 and max_iarange_nesting == float('inf'):
+            raise ValueError("num_chains > 1 requires a finite value for max_iarange_nesting")
         self.model = model
+        self.num_chains = num_chains
+        self.max_iarange_nesting = max_iarange_nesting
+        self._model = model if num_chains == 1 else self._vectorize_chains(model)
+        self._batch_shape = torch.Size() if num_chains == 1 else torch.Size((num_chains,))
 
         self.step_size = step_size if step_size is not None else 1  # from Stan
         if trajectory_length is not None:
@@ -60,34 +170,123 @@ class HMC(TraceKernel):
         self.num_steps = max(1, int(self.trajectory_length / self.step_size))
         self.adapt_step_size = adapt_step_size
         self._target_accept_prob = 0.8  # from Stan
+        self.compile_potential = compile_potential
+        self.adapt_mass_matrix = adapt_mass_matrix
+        self.full_mass = full_mass
+        self.rng_seed = rng_seed
 
         self.transforms = {} if transforms is None else transforms
         self._automatic_transform_enabled = True if transforms is None else False
         self._reset()
         super(HMC, self).__init__()
 
+    def _vectorize_chains(self, fn):
+        """
+        Wraps the model so that it runs all ``num_chains`` chains at once.
+        """
+        def vectorized_fn(*args, **kwargs):
+            with ParticleMessenger("num_chains_vectorized", self.num_chains,
+                                   dim=-1 - self.max_iarange_nesting):
+                return fn(*args, **kwargs)
+        return vectorized_fn
+
+    def _sum_chains(self, value):
+        """
+        Sums ``value`` over all but its leftmost (chain) dim if chains are vectorized.
+        """
+        if self.num_chains == 1:
+            return value.sum()
+        return value.reshape(self.num_chains, -1).sum(-1)
+
     def _get_trace(self, z):
         z_trace = self._prototype_trace
         for name, value in z.items():
             z_trace.nodes[name]["value"] = value
-        trace_poutine = poutine.trace(poutine.replay(self.model, trace=z_trace))
+        trace_poutine = poutine.trace(poutine.replay(self._model, trace=z_trace))
         trace_poutine(*self._args, **self._kwargs)
+        self._num_model_evals += 1
         return trace_poutine.trace
 
+    def _pack(self, z):
+        """
+        Concatenates the values of all sites in ``z`` into a single flat tensor,
+        with one row per chain if chains are vectorized.
+        """
+        return torch.cat([z[name].reshape(self._batch_shape + (-1,)) for name in self._layout], -1)
+
+    def _unpack(self, z):
+        """
+        Splits a flat tensor back into a dictionary of views of each site's value.
+        """
+        return {name: z[..., site_slice].reshape(shape) for name, (site_slice, shape) in self._layout.items()}
+
+    def _velocity(self, r):
+        if self.full_mass:
+            return r.matmul(self._inverse_mass_matrix)
+        return self._inverse_mass_matrix * r
+
     def _kinetic_energy(self, r):
-        return 0.5 * torch.sum(torch.stack([r[name]**2 for name in r]))
+        return 0.5 * (r * self._velocity(r)).sum(-1)
+
+    def _set_inverse_mass_matrix(self, inverse_mass_matrix):
+        self._inverse_mass_matrix = inverse_mass_matrix
+        # momenta are drawn from N(0, M) by scaling standard normal noise by a square root of M
+        if self.full_mass:
+            self._mass_matrix_sqrt = inverse_mass_matrix.inverse().potrf(upper=False).t()
+        else:
+            self._mass_matrix_sqrt = inverse_mass_matrix.rsqrt()
+
+    def _sample_momentum(self):
+        r = torch.randn(self._r_shape, generator=self._rng)
+        if self.full_mass:
+            return r.matmul(self._mass_matrix_sqrt)
+        return self._mass_matrix_sqrt * r
+
+    def _log_joint(self, z):
+        """
+        Runs the model at the constrained values ``z`` of its latent sites under
+        a :class:`_LogJointMessenger`, and returns the log joint probability.
+        """
+        values = self._subsample_values.copy()
+        values.update(z)
+        log_joint_messenger = _LogJointMessenger(values, self._sum_chains)
+        with log_joint_messenger:
+            self._model(*self._args, **self._kwargs)
+        self._num_model_evals += 1
+        if log_joint_messenger.num_latent_sites != len(self._layout):
+            raise _StructureChanged()
+        return log_joint_messenger.log_joint
 
     def _potential_energy(self, z):
         # Since the model is specified in the constrained space, transform the
         # unconstrained R.V.s `z` to the constrained space.
+        z = self._unpack(z)
         z_constrained = z.copy()
         for name, transform in self.transforms.items():
             z_constrained[name] = transform.inv(z_constrained[name])
-        trace = self._get_trace(z_constrained)
-        potential_energy = -trace.log_pdf()
+        potential_energy = None
+        if self._compiled:
+            try:
+                potential_energy = -self._log_joint(z_constrained)
+                self._potential_trace = None
+            except _StructureChanged:
+                # the structure of the model is not static, so use its trace from now on
+                self._compiled = False
+        if potential_energy is None:
+            trace = self._get_trace(z_constrained)
+            # keep the trace, so that it can be returned as a sample if `z` is accepted
+            self._potential_trace = trace
+            if self.num_chains == 1:
+                potential_energy = -trace.log_pdf()
+            else:
+                # the potential energy of each chain
+                trace.compute_batch_log_pdf(lambda name, site: not site_is_subsample(site))
+                potential_energy = -sum(self._sum_chains(site["batch_log_pdf"])
+                                        for name, site in trace.nodes.items()
+                                        if site["type"] == "sample" and not site_is_subsample(site))
         # adjust by the jacobian for this transformation.
         for name, transform in self.transforms.items():
-            potential_energy += transform.log_abs_det_jacobian(z_constrained[name], z[name]).sum()
+            potential_energy += self._sum_chains(transform.log_abs_det_jacobian(z_constrained[name], z[name]))
         return potential_energy
 
     def _energy(self, z, r):
@@ -96,11 +295,69 @@ class HMC(TraceKernel):
     def _reset(self):
         self._t = 0
         self._accept_cnt = 0
-        self._r_dist = OrderedDict()
+        self._r_shape = None
+        self._rng = None
+        self._layout = OrderedDict()
         self._args = None
         self._kwargs = None
         self._prototype_trace = None
         self._adapted_scheme = None
+        self._num_model_evals = 0
+        self._potential_trace = None
+        self._cache = None
+        self._compiled = False
+        self._subsample_values = {}
+        self._inverse_mass_matrix = None
+        self._mass_matrix_sqrt = None
+        self._mass_matrix_adapter = None
+        self._adapt_window_start = None
+        self._adapt_window_ends = []
+
+    def _cache_state(self, trace, z, potential_energy, z_grads):
+        """
+        Remembers the state at which ``trace`` was sampled, so that the next
+        call to :meth:`sample` with that trace need not run the model again.
+        """
+        self._cache = (trace, z, potential_energy, z_grads)
+
+    def _fetch_from_cache(self, trace):
+        """
+        Returns the sample trace, flat unconstrained state, potential energy and
+        its gradient at the state of ``trace``, running the model only if
+        ``trace`` is not the last sample returned by this kernel.
+        """
+        if self._cache is not None and self._cache[0] is trace:
+            return self._cache
+        z = self._get_initial_z(trace)
+        z_grads, potential_energy = potential_grad(self._potential_energy, z)
+        # `trace` may be the prototype trace, which is mutated by `_get_trace`,
+        # so a new trace is used instead
+        return self._trace_at(z, self._potential_trace), z, potential_energy, z_grads
+
+    def _trace_at(self, z, potential_trace):
+        """
+        Returns the sample trace at the flat unconstrained state ``z``. If
+        ``potential_trace``, the trace recorded while computing the potential
+        energy at ``z``, is available, its values are detached and it is
+        reused; otherwise, the model is run again once the trace is read.
+        """
+        if potential_trace is None:
+            return self._lazy_trace(z)
+        for name, site in potential_trace.nodes.items():
+            if site["type"] == "sample":
+                site["value"] = site["value"].detach()
+                for key in ("log_pdf", "batch_log_pdf"):
+                    if key in site:
+                        del site[key]
+        return potential_trace
+
+    def _accept_logprob(self, delta_energy):
+        """
+        Log of the (mean, if chains are vectorized) Metropolis acceptance probability.
+        """
+        if self.num_chains == 1:
+            return -delta_energy
+        return (-delta_energy).exp().clamp(max=1).mean().log()
 
     def _find_reasonable_step_size(self, z):
         step_size = self.step_size
@@ -112,15 +369,14 @@ class HMC(TraceKernel):
         # We are going to find a step_size which make accept_prob (Metropolis correction)
         # near the target_accept_prob. If accept_prob:=exp(-delta_energy) is small,
         # then we have to decrease step_size; otherwise, increase step_size.
-        r = {name: pyro.sample("r_{}_presample".format(name), self._r_dist[name])
-             for name in self._r_dist}
+        r = self._sample_momentum()
         energy_current = self._energy(z, r)
         z_new, r_new, z_grads, potential_energy = single_step_velocity_verlet(
-            z, r, self._potential_energy, step_size)
+            z, r, self._potential_energy, step_size, inverse_mass_matrix=self._inverse_mass_matrix)
         energy_new = potential_energy + self._kinetic_energy(r_new)
         delta_energy = energy_new - energy_current
         # direction=1 means keep increasing step_size, otherwise decreasing step_size
-        direction = 1 if target_accept_logprob < -delta_energy else -1
+        direction = 1 if target_accept_logprob < self._accept_logprob(delta_energy) else -1
 
         # define scale for step_size: 2 for increasing, 1/2 for decreasing
         step_size_scale = 2 ** direction
@@ -130,12 +386,19 @@ class HMC(TraceKernel):
         while direction_new == direction:
             step_size = step_size_scale * step_size
             z_new, r_new, z_grads, potential_energy = single_step_velocity_verlet(
-                z, r, self._potential_energy, step_size)
+                z, r, self._potential_energy, step_size, inverse_mass_matrix=self._inverse_mass_matrix)
             energy_new = potential_energy + self._kinetic_energy(r_new)
             delta_energy = energy_new - energy_current
-            direction_new = 1 if target_accept_logprob < -delta_energy else -1
+            direction_new = 1 if target_accept_logprob < self._accept_logprob(delta_energy) else -1
         return step_size
 
+    def _init_step_size_adaptation(self, z):
+        self.step_size = self._find_reasonable_step_size(z)
+        self.num_steps = max(1, int(self.trajectory_length / self.step_size))
+        # make prox-center for Dual Averaging scheme
+        mu = math.log(10 * self.step_size)
+        self._adapted_scheme = DualAveraging(prox_center=mu)
+
     def _adapt_step_size(self, accept_prob):
         # calculate a statistic for Dual Averaging scheme
         H = self._target_accept_prob - accept_prob
@@ -144,6 +407,23 @@ class HMC(TraceKernel):
         self.step_size = math.exp(log_step_size)
         self.num_steps = max(1, int(self.trajectory_length / self.step_size))
 
+    def _adapt_mass_matrix(self, z):
+        """
+        Adds the sample ``z`` to the estimate of the posterior (co)variance if
+        the current iteration is in an adaptation window, and updates the
+        inverse mass matrix at the end of the window.
+        """
+        if not self._adapt_window_ends or not self._adapt_window_start <= self._t < self._adapt_window_ends[-1]:
+            return
+        for sample in z.reshape(-1, z.size(-1)):
+            self._mass_matrix_adapter.update(sample)
+        if self._t + 1 in self._adapt_window_ends:
+            self._set_inverse_mass_matrix(self._mass_matrix_adapter.get_covariance())
+            self._mass_matrix_adapter.reset()
+            # the step size that suits the old mass matrix may not suit the new one
+            if self.adapt_step_size:
+                self._init_step_size_adaptation(z)
+
     def _validate_trace(self, trace):
         trace_log_pdf = trace.log_pdf()
         if is_nan(trace_log_pdf) or is_inf(trace_log_pdf):
@@ -157,28 +437,67 @@ class HMC(TraceKernel):
         self._kwargs = kwargs
         # set the trace prototype to inter-convert between trace object
         # and dict object used by the integrator
-        trace = poutine.trace(self.model).get_trace(*args, **kwargs)
+        trace = poutine.trace(self._model).get_trace(*args, **kwargs)
         self._prototype_trace = trace
-        # momenta distribution - currently standard normal
+        # the integrator state packs the unconstrained values of all sites into a
+        # single flat tensor; record the slice and shape of each site within it
+        size = 0
         for name, node in sorted(trace.iter_stochastic_nodes(), key=lambda x: x[0]):
-            r_mu = torch.zeros_like(node["value"])
-            r_sigma = torch.ones_like(node["value"])
-            self._r_dist[name] = dist.Normal(mu=r_mu, sigma=r_sigma)
+            if site_is_subsample(node):
+                self._subsample_values[name] = node["value"]
+                continue
+            shape = node["value"].shape
+            site_size = node["value"].numel() // self.num_chains
+            self._layout[name] = (slice(size, size + site_size), shape)
+            size += site_size
             if node["fn"].support is not constraints.real and self._automatic_transform_enabled:
                 self.transforms[name] = biject_to(node["fn"].support).inv
+        # standard normal noise of this shape is scaled to momenta distributed as N(0, M)
+        self._r_shape = self._batch_shape + (size,)
+        # auxiliary randomness is drawn directly from the kernel's own generator
+        self._rng = torch.Generator()
+        rng_seed = self.rng_seed
+        if rng_seed is None:
+            rng_seed = int(torch.randint(0, 2 ** 31, (1,)).item())
+        self._rng.manual_seed(rng_seed)
+        self._set_inverse_mass_matrix(torch.eye(size) if self.full_mass else torch.ones(size))
         self._validate_trace(trace)
+        self._compiled = self.compile_potential
 
         if self.adapt_step_size:
-            z = {name: node["value"] for name, node in trace.iter_stochastic_nodes()}
-            for name, transform in self.transforms.items():
-                z[name] = transform(z[name])
-            self.step_size = self._find_reasonable_step_size(z)
-            self.num_steps = max(1, int(self.trajectory_length / self.step_size))
-            # make prox-center for Dual Averaging scheme
-            mu = math.log(10 * self.step_size)
-            self._adapted_scheme = DualAveraging(prox_center=mu)
+            self._init_step_size_adaptation(self._get_initial_z(trace))
+        # only count the model evaluations made while sampling
+        self._num_model_evals = 0
+
+    def begin_warmup(self, warmup_steps):
+        if not self.adapt_mass_matrix:
+            return
+        # adaptation windows, as in Stan: a fast initial buffer in which only the
+        # step size is adapted, then slow windows of doubling size in which the
+        # mass matrix is estimated, then a fast terminal buffer
+        init_buffer, term_buffer, base_window = 75, 50, 25  # from Stan
+        self._adapt_window_ends = []
+        if warmup_steps < 20:
+            return
+        if init_buffer + base_window + term_buffer > warmup_steps:
+            init_buffer = int(0.15 * warmup_steps)
+            term_buffer = int(0.1 * warmup_steps)
+            base_window = warmup_steps - init_buffer - term_buffer
+        self._adapt_window_start = init_buffer
+        end = init_buffer + base_window
+        window_size = base_window
+        while True:
+            # stretch the last window to the terminal buffer if the next one does not fit
+            if end + 2 * window_size > warmup_steps - term_buffer:
+                self._adapt_window_ends.append(warmup_steps - term_buffer)
+                break
+            self._adapt_window_ends.append(end)
+            window_size *= 2
+            end += window_size
+        self._mass_matrix_adapter = WelfordCovariance(diagonal=not self.full_mass)
 
     def end_warmup(self):
+        self.adapt_mass_matrix = False
         if self.adapt_step_size:
             self.adapt_step_size = False
             _, log_step_size_avg = self._adapted_scheme.get_state()
@@ -188,37 +507,82 @@ class HMC(TraceKernel):
     def cleanup(self):
         self._reset()
 
-    def sample(self, trace):
-        z = {name: node["value"].detach() for name, node in trace.iter_stochastic_nodes()}
+    def _get_initial_z(self, trace):
+        """
+        Packs the values of the latent sites in ``trace``, transformed to
+        unconstrained space, into the flat tensor used by the integrator.
+        """
+        z = {name: trace.nodes[name]["value"].detach() for name in self._layout}
         # automatically transform `z` to unconstrained space, if needed.
         for name, transform in self.transforms.items():
             z[name] = transform(z[name])
-        r = {name: pyro.sample("r_{}_t={}".format(name, self._t), self._r_dist[name])
-             for name in self._r_dist}
+        return self._pack(z)
 
-        z_new, r_new = velocity_verlet(z, r,
-                                       self._potential_energy,
-                                       self.step_size,
-                                       self.num_steps)
+    def _lazy_trace(self, z):
+        """
+        Returns the trace of the model at the flat unconstrained state ``z``,
+        which is only recorded when it is first read, possibly after
+        :meth:`cleanup`.
+        """
+        z = self._unpack(z)
+        # get trace with the constrained values for `z`.
+        for name, transform in self.transforms.items():
+            z[name] = transform.inv(z[name])
+        model, args, kwargs, z_trace = self._model, self._args, self._kwargs, self._prototype_trace
+
+        def record():
+            for name, value in z.items():
+                z_trace.nodes[name]["value"] = value
+            trace_poutine = poutine.trace(poutine.replay(model, trace=z_trace))
+            trace_poutine(*args, **kwargs)
+            self._num_model_evals += 1
+            return trace_poutine.trace
+
+        return _LazyTrace(record)
+
+    def sample(self, trace):
+        # the potential energy and its gradient at the current state are reused
+        # from the previous iteration, so each leapfrog step runs the model once
+        trace, z, potential_energy, z_grads = self._fetch_from_cache(trace)
+        r = self._sample_momentum()
+
+        z_new, r_new, z_grads_new, potential_energy_new = velocity_verlet(
+            z, r, self._potential_energy, self.step_size, self.num_steps, z_grads=z_grads,
+            inverse_mass_matrix=self._inverse_mass_matrix)
+        trace_new = self._potential_trace
         # apply Metropolis correction.
-        energy_proposal = self._energy(z_new, r_new)
-        energy_current = self._energy(z, r)
+        energy_proposal = potential_energy_new + self._kinetic_energy(r_new)
+        energy_current = potential_energy + self._kinetic_energy(r)
         delta_energy = energy_proposal - energy_current
-        rand = pyro.sample("rand_t={}".format(self._t), dist.Uniform(torch.zeros(1), torch.ones(1)))
-        if rand < (-delta_energy).exp():
-            self._accept_cnt += 1
-            z = z_new
+        rand = torch.rand(self.num_chains, generator=self._rng)
+        if self.num_chains == 1:
+            if rand < (-delta_energy).exp():
+                self._accept_cnt += 1
+                z, potential_energy, z_grads = z_new, potential_energy_new, z_grads_new
+                trace = self._trace_at(z, trace_new)
+        else:
+            # accept or reject the proposal of each chain
+            accept = rand < (-delta_energy).exp()
+            self._accept_cnt += accept.sum().item()
+            if accept.all():
+                z, potential_energy, z_grads = z_new, potential_energy_new, z_grads_new
+                trace = self._trace_at(z, trace_new)
+            elif accept.any():
+                z = torch.where(accept.unsqueeze(-1).expand_as(z), z_new, z)
+                potential_energy = torch.where(accept, potential_energy_new, potential_energy)
+                z_grads = torch.where(accept.unsqueeze(-1).expand_as(z_grads), z_grads_new, z_grads)
+                trace = self._lazy_trace(z)
 
         if self.adapt_step_size:
-            accept_prob = (-delta_energy).exp().clamp(max=1).item()
+            accept_prob = (-delta_energy).exp().clamp(max=1).mean().item()
             self._adapt_step_size(accept_prob)
+        if self.adapt_mass_matrix:
+            self._adapt_mass_matrix(z)
 
         self._t += 1
-        # get trace with the constrained values for `z`.
-        for name, transform in self.transforms.items():
-            z[name] = transform.inv(z[name])
-        return self._get_trace(z)
+        self._cache_state(trace, z, potential_energy, z_grads)
+        return trace
 
     def diagnostics(self):
-        return "Step size: {:.6f} | Acceptance rate: {:.6f}".format(
-            self.step_size, self._accept_cnt / self._t)
+        return "Step size: {:.6f} | Acceptance rate: {:.6f} | Model evaluations per sample: {:.1f}".format(
+            self.step_size, self._accept_cnt / (self._t * self.num_chains), self._num_model_evals / self._t)
@@ -2,10 +2,19 @@ from __future__ import absolute_import, division, print_function
 
 import logging
 import math
+import multiprocessing
+import pickle
+import traceback
 
 import torch
+from six.moves.queue import Empty
 
+import pyro
 from pyro.infer import TracePosterior
+from pyro.poutine.trace import Trace
+
+# seconds to wait for a message from the chain workers before checking that they are still alive
+_WORKER_POLL_TIMEOUT = 1.0
 
 
 class MCMC(TracePosterior):
@@ -21,17 +30,98 @@ class MCMC(TracePosterior):
         excluding the samples discarded during the warmup phase.
     :param int warmup_steps: Number of warmup iterations. The samples generated
         during the warmup phase are discarded.
+    :param int num_chains: Number of independent chains. If more than one, each
+        chain runs in its own worker process with its own seed and its own copy
+        of the kernel (including its step size adaptation). If the kernel has an
+        ``rng_seed``, chain ``i`` uses ``rng_seed + i``. The samples are
+        streamed back to this process. The traces of these samples only hold
+        the sample sites, with their values and log densities, and the return
+        value of the model.
     """
 
-    def __init__(self, kernel, num_samples, warmup_steps=0):
+    def __init__(self, kernel, num_samples, warmup_steps=0, num_chains=1):
         self.kernel = kernel
         self.warmup_steps = warmup_steps
         self.num_samples = num_samples
+        self.num_chains = num_chains
         self.logger = logging.getLogger(__name__)
         super(MCMC, self).__init__()
 
     def _traces(self, *args, **kwargs):
+        if self.num_chains == 1:
+            for trace in self._chain_traces(*args, **kwargs):
+                yield (trace, torch.tensor([1.0]))
+            return
+        for chain in self.get_chains(*args, **kwargs):
+            for trace in chain:
+                yield (trace, torch.tensor([1.0]))
+
+    def get_chains(self, *args, **kwargs):
+        """
+        Runs all chains, in parallel worker processes if there is more than one.
+
+        :returns: the sample traces of each chain, excluding warmup
+        :rtype: list of lists of :class:`~pyro.poutine.trace.Trace`
+        """
+        if self.num_chains == 1:
+            return [list(self._chain_traces(*args, **kwargs))]
+
+        # seed each chain from the current rng state, so that runs are reproducible
+        seeds = torch.randint(0, 2 ** 31, (self.num_chains,)).long().tolist()
+        queue = multiprocessing.Queue()
+        workers = [multiprocessing.Process(target=self._run_chain, args=(chain_id, seed, queue, args, kwargs))
+                   for chain_id, seed in enumerate(seeds)]
+        for worker in workers:
+            worker.daemon = True
+            worker.start()
+
+        # rebuild the traces of each chain as their samples arrive
+        chains = [[] for _ in range(self.num_chains)]
+        running = set(range(self.num_chains))
+        exited = set()
+        try:
+            while running:
+                try:
+                    chain_id, status, payload = queue.get(timeout=_WORKER_POLL_TIMEOUT)
+                except Empty:
+                    # a worker that exited without reporting has died, e.g. it was killed by the OS. Its
+                    # last messages may still be in flight, so it is only reported at the next timeout.
+                    for chain_id in running:
+                        if not workers[chain_id].is_alive():
+                            if chain_id in exited:
+                                raise RuntimeError("chain {} exited unexpectedly with exit code {}"
+                                                   .format(chain_id, workers[chain_id].exitcode))
+                            exited.add(chain_id)
+                    continue
+                if status == "sample":
+                    chains[chain_id].append(_unpack_sample(pickle.loads(payload), args, kwargs))
+                elif status == "done":
+                    running.remove(chain_id)
+                else:
+                    raise RuntimeError("chain {} failed:\n{}".format(chain_id, payload))
+        finally:
+            for worker in workers:
+                if running:
+                    worker.terminate()
+                worker.join()
+        return chains
+
+    def _run_chain(self, chain_id, seed, queue, args, kwargs):
+        try:
+            pyro.set_rng_seed(seed)
+            if getattr(self.kernel, "rng_seed", None) is not None:
+                # a kernel seeded by the user, e.g. HMC(..., rng_seed=s), draws a different stream in each chain
+                self.kernel.rng_seed += chain_id
+            for trace in self._chain_traces(*args, **kwargs):
+                sample = _pack_sample(trace, args, kwargs)
+                queue.put((chain_id, "sample", pickle.dumps(sample, pickle.HIGHEST_PROTOCOL)))
+            queue.put((chain_id, "done", None))
+        except Exception:
+            queue.put((chain_id, "error", traceback.format_exc()))
+
+    def _chain_traces(self, *args, **kwargs):
         self.kernel.setup(*args, **kwargs)
+        self.kernel.begin_warmup(self.warmup_steps)
         trace = self.kernel.initial_trace()
         self.logger.info("Starting MCMC using kernel - {} ...".format(self.kernel.__class__.__name__))
         logging_interval = math.ceil((self.warmup_steps + self.num_samples) / 20)
@@ -46,5 +136,42 @@ class MCMC(TracePosterior):
                 if t == self.warmup_steps:
                     self.kernel.end_warmup()
                 continue
-            yield (trace, torch.tensor([1.0]))
+            yield trace
         self.kernel.cleanup()
+
+
+def _pack_sample(trace, args, kwargs):
+    # the log densities are computed by the worker, so that the trace need not be rebuilt by running the
+    # model. Observed values that are arguments of the model are sent as references to those arguments,
+    # so that the message size does not grow with the data.
+    trace.log_pdf()
+    arg_ids = {id(arg): ("arg", i) for i, arg in enumerate(args)}
+    arg_ids.update((id(arg), ("kwarg", key)) for key, arg in kwargs.items())
+    sites = []
+    for name, site in trace.nodes.items():
+        if site["type"] != "sample":
+            continue
+        value = arg_ids.get(id(site["value"])) if site["is_observed"] else None
+        if value is None:
+            value = "value", _detach(site["value"])
+        sites.append((name, site["is_observed"], value, site["infer"], _detach(site["log_pdf"])))
+    return_value = trace.nodes["_RETURN"]["value"] if "_RETURN" in trace else None
+    return sites, _detach(return_value)
+
+
+def _detach(x):
+    return x.detach() if torch.is_tensor(x) else x
+
+
+def _unpack_sample(sample, args, kwargs):
+    sites, return_value = sample
+    trace = Trace()
+    for name, is_observed, (source, value), infer, log_pdf in sites:
+        if source == "arg":
+            value = args[value]
+        elif source == "kwarg":
+            value = kwargs[value]
+        trace.add_node(name, type="sample", name=name, is_observed=is_observed, value=value,
+                       infer=infer, log_pdf=log_pdf)
+    trace.add_node("_RETURN", name="_RETURN", type="return", value=return_value)
+    return trace
@@ -1,25 +1,34 @@
 from __future__ import absolute_import, division, print_function
 
+import math
 from collections import namedtuple
 
 import torch
 
-import pyro
-import pyro.distributions as dist
 from pyro.infer.util import torch_data_sum
 from pyro.ops.integrator import single_step_velocity_verlet
 
 from .hmc import HMC
 
 
+# z, r and z_grads are the state at the last leaf built, from which the
+# trajectory is extended in the same direction at the next doubling;
+# z_proposal_pe, z_proposal_grads and z_proposal_trace are kept to avoid
+# running the model again at z_proposal if it is accepted;
+# log_weight is the log of the sum of the weights exp(-dE) of the states of the tree,
+# used for multinomial sampling;
 # sum_accept_probs and num_proposals are used to calculate
-# the statistic accept_prob for Dual Averaging scheme;
-# z_left_grads and z_right_grads are kept to avoid recalculating
-# grads at left and right leaves
-_TreeInfo = namedtuple("TreeInfo", ["z_left", "r_left", "z_left_grads",
-                                    "z_right", "r_right", "z_right_grads",
-                                    "z_proposal", "size", "turning", "diverging",
-                                    "sum_accept_probs", "num_proposals"])
+# the statistic accept_prob for Dual Averaging scheme
+_TreeInfo = namedtuple("TreeInfo", ["z", "r", "z_grads", "z_proposal", "z_proposal_pe",
+                                    "z_proposal_grads", "z_proposal_trace", "size", "log_weight",
+                                    "turning", "diverging", "sum_accept_probs", "num_proposals"])
+
+
+def _logaddexp(x, y):
+    if x == -float('inf'):
+        return y
+    m = max(x, y)
+    return m + math.log(math.exp(x - m) + math.exp(y - m))
 
 
 class NUTS(HMC):
@@ -31,6 +40,9 @@ class NUTS(HMC):
     [1] `The No-U-turn sampler: adaptively setting path lengths in Hamiltonian Monte Carlo`,
     Matthew D. Hoffman, and Andrew Gelman
 
+    [2] `A Conceptual Introduction to Hamiltonian Monte Carlo`,
+    Michael Betancourt
+
     :param model: Python callable containing pyro primitives.
     :param float step_size: Determines the size of a single step taken by the
         verlet integrator while computing the trajectory using Hamiltonian
@@ -43,6 +55,19 @@ class NUTS(HMC):
         If not specified and the model has sites with constrained support,
         automatic transformations will be applied, as specified in
         :mod:`torch.distributions.constraint_registry`.
+    :param bool compile_potential: Whether to compute the potential energy without
+        recording a trace of the model at each step, see :class:`HMC`.
+    :param bool adapt_mass_matrix: A flag to decide if we want to adapt the mass
+        matrix during warm-up phase, see :class:`HMC`.
+    :param bool full_mass: A flag to decide if the mass matrix is dense rather
+        than diagonal.
+    :param bool use_multinomial_sampling: A flag to decide if we want to sample
+        the proposal from the trajectory with probabilities proportional to
+        the joint density of its states, favouring the states of each new
+        subtree (biased progressive sampling, see :math:`[2]`), rather than
+        uniformly among the states in a slice as in :math:`[1]`.
+    :param int rng_seed: Optional seed of the random number generator of the
+        kernel, from which all of its auxiliary randomness is drawn, see :class:`HMC`.
 
     Example::
 
@@ -63,9 +88,14 @@ class NUTS(HMC):
             posterior.append(trace.nodes['beta']['value'])
     """
 
-    def __init__(self, model, step_size=None, adapt_step_size=False, transforms=None):
+    def __init__(self, model, step_size=None, adapt_step_size=False, transforms=None,
+                 compile_potential=True, adapt_mass_matrix=False, full_mass=False,
+                 use_multinomial_sampling=False, rng_seed=None):
         super(NUTS, self).__init__(model, step_size, adapt_step_size=adapt_step_size,
-                                   transforms=transforms)
+                                   transforms=transforms, compile_potential=compile_potential,
+                                   adapt_mass_matrix=adapt_mass_matrix, full_mass=full_mass,
+                                   rng_seed=rng_seed)
+        self.use_multinomial_sampling = use_multinomial_sampling
 
         self._max_tree_depth = 10  # from Stan
         # There are three conditions to stop doubling process:
@@ -78,112 +108,103 @@ class NUTS(HMC):
         # This also suggests the notion "diverging" in the implemenation:
         #     when the energy E_p diverges from E_u too much, we stop doubling.
         # Here, as suggested in [1], we set dE_max = 1000.
+        # Without the slice variable, i.e. for multinomial sampling, E_u is replaced by
+        #     the energy of the initial state.
         self._max_sliced_energy = 1000
 
+    def _uniform(self):
+        """
+        Draws a number uniformly from :math:`[0, 1)` with the kernel's generator.
+        """
+        return torch.rand(1, generator=self._rng).item()
+
     def _is_turning(self, z_left, r_left, z_right, r_right):
-        z_left = torch.stack([z_left[name] for name in self._r_dist])
-        r_left = torch.stack([r_left[name] for name in self._r_dist])
-        z_right = torch.stack([z_right[name] for name in self._r_dist])
-        r_right = torch.stack([r_right[name] for name in self._r_dist])
+        # the U-turn criterion is computed with velocities, which are the
+        # momenta scaled by the inverse mass matrix
         dz = z_right - z_left
-        return (torch_data_sum(dz * r_left) < 0) or (torch_data_sum(dz * r_right) < 0)
-
-    def _build_basetree(self, z, r, z_grads, log_slice, direction, energy_current):
-        step_size = self.step_size if direction == 1 else -self.step_size
-        z_new, r_new, z_grads, potential_energy = single_step_velocity_verlet(
-            z, r, self._potential_energy, step_size, z_grads=z_grads)
-        energy_new = potential_energy + self._kinetic_energy(r_new)
-        sliced_energy = energy_new + log_slice
-
-        # As a part of the slice sampling process (see below), along the trajectory
-        #     we eliminate states which p(z, r) < u, or dE > 0.
-        # Due to this elimination (and stop doubling conditions),
-        #     the size of binary tree might not equal to 2^tree_depth.
-        tree_size = 1 if sliced_energy <= 0 else 0
-        diverging = sliced_energy >= self._max_sliced_energy
-        delta_energy = energy_new - energy_current
-        accept_prob = (-delta_energy).exp().clamp(max=1)
-        return _TreeInfo(z_new, r_new, z_grads, z_new, r_new, z_grads,
-                         z_new, tree_size, False, diverging, accept_prob, 1)
+        v_left = self._velocity(r_left)
+        v_right = self._velocity(r_right)
+        return (torch_data_sum(dz * v_left) < 0) or (torch_data_sum(dz * v_right) < 0)
 
     def _build_tree(self, z, r, z_grads, log_slice, direction, tree_depth, energy_current):
-        if tree_depth == 0:
-            return self._build_basetree(z, r, z_grads, log_slice, direction, energy_current)
-
-        # build the first half of tree
-        half_tree = self._build_tree(z, r, z_grads, log_slice,
-                                     direction, tree_depth-1, energy_current)
-        z_proposal = half_tree.z_proposal
-
-        # Check conditions to stop doubling. If we meet that condition,
-        #     there is no need to build the other tree.
-        if half_tree.turning or half_tree.diverging:
-            return half_tree
-
-        # Else, build remaining half of tree.
-        # If we are going to the right, start from the right leaf of the first half.
-        if direction == 1:
-            z = half_tree.z_right
-            r = half_tree.r_right
-            z_grads = half_tree.z_right_grads
-        else:  # otherwise, start from the left leaf of the first half
-            z = half_tree.z_left
-            r = half_tree.r_left
-            z_grads = half_tree.z_left_grads
-        other_half_tree = self._build_tree(z, r, z_grads, log_slice,
-                                           direction, tree_depth-1, energy_current)
-
-        tree_size = half_tree.size + other_half_tree.size
-        sum_accept_probs = half_tree.sum_accept_probs + other_half_tree.sum_accept_probs
-        num_proposals = half_tree.num_proposals + other_half_tree.num_proposals
-
-        # Under the slice sampling process, a proposal for z is uniformly picked.
-        # The probability of that proposal belongs to which half of tree
-        #     is computed based on the sizes of each half.
-        # For the special case that the sizes of each half are both 0,
-        #     we choose the proposal from the first half
-        #     (any is fine, because the probability of picking it at the end is 0!).
-        if tree_size != 0:
-            other_half_tree_prob = other_half_tree.size / tree_size
-            is_other_half_tree = pyro.sample("is_other_halftree",
-                                             dist.Bernoulli(ps=torch.ones(1) * other_half_tree_prob))
-            if int(is_other_half_tree.item()) == 1:
-                z_proposal = other_half_tree.z_proposal
-
-        # leaves of the full tree are determined by the direction
-        if direction == 1:
-            z_left = half_tree.z_left
-            r_left = half_tree.r_left
-            z_left_grads = half_tree.z_left_grads
-            z_right = other_half_tree.z_right
-            r_right = other_half_tree.r_right
-            z_right_grads = other_half_tree.z_right_grads
-        else:
-            z_left = other_half_tree.z_left
-            r_left = other_half_tree.r_left
-            z_left_grads = other_half_tree.z_left_grads
-            z_right = half_tree.z_right
-            r_right = half_tree.r_right
-            z_right_grads = half_tree.z_right_grads
-
-        # We already check if first half tree is turning. Now, we check
-        #     if the other half tree or full tree are turning.
-        turning = other_half_tree.turning or self._is_turning(z_left, r_left, z_right, r_right)
-
-        # The divergence is checked by the second half tree (the first half is already checked).
-        diverging = other_half_tree.diverging
+        """
+        Builds a balanced binary tree of ``2 ** tree_depth`` leapfrog steps from
+        ``(z, r)`` in the given direction.
+
+        Instead of recursing into both halves of each subtree, the leaves are
+        built one at a time, in trajectory order. The subtree of size ``2 ** k``
+        containing leaf ``n`` starts at a leaf with ``n % 2 ** k == 0`` and is
+        complete at a leaf with ``(n + 1) % 2 ** k == 0``, so keeping the first
+        state of the current subtree at each of the ``tree_depth`` levels is
+        enough to check every subtree for a U-turn as soon as it is complete.
+        """
+        step_size = self.step_size if direction == 1 else -self.step_size
+        # the first (z, r) of the current subtree of size 2 ** k is checkpoints[k]
+        checkpoints = [None] * (tree_depth + 1)
+        z_proposal = z_proposal_pe = z_proposal_grads = z_proposal_trace = None
+        tree_size = 0
+        tree_log_weight = -float('inf')
+        sum_accept_probs = 0.
+        num_proposals = 0
+        turning = diverging = False
+
+        for n in range(2 ** tree_depth):
+            z, r, z_grads, potential_energy = single_step_velocity_verlet(
+                z, r, self._potential_energy, step_size, z_grads=z_grads,
+                inverse_mass_matrix=self._inverse_mass_matrix)
+            energy_new = potential_energy + self._kinetic_energy(r)
+            delta_energy = energy_new - energy_current
+            sliced_energy = delta_energy if self.use_multinomial_sampling else energy_new + log_slice
+            sum_accept_probs = sum_accept_probs + (-delta_energy).exp().clamp(max=1)
+            num_proposals += 1
+
+            # As a part of the slice sampling process (see below), along the trajectory
+            #     we eliminate states which p(z, r) < u, or dE > 0.
+            # Due to this elimination (and stop doubling conditions),
+            #     the size of binary tree might not equal to 2^tree_depth.
+            # Under the slice sampling process, a proposal for z is uniformly picked
+            #     from the remaining states. Replacing the proposal by the i-th of them
+            #     with probability 1/i leaves each of them equally likely to be picked.
+            # For multinomial sampling, all states are kept, and the probability of the
+            #     i-th of them is proportional to its weight exp(-dE) instead.
+            if self.use_multinomial_sampling or sliced_energy <= 0:
+                tree_size += 1
+                if self.use_multinomial_sampling:
+                    log_weight = -delta_energy.item()
+                    tree_log_weight = _logaddexp(tree_log_weight, log_weight)
+                    new_proposal_prob = math.exp(log_weight - tree_log_weight)
+                else:
+                    new_proposal_prob = 1. / tree_size
+                if tree_size == 1 or self._uniform() < new_proposal_prob:
+                    z_proposal, z_proposal_pe, z_proposal_grads = z, potential_energy, z_grads
+                    z_proposal_trace = self._potential_trace
+
+            # Check conditions to stop doubling. If we meet that condition,
+            #     there is no need to build the rest of the tree.
+            diverging = sliced_energy >= self._max_sliced_energy
+            if diverging:
+                break
+            for k in range(1, tree_depth + 1):
+                if n % 2 ** k == 0:
+                    checkpoints[k] = (z, r)
+                elif (n + 1) % 2 ** k == 0:
+                    z_first, r_first = checkpoints[k]
+                    if direction == 1:
+                        turning = self._is_turning(z_first, r_first, z, r)
+                    else:
+                        turning = self._is_turning(z, r, z_first, r_first)
+                    if turning:
+                        break
+            if turning:
+                break
 
-        return _TreeInfo(z_left, r_left, z_left_grads, z_right, r_right, z_right_grads, z_proposal,
-                         tree_size, turning, diverging, sum_accept_probs, num_proposals)
+        return _TreeInfo(z, r, z_grads, z_proposal, z_proposal_pe, z_proposal_grads, z_proposal_trace,
+                         tree_size, tree_log_weight, turning, diverging, sum_accept_probs, num_proposals)
 
     def sample(self, trace):
-        z = {name: node["value"].detach() for name, node in trace.iter_stochastic_nodes()}
-        # automatically transform `z` to unconstrained space, if needed.
-        for name, transform in self.transforms.items():
-            z[name] = transform(z[name])
-        r = {name: pyro.sample("r_{}_t={}".format(name, self._t), self._r_dist[name])
-             for name in self._r_dist}
-        energy_current = self._energy(z, r)
+        trace, z, potential_energy, z_grads = self._fetch_from_cache(trace)
+        r = self._sample_momentum()
+        energy_current = potential_energy + self._kinetic_energy(r)
 
         # Ideally, following a symplectic integrator trajectory, the energy is constant.
         # In that case, we can sample the proposal uniformly, and there is no need to use "slice".
@@ -197,61 +218,69 @@ class NUTS(HMC):
         #     `Slice sampling` by Radford M. Neal.
         # For another version of NUTS which uses multinomial sampling instead of slice sampling, see
         #     `A Conceptual Introduction to Hamiltonian Monte Carlo` by Michael Betancourt.
-        joint_prob = torch.exp(-energy_current)
-        if joint_prob == 0:
-            slice_var = torch.tensor(0)
+        if self.use_multinomial_sampling:
+            log_slice = None
         else:
-            slice_var = pyro.sample("slicevar_t={}".format(self._t),
-                                    dist.Uniform(torch.zeros(1), joint_prob))
-        log_slice = slice_var.log()
+            # log u = log(p(z_0, r_0) * v) with v ~ Uniform(0, 1]
+            log_slice = math.log(1. - self._uniform()) - energy_current
 
         z_left = z_right = z
         r_left = r_right = r
-        z_left_grads = z_right_grads = None
+        z_left_grads = z_right_grads = z_grads
         tree_size = 1
+        tree_log_weight = 0.  # the weight of the initial state is exp(-dE) = 1
         accepted = False
 
         # doubling process, stop when turning or diverging
         for tree_depth in range(self._max_tree_depth + 1):
-            direction = pyro.sample("direction_t={}_treedepth={}".format(self._t, tree_depth),
-                                    dist.Bernoulli(ps=torch.ones(1) * 0.5))
-            direction = int(direction.item())
+            direction = 1 if self._uniform() < 0.5 else 0
             if direction == 1:  # go to the right, start from the right leaf of current tree
                 new_tree = self._build_tree(z_right, r_right, z_right_grads, log_slice,
                                             direction, tree_depth, energy_current)
                 # update leaf for the next doubling process
-                z_right = new_tree.z_right
-                r_right = new_tree.r_right
-                z_right_grads = new_tree.z_right_grads
+                z_right = new_tree.z
+                r_right = new_tree.r
+                z_right_grads = new_tree.z_grads
             else:  # go the the left, start from the left leaf of current tree
                 new_tree = self._build_tree(z_left, r_left, z_left_grads, log_slice,
                                             direction, tree_depth, energy_current)
-                z_left = new_tree.z_left
-                r_left = new_tree.r_left
-                z_left_grads = new_tree.z_left_grads
+                z_left = new_tree.z
+                r_left = new_tree.r
+                z_left_grads = new_tree.z_grads
 
             if new_tree.turning or new_tree.diverging:  # stop doubling
                 break
 
-            rand = pyro.sample("rand_t={}_treedepth={}".format(self._t, tree_depth),
-                               dist.Uniform(torch.zeros(1), torch.ones(1)))
-            if rand < new_tree.size / tree_size:
+            # The proposal of the new tree is accepted with probability proportional
+            #     to its size (or weight). For multinomial sampling, the probability is
+            #     biased towards the new tree, which moves the sample further away from
+            #     the initial state while leaving the target distribution invariant.
+            if self.use_multinomial_sampling:
+                new_tree_prob = math.exp(min(0., new_tree.log_weight - tree_log_weight))
+            else:
+                new_tree_prob = new_tree.size / tree_size
+            if self._uniform() < new_tree_prob:
                 accepted = True
                 z = new_tree.z_proposal
+                potential_energy = new_tree.z_proposal_pe
+                z_grads = new_tree.z_proposal_grads
+                proposal_trace = new_tree.z_proposal_trace
 
             if self._is_turning(z_left, r_left, z_right, r_right):  # stop doubling
                 break
             else:  # update tree_size
                 tree_size += new_tree.size
+                tree_log_weight = _logaddexp(tree_log_weight, new_tree.log_weight)
 
         if self.adapt_step_size:
             accept_prob = new_tree.sum_accept_probs.item() / new_tree.num_proposals
             self._adapt_step_size(accept_prob)
+        if self.adapt_mass_matrix:
+            self._adapt_mass_matrix(z)
 
         if accepted:
             self._accept_cnt += 1
+            trace = self._trace_at(z, proposal_trace)
         self._t += 1
-        # get trace with the constrained values for `z`.
-        for name, transform in self.transforms.items():
-            z[name] = transform.inv(z[name])
-        return self._get_trace(z)
+        self._cache_state(trace, z, potential_energy, z_grads)
+        return trace
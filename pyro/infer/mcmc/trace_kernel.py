@@ -34,6 +34,15 @@ class TraceKernel(object):
         """
         return None
 
+    def begin_warmup(self, warmup_steps):
+        """
+        Optional method to tell kernel, after :meth:`setup`, the number of
+        warm-up steps that follow, so that it can schedule its adaptation.
+
+        :param int warmup_steps: Number of warm-up iterations.
+        """
+        pass
+
     def end_warmup(self):
         """
         Optional method to tell kernel that warm-up phase has been finished.
@@ -17,6 +17,8 @@ class SVI(object):
         in the case this is a built-in loss `loss_and_grads` will be filled in accordingly
     :param loss_and_grads: if specified, this user-provided callable computes gradients for use in `step()`
         and marks which parameters in the param store are to be optimized
+    :param kwargs: if `loss` is 'ELBO', keyword arguments passed to :meth:`ELBO.make
+        <pyro.infer.elbo.ELBO.make>`, e.g. `num_particles` or `freeze_structure`
 
     A unified interface for stochastic variational inference in Pyro. Most
     users will interact with `SVI` with the argument `loss="ELBO"`. See the
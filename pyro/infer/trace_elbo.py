@@ -7,14 +7,14 @@ import pyro.poutine as poutine
 from pyro.distributions.util import is_identically_zero
 import pyro.infer as infer
 from pyro.infer.elbo import ELBO
-from pyro.infer.util import MultiFrameTensor, get_iarange_stacks
+from pyro.infer.util import MultiFrameTensor
+from pyro.poutine.indep_poutine import ParticleMessenger
 from pyro.poutine.util import prune_subsample_sites
 from pyro.util import check_model_guide_match, check_site_shape, is_nan
 
 
-def _compute_log_r(model_trace, guide_trace):
+def _compute_log_r(model_trace, guide_trace, stacks):
     log_r = MultiFrameTensor()
-    stacks = get_iarange_stacks(model_trace)
     for name, model_site in model_trace.nodes.items():
         if model_site["type"] == "sample":
             log_r_term = model_site["batch_log_pdf"]
@@ -27,30 +27,74 @@ def _compute_log_r(model_trace, guide_trace):
 class Trace_ELBO(ELBO):
     """
     A trace implementation of ELBO-based SVI
+
+    :param bool vectorize_particles: Whether to draw all ``num_particles``
+        particles in a single run of the model and guide, under an extra
+        batch dimension to the left of all :func:`pyro.iarange` dims, rather
+        than running them once per particle. This requires a finite
+        ``max_iarange_nesting``, and sample sites whose batch shape already
+        reaches the particle dim must have size ``num_particles`` there.
     """
 
+    def __init__(self,
+                 num_particles=1,
+                 max_iarange_nesting=float('inf'),
+                 freeze_structure=False,
+                 vectorize_particles=False):
+        if vectorize_particles and max_iarange_nesting == float('inf'):
+            raise ValueError("vectorize_particles requires a finite value for max_iarange_nesting")
+        super(Trace_ELBO, self).__init__(num_particles=num_particles,
+                                         max_iarange_nesting=max_iarange_nesting,
+                                         freeze_structure=freeze_structure)
+        self.vectorize_particles = vectorize_particles
+
+    def _vectorize_particles(self, fn):
+        """
+        Wraps a model or guide so that it draws ``num_particles`` particles at once.
+        """
+        def vectorized_fn(*args, **kwargs):
+            with ParticleMessenger("num_particles_vectorized", self.num_particles,
+                                   dim=-1 - self.max_iarange_nesting):
+                return fn(*args, **kwargs)
+        return vectorized_fn
+
     def _get_traces(self, model, guide, *args, **kwargs):
         """
         runs the guide and runs the model against the guide with
         the result packaged as a trace generator
         """
-        for i in range(self.num_particles):
+        num_runs = self.num_particles
+        max_iarange_nesting = self.max_iarange_nesting
+        if self.vectorize_particles:
+            model = self._vectorize_particles(model)
+            guide = self._vectorize_particles(guide)
+            num_runs = 1
+            max_iarange_nesting += 1
+
+        for i in range(num_runs):
             guide_trace = poutine.trace(guide).get_trace(*args, **kwargs)
             model_trace = poutine.trace(poutine.replay(model, guide_trace)).get_trace(*args, **kwargs)
-            if infer.is_validation_enabled():
+            structure = self._get_structure(model_trace, guide_trace)
+            validate = infer.is_validation_enabled() and not (structure is not None and structure.validated)
+            if validate:
                 check_model_guide_match(model_trace, guide_trace)
-            guide_trace = prune_subsample_sites(guide_trace)
-            model_trace = prune_subsample_sites(model_trace)
+            if structure is None:
+                guide_trace = prune_subsample_sites(guide_trace)
+                model_trace = prune_subsample_sites(model_trace)
+            else:
+                structure.prune(model_trace, guide_trace)
 
             model_trace.compute_batch_log_pdf()
             guide_trace.compute_score_parts()
-            if infer.is_validation_enabled():
+            if validate:
                 for site in model_trace.nodes.values():
                     if site["type"] == "sample":
-                        check_site_shape(site, self.max_iarange_nesting)
+                        check_site_shape(site, max_iarange_nesting)
                 for site in guide_trace.nodes.values():
                     if site["type"] == "sample":
-                        check_site_shape(site, self.max_iarange_nesting)
+                        check_site_shape(site, max_iarange_nesting)
+                if structure is not None:
+                    structure.validated = True
 
             yield model_trace, guide_trace
 
@@ -105,7 +149,7 @@ class Trace_ELBO(ELBO):
 
                         if not is_identically_zero(score_function_term):
                             if log_r is None:
-                                log_r = _compute_log_r(model_trace, guide_trace)
+                                log_r = _compute_log_r(model_trace, guide_trace, self._get_iarange_stacks(model_trace))
                             log_r_site = log_r.sum_to(guide_site["cond_indep_stack"])
                             surrogate_elbo_particle = surrogate_elbo_particle + (log_r_site * score_function_term).sum()
 
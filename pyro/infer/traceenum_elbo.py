@@ -16,16 +16,14 @@ from pyro.util import check_model_guide_match, check_site_shape, check_traceenum
 
 def _compute_dice_elbo(model_trace, guide_trace):
     dice = MultiFrameDice(guide_trace)
-    elbo = 0
+    costs = []
     for name, model_site in model_trace.nodes.items():
         if model_site["type"] == "sample":
-            cost = model_site["batch_log_pdf"]
+            costs.append((model_site["cond_indep_stack"], model_site["batch_log_pdf"]))
             if not model_site["is_observed"]:
-                cost = cost - guide_trace.nodes[name]["batch_log_pdf"]
-            dice_prob = dice.in_context(model_site["cond_indep_stack"])
+                costs.append((model_site["cond_indep_stack"], -guide_trace.nodes[name]["batch_log_pdf"]))
             # TODO use score_parts.entropy_term to "stick the landing"
-            elbo = elbo + (dice_prob * cost).sum()
-    return elbo
+    return dice.compute_expectation(costs)
 
 
 class TraceEnum_ELBO(ELBO):
@@ -56,22 +54,29 @@ class TraceEnum_ELBO(ELBO):
                 model_trace = poutine.trace(poutine.replay(model, guide_trace),
                                             graph_type="flat").get_trace(*args, **kwargs)
 
-                if infer.is_validation_enabled():
+                structure = self._get_structure(model_trace, guide_trace)
+                validate = infer.is_validation_enabled() and not (structure is not None and structure.validated)
+                if validate:
                     check_model_guide_match(model_trace, guide_trace, self.max_iarange_nesting)
-                guide_trace = prune_subsample_sites(guide_trace)
-                model_trace = prune_subsample_sites(model_trace)
-                if infer.is_validation_enabled():
+                if structure is None:
+                    guide_trace = prune_subsample_sites(guide_trace)
+                    model_trace = prune_subsample_sites(model_trace)
+                else:
+                    structure.prune(model_trace, guide_trace)
+                if validate:
                     check_traceenum_requirements(model_trace, guide_trace)
 
                 model_trace.compute_batch_log_pdf()
                 guide_trace.compute_score_parts()
-                if infer.is_validation_enabled():
+                if validate:
                     for site in model_trace.nodes.values():
                         if site["type"] == "sample":
                             check_site_shape(site, self.max_iarange_nesting)
                     for site in guide_trace.nodes.values():
                         if site["type"] == "sample":
                             check_site_shape(site, self.max_iarange_nesting)
+                    if structure is not None:
+                        structure.validated = True
 
                 yield model_trace, guide_trace
 
@@ -1,9 +1,9 @@
 from __future__ import absolute_import, division, print_function
 
 import warnings
+from collections import namedtuple
 from operator import itemgetter
 
-import networkx
 import torch
 
 import pyro
@@ -11,7 +11,7 @@ import pyro.infer as infer
 import pyro.poutine as poutine
 from pyro.distributions.util import is_identically_zero
 from pyro.infer import ELBO
-from pyro.infer.util import MultiFrameTensor, get_iarange_stacks, torch_backward, torch_data_sum
+from pyro.infer.util import MultiFrameTensor, _trace_signature, get_iarange_stacks, torch_backward, torch_data_sum
 from pyro.poutine.util import prune_subsample_sites
 from pyro.util import check_model_guide_match, check_site_shape, detach_iterable, is_nan
 
@@ -32,28 +32,37 @@ def _get_baseline_options(site):
     return options_tuple
 
 
-def _compute_downstream_costs(model_trace, guide_trace,  #
-                              non_reparam_nodes):
+# For each guide sample site that needs a downstream cost, in reverse topological order:
+# the children whose downstream costs are added to that of the site, the sites whose costs are
+# added individually, and, for non-reparameterized sites, the additional sites in the model.
+_DownstreamStructure = namedtuple("_DownstreamStructure", ["guide_nodes", "children", "missing_nodes",
+                                                           "model_children", "downstream_guide_cost_nodes"])
+
+
+def _compute_downstream_structure(model_trace, guide_trace, non_reparam_nodes):
+    """
+    Computes which cost terms make up the downstream cost of each guide sample
+    site. This only depends on the dependency structure of the traces, so the
+    result can be reused for later traces with the same structure.
+    """
     # recursively compute downstream cost nodes for all sample sites in model and guide
     # (even though ultimately just need for non-reparameterizable sample sites)
     # 1. downstream costs used for rao-blackwellization
     # 2. model observe sites (as well as terms that arise from the model and guide having different
     # dependency structures) are taken care of via 'children_in_model' below
-    topo_sort_guide_nodes = list(reversed(list(networkx.topological_sort(guide_trace))))
+    topo_sort_guide_nodes = list(reversed(guide_trace.topological_sort()))
     topo_sort_guide_nodes = [x for x in topo_sort_guide_nodes
                              if guide_trace.nodes[x]["type"] == "sample"]
     ordered_guide_nodes_dict = {n: i for i, n in enumerate(topo_sort_guide_nodes)}
 
     downstream_guide_cost_nodes = {}
-    downstream_costs = {}
-    stacks = get_iarange_stacks(model_trace)
+    children_included = {}
+    missing_nodes = {}
 
     for node in topo_sort_guide_nodes:
-        downstream_costs[node] = MultiFrameTensor((stacks[node],
-                                                   model_trace.nodes[node]['batch_log_pdf'] -
-                                                   guide_trace.nodes[node]['batch_log_pdf']))
         nodes_included_in_sum = set([node])
         downstream_guide_cost_nodes[node] = set([node])
+        children_included[node] = []
         # make more efficient by ordering children appropriately (higher children first)
         children = [(k, -ordered_guide_nodes_dict[k]) for k in guide_trace.successors(node)]
         sorted_children = sorted(children, key=itemgetter(1))
@@ -61,19 +70,16 @@ def _compute_downstream_costs(model_trace, guide_trace,  #
             child_cost_nodes = downstream_guide_cost_nodes[child]
             downstream_guide_cost_nodes[node].update(child_cost_nodes)
             if nodes_included_in_sum.isdisjoint(child_cost_nodes):  # avoid duplicates
-                downstream_costs[node].add(*downstream_costs[child].items())
+                children_included[node].append(child)
                 # XXX nodes_included_in_sum logic could be more fine-grained, possibly leading
                 # to speed-ups in case there are many duplicates
                 nodes_included_in_sum.update(child_cost_nodes)
-        missing_downstream_costs = downstream_guide_cost_nodes[node] - nodes_included_in_sum
         # include terms we missed because we had to avoid duplicates
-        for missing_node in missing_downstream_costs:
-            downstream_costs[node].add((stacks[missing_node],
-                                        model_trace.nodes[missing_node]['batch_log_pdf'] -
-                                        guide_trace.nodes[missing_node]['batch_log_pdf']))
+        missing_nodes[node] = list(downstream_guide_cost_nodes[node] - nodes_included_in_sum)
 
     # finish assembling complete downstream costs
     # (the above computation may be missing terms from model)
+    model_children = {}
     for site in non_reparam_nodes:
         children_in_model = set()
         for node in downstream_guide_cost_nodes[site]:
@@ -82,14 +88,51 @@ def _compute_downstream_costs(model_trace, guide_trace,  #
         children_in_model.difference_update(downstream_guide_cost_nodes[site])
         for child in children_in_model:
             assert (model_trace.nodes[child]["type"] == "sample")
+        model_children[site] = list(children_in_model)
+        downstream_guide_cost_nodes[site].update(children_in_model)
+
+    # only the costs of non-reparameterized sites and of the children they include are needed
+    needed = set()
+    frontier = list(non_reparam_nodes)
+    while frontier:
+        node = frontier.pop()
+        if node not in needed:
+            needed.add(node)
+            frontier.extend(children_included[node])
+    guide_nodes = [node for node in topo_sort_guide_nodes if node in needed]
+
+    return _DownstreamStructure(guide_nodes, children_included, missing_nodes, model_children,
+                                downstream_guide_cost_nodes)
+
+
+def _compute_downstream_costs(model_trace, guide_trace,  #
+                              non_reparam_nodes, stacks=None, structure=None):
+    if structure is None:
+        structure = _compute_downstream_structure(model_trace, guide_trace, non_reparam_nodes)
+    if stacks is None:
+        stacks = get_iarange_stacks(model_trace)
+
+    downstream_costs = {}
+    for node in structure.guide_nodes:
+        downstream_costs[node] = MultiFrameTensor((stacks[node],
+                                                   model_trace.nodes[node]['batch_log_pdf'] -
+                                                   guide_trace.nodes[node]['batch_log_pdf']))
+        for child in structure.children[node]:
+            downstream_costs[node].add(*downstream_costs[child].items())
+        for missing_node in structure.missing_nodes[node]:
+            downstream_costs[node].add((stacks[missing_node],
+                                        model_trace.nodes[missing_node]['batch_log_pdf'] -
+                                        guide_trace.nodes[missing_node]['batch_log_pdf']))
+
+    for site in non_reparam_nodes:
+        for child in structure.model_children[site]:
             downstream_costs[site].add((stacks[child],
                                         model_trace.nodes[child]['batch_log_pdf']))
-            downstream_guide_cost_nodes[site].update([child])
 
     for k in non_reparam_nodes:
         downstream_costs[k] = downstream_costs[k].sum_to(guide_trace.nodes[k]["cond_indep_stack"])
 
-    return downstream_costs, downstream_guide_cost_nodes
+    return downstream_costs, structure.downstream_guide_cost_nodes
 
 
 def _compute_elbo_reparam(model_trace, guide_trace, non_reparam_nodes):
@@ -183,6 +226,32 @@ class TraceGraph_ELBO(ELBO):
         Andriy Mnih, Karol Gregor
     """
 
+    def __init__(self,
+                 num_particles=1,
+                 max_iarange_nesting=float('inf'),
+                 freeze_structure=False):
+        super(TraceGraph_ELBO, self).__init__(num_particles=num_particles,
+                                              max_iarange_nesting=max_iarange_nesting,
+                                              freeze_structure=freeze_structure)
+        self._downstream_structure = None  # (fingerprint, structure) of the most recent traces
+
+    def _get_downstream_structure(self, model_trace, guide_trace, non_reparam_nodes):
+        """
+        Returns the structure of the downstream costs of a pair of pruned traces,
+        reusing the one computed on an earlier step if the traces have the same
+        sample sites, shapes and ``cond_indep_stack`` s, and hence the same
+        dependency graphs.
+        """
+        if self._structure is not None:
+            signature = self._structure.signature  # already matched against these traces
+        else:
+            signature = _trace_signature(model_trace), _trace_signature(guide_trace)
+        fingerprint = signature, frozenset(non_reparam_nodes)
+        if self._downstream_structure is None or self._downstream_structure[0] != fingerprint:
+            structure = _compute_downstream_structure(model_trace, guide_trace, non_reparam_nodes)
+            self._downstream_structure = fingerprint, structure
+        return self._downstream_structure[1]
+
     def _get_traces(self, model, guide, *args, **kwargs):
         """
         runs the guide and runs the model against the guide with
@@ -194,10 +263,14 @@ class TraceGraph_ELBO(ELBO):
                                         graph_type="dense").get_trace(*args, **kwargs)
             model_trace = poutine.trace(poutine.replay(model, guide_trace),
                                         graph_type="dense").get_trace(*args, **kwargs)
-            if infer.is_validation_enabled():
+            structure = self._get_structure(model_trace, guide_trace)
+            if infer.is_validation_enabled() and not (structure is not None and structure.validated):
                 check_model_guide_match(model_trace, guide_trace)
-            guide_trace = prune_subsample_sites(guide_trace)
-            model_trace = prune_subsample_sites(model_trace)
+            if structure is None:
+                guide_trace = prune_subsample_sites(guide_trace)
+                model_trace = prune_subsample_sites(model_trace)
+            else:
+                structure.prune(model_trace, guide_trace)
 
             weight = 1.0 / self.num_particles
             yield weight, model_trace, guide_trace
@@ -249,13 +322,16 @@ class TraceGraph_ELBO(ELBO):
         # and score function terms (if present) so that they are available below
         model_trace.compute_batch_log_pdf()
         guide_trace.compute_score_parts()
-        if infer.is_validation_enabled():
+        structure = self._structure
+        if infer.is_validation_enabled() and not (structure is not None and structure.validated):
             for site in model_trace.nodes.values():
                 if site["type"] == "sample":
                     check_site_shape(site, self.max_iarange_nesting)
             for site in guide_trace.nodes.values():
                 if site["type"] == "sample":
                     check_site_shape(site, self.max_iarange_nesting)
+            if structure is not None:
+                structure.validated = True
 
         # compute elbo for reparameterized nodes
         non_reparam_nodes = set(guide_trace.nonreparam_stochastic_nodes)
@@ -264,7 +340,9 @@ class TraceGraph_ELBO(ELBO):
         # the following computations are only necessary if we have non-reparameterizable nodes
         baseline_loss = 0.0
         if non_reparam_nodes:
-            downstream_costs, _ = _compute_downstream_costs(model_trace, guide_trace, non_reparam_nodes)
+            structure = self._get_downstream_structure(model_trace, guide_trace, non_reparam_nodes)
+            downstream_costs, _ = _compute_downstream_costs(model_trace, guide_trace, non_reparam_nodes,
+                                                            self._get_iarange_stacks(model_trace), structure)
             surrogate_elbo_term, baseline_loss = _compute_elbo_non_reparam(guide_trace,
                                                                            non_reparam_nodes, downstream_costs)
             surrogate_elbo += surrogate_elbo_term
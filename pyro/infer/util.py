@@ -2,6 +2,8 @@ from __future__ import absolute_import, division, print_function
 
 import math
 import numbers
+import string
+from collections import OrderedDict, defaultdict
 
 import torch
 
@@ -76,6 +78,53 @@ def get_iarange_stacks(trace):
             if node["type"] == "sample" and not site_is_subsample(node)}
 
 
+def _trace_signature(trace):
+    return tuple((name, site["is_observed"], getattr(site["value"], "shape", None), site["cond_indep_stack"])
+                 for name, site in trace.nodes.items() if site["type"] == "sample")
+
+
+class TraceStructure(object):
+    """
+    Structural metadata of a pair of model and guide traces, as used by
+    :class:`~pyro.infer.elbo.ELBO` implementations with
+    ``freeze_structure=True``.
+
+    The structure is captured from unpruned traces. On later steps,
+    :meth:`matches` compares a cheap signature of the new traces (sample site
+    names, shapes and ``cond_indep_stack`` s) against the captured one, and if
+    they agree the precomputed subsample sites and iarange stacks are reused.
+    Once the validation checks have passed for traces with this structure,
+    ``validated`` is set and the checks are skipped.
+
+    :param pyro.poutine.Trace model_trace: an unpruned model trace
+    :param pyro.poutine.Trace guide_trace: an unpruned guide trace
+    """
+    def __init__(self, model_trace, guide_trace):
+        self.signature = _trace_signature(model_trace), _trace_signature(guide_trace)
+        self.model_subsample_sites = [name for name, site in model_trace.nodes.items() if site_is_subsample(site)]
+        self.guide_subsample_sites = [name for name, site in guide_trace.nodes.items() if site_is_subsample(site)]
+        self.iarange_stacks = get_iarange_stacks(model_trace)
+        self.validated = False
+
+    def matches(self, model_trace, guide_trace):
+        """
+        :returns: whether the traces have the structure captured in this object
+        :rtype: bool
+        """
+        return self.signature == (_trace_signature(model_trace), _trace_signature(guide_trace))
+
+    def prune(self, model_trace, guide_trace):
+        """
+        Removes subsample sites from a pair of traces in-place. Unlike
+        :func:`~pyro.poutine.util.prune_subsample_sites`, this does not copy the
+        traces, so they should not be shared with other code.
+        """
+        for name in self.model_subsample_sites:
+            model_trace.remove_node(name)
+        for name in self.guide_subsample_sites:
+            guide_trace.remove_node(name)
+
+
 class MultiFrameTensor(dict):
     """
     A container for sums of Tensors among different :class:`iarange` contexts.
@@ -132,6 +181,101 @@ def _dict_iadd(items, key, value):
         items[key] = value
 
 
+def _nonsingleton_dims(x):
+    return tuple(dim for dim in range(-x.dim(), 0) if x.shape[dim] != 1)
+
+
+def sum_product(tensors, cache=None):
+    """
+    Computes the sum over all elements of the broadcasted product of
+    ``tensors``, without constructing the broadcasted product.
+
+    Tensor dimensions are aligned from the right as in broadcasting. Each
+    dimension is summed out as soon as the tensors that share it have been
+    multiplied together, choosing at each step the dimension whose
+    contraction by :func:`torch.einsum` is smallest (contractions over more
+    than 26 dims fall back to a broadcasted product). For tensors with tree or
+    chain structure, such as the factors of a hidden Markov model, the cost
+    is thus exponential in the treewidth rather than the number of dims.
+
+    :param list tensors: a list of :class:`~torch.Tensor` s or numbers
+    :param dict cache: an optional dict in which to memoize intermediate
+        contractions, keyed by the ids of their operands. Sharing a cache
+        between calls whose tensors overlap avoids recomputing common terms;
+        the cache must not outlive the tensors.
+    :returns: the sum of the product
+    :rtype: torch.Tensor or number
+    """
+    if cache is None:
+        cache = {}
+    result = 1
+    operands = []
+    for x in tensors:
+        if not torch.is_tensor(x):
+            result = result * x
+            continue
+        key = id(x)
+        if key not in cache:
+            dims = _nonsingleton_dims(x)
+            cache[key] = x.reshape(tuple(x.shape[dim] for dim in dims)), dims
+        operands.append(cache[key])
+    sizes = OrderedDict((dim, x.shape[i]) for x, dims in operands for i, dim in enumerate(dims))
+
+    # If some operand has every dim, nothing can be summed out before the full product.
+    if any(len(dims) == len(sizes) for _, dims in operands):
+        product = 1
+        for x in tensors:
+            product = product * x
+        return product.sum()
+
+    while sizes:
+        # Greedily choose the dim whose contraction involves the fewest elements.
+        best_cost, best_dim = None, None
+        for dim in sizes:
+            group_dims = set(d for _, dims in operands if dim in dims for d in dims)
+            cost = 1
+            for d in group_dims:
+                cost *= sizes[d]
+            if best_cost is None or cost < best_cost:
+                best_cost, best_dim = cost, dim
+        group = [op for op in operands if best_dim in op[1]]
+        operands = [op for op in operands if best_dim not in op[1]]
+
+        # Sum out every dim that appears only in this group.
+        remaining_dims = set(d for _, dims in operands for d in dims)
+        group_dims = set(d for _, dims in group for d in dims)
+        out_dims = tuple(sorted(group_dims & remaining_dims))
+        for dim in group_dims - remaining_dims:
+            del sizes[dim]
+        key = (out_dims,) + tuple(id(x) for x, _ in group)
+        if key not in cache:
+            cache[key] = _contract(group, out_dims), out_dims
+        operands.append(cache[key])
+
+    for x, _ in operands:
+        result = result * x
+    return result
+
+
+def _contract(group, out_dims):
+    group_dims = sorted(set(d for _, dims in group for d in dims))
+    if len(group_dims) <= len(string.ascii_lowercase):
+        # torch.einsum only accepts the symbols a-z, so each contraction names just the dims it involves
+        symbols = dict(zip(group_dims, string.ascii_lowercase))
+        equation = "{}->{}".format(",".join("".join(symbols[d] for d in dims) for _, dims in group),
+                                   "".join(symbols[d] for d in out_dims))
+        return torch.einsum(equation, [x for x, _ in group])
+
+    # too many dims to name, so fall back to the broadcasted product
+    product = 1
+    for x, dims in group:
+        product = product * x.reshape(tuple(x.shape[dims.index(d)] if d in dims else 1 for d in group_dims))
+    for i in reversed(range(len(group_dims))):
+        if group_dims[i] not in out_dims:
+            product = product.sum(i)
+    return product
+
+
 class MultiFrameDice(object):
     """
     An implementation of the DiCE operator compatible with Pyro features.
@@ -145,6 +289,10 @@ class MultiFrameDice(object):
     variables outside of an :class:`~pyro.iarange` can never depend on
     variables inside that :class:`~pyro.iarange`.
 
+    The DiCE factors of the guide sites are kept separate, so that
+    :meth:`compute_expectation` can sum out parallel enumerated dims by
+    variable elimination rather than broadcasting over all of them at once.
+
     Refereces:
     [1] Jakob Foerster, Greg Farquhar, Maruan Al-Shedivat, Tim Rocktaeschel,
         Eric P. Xing, Shimon Whiteson (2018)
@@ -153,7 +301,7 @@ class MultiFrameDice(object):
     """
     def __init__(self, guide_trace):
         log_denom = {}  # avoids double-counting when sequentially enumerating
-        log_probs = {}  # accounts for upstream probabilties
+        log_factors = defaultdict(list)  # accounts for upstream probabilties
 
         for site in guide_trace.nodes.values():
             if site["type"] != "sample":
@@ -168,10 +316,10 @@ class MultiFrameDice(object):
                     _dict_iadd(log_denom, context, math.log(site["infer"]["_enum_total"]))
             else:  # site was monte carlo sampled
                 log_prob = log_prob - log_prob.detach()
-            _dict_iadd(log_probs, context, log_prob)
+            log_factors[context].append(log_prob)
 
         self.log_denom = log_denom
-        self.log_probs = log_probs
+        self.log_factors = log_factors
         self.cache = {}
 
     def in_context(self, cond_indep_stack):
@@ -186,10 +334,56 @@ class MultiFrameDice(object):
         for context, term in self.log_denom.items():
             if not context <= target_context:  # not downstream
                 log_prob = log_prob - term  # term = log(# times this context is counted)
-        for context, term in self.log_probs.items():
+        for context, terms in self.log_factors.items():
             if context <= target_context:  # upstream
-                log_prob = log_prob + term  # term = log(dice weight of this context)
+                for term in terms:
+                    log_prob = log_prob + term  # term = log(dice weight of a site in this context)
         result = 1 if is_identically_zero(log_prob) else log_prob.exp()
 
         self.cache[target_context] = result
         return result
+
+    def compute_expectation(self, costs):
+        """
+        Returns the sum of DiCE-weighted costs, i.e.
+        ``sum((self.in_context(stack) * cost).sum() for stack, cost in costs)``,
+        computed with :func:`sum_product` so that the DiCE factors of
+        different enumerated sites are never broadcast together.
+
+        :param costs: an iterable of ``(cond_indep_stack, cost)`` pairs, where
+            each cost is a :class:`~torch.Tensor`
+        :rtype: torch.Tensor
+        """
+        # Costs in the same context share a contraction with any cost whose dims include theirs.
+        # Costs are only broadcast along enumerated dims, over which the DiCE factors are
+        # normalized; broadcasting along an iarange dim would count the cost once per element.
+        costs = [(frozenset(f for f in cond_indep_stack if f.vectorized), _nonsingleton_dims(cost), cost)
+                 for cond_indep_stack, cost in costs]
+        costs.sort(key=lambda item: -len(item[1]))
+        grouped_costs = OrderedDict()
+        context_keys = defaultdict(list)
+        for context, dims, cost in costs:
+            iarange_dims = set(f.dim for f in context)
+            for key in context_keys[context]:
+                if set(dims) <= set(key[1]) and set(key[1]) & iarange_dims <= set(dims):
+                    break
+            else:
+                key = context, dims
+                context_keys[context].append(key)
+            _dict_iadd(grouped_costs, key, cost)
+
+        factors = {}
+        cache = {}
+        expected_cost = 0
+        for (context, _), cost in grouped_costs.items():
+            if context not in factors:
+                log_scale = 0
+                for other, term in self.log_denom.items():
+                    if not other <= context:  # not downstream
+                        log_scale = log_scale - term  # term = log(# times this context is counted)
+                factors[context] = [math.exp(log_scale)] + [term.exp()
+                                                            for other, terms in self.log_factors.items()
+                                                            if other <= context  # upstream
+                                                            for term in terms]
+            expected_cost = expected_cost + sum_product(factors[context] + [cost], cache)
+        return expected_cost
@@ -1,69 +1,104 @@
 from __future__ import absolute_import, division, print_function
 
+import torch
 from torch.autograd import grad
 
 
-def velocity_verlet(z, r, potential_fn, step_size, num_steps=1):
+def velocity_verlet(z, r, potential_fn, step_size, num_steps=1, z_grads=None, inverse_mass_matrix=None):
     """
     Second order symplectic integrator that uses the velocity verlet algorithm.
 
-    :param dict z: dictionary of sample site names and their current values
-        (type :class:`~torch.Tensor`).
-    :param dict r: dictionary of sample site names and corresponding momenta
-        (type :class:`~torch.Tensor`).
+    :param z: dictionary of sample site names and their current values
+        (type :class:`~torch.Tensor`), or a single flat :class:`~torch.Tensor`
+        holding the values of all sites.
+    :param r: dictionary of sample site names and corresponding momenta
+        (type :class:`~torch.Tensor`), or a single flat :class:`~torch.Tensor`
+        of the same shape as ``z``.
     :param callable potential_fn: function that returns potential energy given z
         for each sample site. The negative gradient of the function with respect
         to ``z`` determines the rate of change of the corresponding sites'
-        momenta ``r``.
+        momenta ``r``. The function may also return a batch of potential energies
+        of independent chains, in which case the gradient of their sum is used.
     :param float step_size: step size for each time step iteration.
     :param int num_steps: number of discrete time steps over which to integrate.
-    :return tuple (z_next, r_next): final position and momenta, having same types as (z, r).
+    :param z_grads: optional gradients of potential energy at current ``z``.
+    :param torch.Tensor inverse_mass_matrix: optional inverse mass matrix, either
+        a vector holding its diagonal or a square matrix, which maps momenta to
+        velocities. Only supported if ``z`` is a single flat tensor. Defaults to
+        the identity.
+    :return tuple (z_next, r_next, z_grads, potential_energy): final position and momenta,
+        having same types as (z, r), together with the potential energy and its
+        gradient w.r.t. ``z_next``.
     """
-    z_next = z.copy()
-    r_next = r.copy()
-    grads, _ = _grad(potential_fn, z_next)
+    z_next = z
+    r_next = r
+    grads = potential_grad(potential_fn, z_next)[0] if z_grads is None else z_grads
 
     for _ in range(num_steps):
-        for site_name in z_next:
-            # r(n+1/2)
-            r_next[site_name] = r_next[site_name] + 0.5 * step_size * (-grads[site_name])
-            # z(n+1)
-            z_next[site_name] = z_next[site_name] + step_size * r_next[site_name]
-        grads, _ = _grad(potential_fn, z_next)
-        for site_name in r_next:
-            # r(n+1)
-            r_next[site_name] = r_next[site_name] + 0.5 * step_size * (-grads[site_name])
-    return z_next, r_next
-
-
-def single_step_velocity_verlet(z, r, potential_fn, step_size, z_grads=None):
+        # r(n+1/2)
+        r_next = _step(r_next, grads, -0.5 * step_size)
+        # z(n+1)
+        z_next = _step(z_next, _velocity(r_next, inverse_mass_matrix), step_size)
+        grads, potential_energy = potential_grad(potential_fn, z_next)
+        # r(n+1)
+        r_next = _step(r_next, grads, -0.5 * step_size)
+    return z_next, r_next, grads, potential_energy
+
+
+def single_step_velocity_verlet(z, r, potential_fn, step_size, z_grads=None, inverse_mass_matrix=None):
     """
     A special case of ``velocity_verlet`` integrator where ``num_steps=1``. It is particular
     helpful for NUTS kernel.
 
-    :param torch.Tensor z_grads: optional gradients of potential energy at current ``z``.
+    :param z_grads: optional gradients of potential energy at current ``z``.
+    :param torch.Tensor inverse_mass_matrix: optional inverse mass matrix.
     :return tuple (z_next, r_next, z_grads, potential_energy): next position and momenta,
         together with the potential energy and its gradient w.r.t. ``z_next``.
     """
-    z_next = z.copy()
-    r_next = r.copy()
-    grads = _grad(potential_fn, z_next)[0] if z_grads is None else z_grads
-
-    for site_name in z_next:
-        r_next[site_name] = r_next[site_name] + 0.5 * step_size * (-grads[site_name])
-        z_next[site_name] = z_next[site_name] + step_size * r_next[site_name]
-    grads, potential_energy = _grad(potential_fn, z_next)
-    for site_name in r_next:
-        r_next[site_name] = r_next[site_name] + 0.5 * step_size * (-grads[site_name])
+    grads = potential_grad(potential_fn, z)[0] if z_grads is None else z_grads
+
+    r_next = _step(r, grads, -0.5 * step_size)
+    z_next = _step(z, _velocity(r_next, inverse_mass_matrix), step_size)
+    grads, potential_energy = potential_grad(potential_fn, z_next)
+    r_next = _step(r_next, grads, -0.5 * step_size)
     return z_next, r_next, grads, potential_energy
 
 
-def _grad(potential_fn, z):
+def _step(x, dx, scale):
+    if isinstance(x, torch.Tensor):
+        return x + scale * dx
+    return {site_name: x[site_name] + scale * dx[site_name] for site_name in x}
+
+
+def _velocity(r, inverse_mass_matrix):
+    if inverse_mass_matrix is None:
+        return r
+    if inverse_mass_matrix.dim() == 1:
+        return inverse_mass_matrix * r
+    return r.matmul(inverse_mass_matrix)
+
+
+def potential_grad(potential_fn, z):
+    """
+    Gradient of potential energy w.r.t. ``z``.
+
+    :param callable potential_fn: function that returns potential energy given z.
+    :param z: dictionary of sample site names and their current values, or a
+        single flat :class:`~torch.Tensor`.
+    :return tuple (z_grads, potential_energy): gradients, having same type as ``z``,
+        and the (detached) potential energy at ``z``.
+    """
+    if isinstance(z, torch.Tensor):
+        z.requires_grad = True
+        potential_energy = potential_fn(z)
+        grads, = grad(potential_energy.sum(), [z])
+        z.requires_grad = False
+        return grads, potential_energy.detach()
     z_keys, z_nodes = zip(*z.items())
     for node in z_nodes:
         node.requires_grad = True
     potential_energy = potential_fn(z)
-    grads = grad(potential_energy, z_nodes)
+    grads = grad(potential_energy.sum(), z_nodes)
     for node in z_nodes:
         node.requires_grad = False
-    return dict(zip(z_keys, grads)), potential_energy
+    return dict(zip(z_keys, grads)), potential_energy.detach()
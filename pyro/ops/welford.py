@@ -0,0 +1,67 @@
+from __future__ import absolute_import, division, print_function
+
+import torch
+
+
+class WelfordCovariance(object):
+    """
+    Welford's online scheme to estimate the variance (or covariance) of a stream
+    of samples, in a numerically stable way and without storing the samples
+    (see :math:`[1]`). It is used to adapt the mass matrix of HMC and NUTS during
+    warmup.
+
+    References
+
+    [1] `Note on a method for calculating corrected sums of squares and products`,
+    B. P. Welford
+
+    :param bool diagonal: Whether to estimate only the variance of each
+        coordinate, rather than the full covariance matrix.
+    """
+
+    def __init__(self, diagonal=True):
+        self.diagonal = diagonal
+        self.reset()
+
+    def reset(self):
+        """
+        Forgets all samples seen so far.
+        """
+        self._mean = 0.
+        self._m2 = 0.  # sum of squared (or outer products of) deviations from the mean
+        self.n_samples = 0
+
+    def update(self, sample):
+        """
+        Updates the estimate with a new sample.
+
+        :param torch.Tensor sample: A 1-dimensional sample.
+        """
+        self.n_samples += 1
+        delta_pre = sample - self._mean
+        self._mean = self._mean + delta_pre / self.n_samples
+        delta_post = sample - self._mean
+        if self.diagonal:
+            self._m2 = self._m2 + delta_pre * delta_post
+        else:
+            self._m2 = self._m2 + torch.ger(delta_post, delta_pre)
+
+    def get_covariance(self, regularize=True):
+        """
+        Returns the (co)variance of the samples seen so far.
+
+        :param bool regularize: Whether to shrink the estimate towards a small
+            multiple of the identity, as in Stan, which keeps it well conditioned
+            when there are few samples.
+        """
+        if self.n_samples < 2:
+            raise RuntimeError("at least 2 samples are needed to estimate the covariance")
+        cov = self._m2 / (self.n_samples - 1)
+        if regularize:
+            scaled_cov = (self.n_samples / (self.n_samples + 5.)) * cov
+            shrinkage = 1e-3 * (5. / (self.n_samples + 5.))
+            if self.diagonal:
+                cov = scaled_cov + shrinkage
+            else:
+                cov = scaled_cov + shrinkage * torch.eye(cov.size(0))
+        return cov
@@ -4,6 +4,7 @@ import torch
 
 from .clipped_adam import ClippedAdam as pt_ClippedAdam
 from .adagrad_rmsprop import AdagradRMSProp as pt_AdagradRMSProp
+from .checkpoint import AsyncCheckpointer  # noqa: F401
 from .optim import PyroOptim
 
 
@@ -0,0 +1,105 @@
+from __future__ import absolute_import, division, print_function
+
+import copy
+import threading
+
+import torch
+from six.moves.queue import Queue
+
+import pyro
+
+
+class AsyncCheckpointer(object):
+    """
+    Saves checkpoints of the ParamStore and of a :class:`~pyro.optim.optim.PyroOptim`
+    on a background thread, so that training can continue while the checkpoint
+    is written to disk.
+
+    Calling :meth:`save` snapshots the current state by cloning it in memory,
+    then queues the snapshot to be written. If ``max_pending`` snapshots are
+    already waiting, :meth:`save` blocks until one has been written, which
+    bounds the memory used by snapshots. Files are written in the formats of
+    ``ParamStoreDict.save`` and ``PyroOptim.save``, so they can be loaded with
+    the corresponding ``load`` methods.
+
+    Example::
+
+        checkpointer = AsyncCheckpointer(optim)
+        for step in range(num_steps):
+            svi.step(data)
+            if step % 100 == 0:
+                checkpointer.save("params.pt", "optim.pt")
+        checkpointer.close()
+
+    :param optim: an optional PyroOptim whose state is saved along with the params
+    :type optim: pyro.optim.optim.PyroOptim
+    :param int max_pending: the maximum number of snapshots waiting to be written
+    """
+    def __init__(self, optim=None, max_pending=1):
+        self.optim = optim
+        self._queue = Queue(maxsize=max_pending)
+        self._error = None
+        self._thread = threading.Thread(target=self._write_snapshots)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def save(self, param_filename, optim_filename=None):
+        """
+        :param param_filename: file name to save the ParamStore state to
+        :type param_filename: str
+        :param optim_filename: file name to save the optimizer state to
+        :type optim_filename: str
+
+        Snapshot the current state and queue it to be written to disk
+        """
+        self._raise_error()
+        if optim_filename is not None and self.optim is None:
+            raise ValueError("cannot save optimizer state without an optimizer")
+        state = pyro.get_param_store().get_state()
+        params = {}
+        for name, param in state["params"].items():
+            params[name] = param.detach().clone().requires_grad_(param.requires_grad)
+        snapshots = [(param_filename, {"params": params, "constraints": dict(state["constraints"])})]
+        if optim_filename is not None:
+            snapshots.append((optim_filename, copy.deepcopy(self.optim.get_state())))
+        self._queue.put(snapshots)
+
+    def wait(self):
+        """
+        Block until all queued snapshots have been written to disk
+        """
+        self._queue.join()
+        self._raise_error()
+
+    def close(self):
+        """
+        Write all queued snapshots and stop the background thread
+        """
+        self._queue.put(None)
+        self._thread.join()
+        self._raise_error()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _write_snapshots(self):
+        while True:
+            snapshots = self._queue.get()
+            try:
+                if snapshots is None:
+                    return
+                for filename, state in snapshots:
+                    with open(filename, "wb") as output_file:
+                        torch.save(state, output_file)
+            except Exception as e:
+                self._error = e
+            finally:
+                self._queue.task_done()
+
+    def _raise_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
@@ -18,7 +18,10 @@ class ClippedAdam(Optimizer):
     :param lrd: rate at which learning rate decays (default: 1.0)
 
     Small modification to the Adam algorithm implemented in torch.optim.Adam
-    to include gradient clipping and learning rate decay.
+    to include gradient clipping and learning rate decay. The learning rate of
+    each parameter is ``group['lr']`` times a decay factor that is multiplied
+    by ``lrd`` every time that parameter is stepped, and is kept in its state
+    as ``state['lr_decay']``.
 
     Reference
 
@@ -43,17 +46,19 @@ class ClippedAdam(Optimizer):
             loss = closure()
 
         for group in self.param_groups:
-            group['lr'] *= group['lrd']
-
             for p in group['params']:
+                state = self.state[p]
+
+                # Decay the learning rate of each param every time it is stepped
+                state['lr_decay'] = state.get('lr_decay', 1.0) * group['lrd']
+
                 if p.grad is None:
                     continue
                 grad = p.grad.data
                 grad.clamp_(-group['clip_norm'], group['clip_norm'])
-                state = self.state[p]
 
                 # State initialization
-                if len(state) == 0:
+                if 'step' not in state:
                     state['step'] = 0
                     # Exponential moving average of gradient values
                     state['exp_avg'] = grad.new().resize_as_(grad).zero_()
@@ -76,7 +81,7 @@ class ClippedAdam(Optimizer):
 
                 bias_correction1 = 1 - beta1 ** state['step']
                 bias_correction2 = 1 - beta2 ** state['step']
-                step_size = group['lr'] * math.sqrt(bias_correction2) / bias_correction1
+                step_size = group['lr'] * state['lr_decay'] * math.sqrt(bias_correction2) / bias_correction1
 
                 p.data.addcdiv_(-step_size, exp_avg, denom)
 
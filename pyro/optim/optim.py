@@ -1,15 +1,24 @@
 from __future__ import absolute_import, division, print_function
 
+import os
+import shutil
+
 import torch
 
 import pyro
 from pyro.params import module_from_param_with_module_name, user_param_name
+from pyro.params.param_store import _MANIFEST, _new_checkpoint_files, _replace
 
 
 class PyroOptim(object):
     """
     A wrapper for torch.optim.Optimizer objects that helps managing with dynamically generated parameters
 
+    All parameters are optimized by a single optimizer object. Parameters that
+    are first seen together and share the same learning arguments form one
+    param group, which is added to the optimizer with ``add_param_group``. The
+    state of each parameter is still saved and loaded by parameter name.
+
     :param optim_constructor: a torch.optim.Optimizer
     :param optim_args: a dictionary of learning arguments for the optimizer or a callable that returns
         such dictionaries
@@ -24,48 +33,120 @@ class PyroOptim(object):
         # hold our args to be called/used
         self.pt_optim_args = optim_args
 
-        # holds the torch optimizer objects
-        self.optim_objs = {}
+        # holds the torch optimizer object, created when the first params are seen
+        self.optim = None
+
+        # maps each param to the param group of self.optim that contains it
+        self.param_groups = {}
 
         # any optimizer state that's waiting to be consumed (because that parameter hasn't been seen before)
         self._state_waiting_to_be_consumed = {}
 
+        # files of optimizer state waiting to be consumed, which are only loaded once their parameter is seen
+        self._state_files_waiting_to_be_consumed = {}
+
     def __call__(self, params,  *args, **kwargs):
         """
         :param params: a list of parameters
         :type params: an iterable of strings
 
         Do an optimization step for each param in params. If a given param has never been seen before,
-        initialize an optimizer for it.
+        add it to the optimizer.
         """
-
+        params = set(params)
+        new_params = [p for p in params if p not in self.param_groups]
+        if new_params:
+            self._add_params(new_params)
+        if not params:
+            return
+
+        # the optimizer updates the params through .data, which does not bump their versions
+        pyro.get_param_store().mark_params_modified(params)
+
+        if len(params) == len(self.param_groups):
+            # every param is being stepped, which is the common case
+            self.optim.step(*args, **kwargs)
+            return
+
+        # step only the given params, by temporarily restricting the param groups
+        param_groups = self.optim.param_groups
+        restricted = []
+        for group in param_groups:
+            active = [p for p in group["params"] if p in params]
+            if len(active) < len(group["params"]):
+                restricted.append((group, group["params"]))
+                group["params"] = active
+        self.optim.param_groups = [group for group in param_groups if group["params"]]
+        try:
+            self.optim.step(*args, **kwargs)
+        finally:
+            self.optim.param_groups = param_groups
+            for group, group_params in restricted:
+                group["params"] = group_params
+
+    def _add_params(self, params):
+        # params with waiting state get a group of their own, restored from that state
+        groups = []
         for p in params:
-            # if we have not seen this param before, we instantiate and optim object to deal with it
-            if p not in self.optim_objs:
-                # get our constructor arguments
-                def_optim_dict = self._get_optim_args(p)
-                # create a single optim object for that param
-                self.optim_objs[p] = self.pt_optim_constructor([p], **def_optim_dict)
-
-                # set state from _state_waiting_to_be_consumed if present
-                param_name = pyro.get_param_store().param_name(p)
-                if param_name in self._state_waiting_to_be_consumed:
-                    state = self._state_waiting_to_be_consumed.pop(param_name)
-                    self.optim_objs[p].load_state_dict(state)
-
-            # actually perform the step for the optim object
-            self.optim_objs[p].step(*args, **kwargs)
+            param_name = pyro.get_param_store().param_name(p)
+            if param_name in self._state_files_waiting_to_be_consumed:
+                filename = self._state_files_waiting_to_be_consumed.pop(param_name)
+                self._state_waiting_to_be_consumed[param_name] = torch.load(filename)
+            if param_name in self._state_waiting_to_be_consumed:
+                state = self._state_waiting_to_be_consumed.pop(param_name)
+                param_optim = self.pt_optim_constructor([p], **self._get_optim_args(p))
+                param_optim.load_state_dict(state)
+                self._add_param_group(param_optim.param_groups[0], param_optim.state[p])
+                continue
+            # get our constructor arguments
+            def_optim_dict = self._get_optim_args(p)
+            for optim_dict, group_params in groups:
+                if optim_dict == def_optim_dict:
+                    group_params.append(p)
+                    break
+            else:
+                groups.append((def_optim_dict, [p]))
+
+        for optim_dict, group_params in groups:
+            group = dict(optim_dict)
+            group["params"] = group_params
+            self._add_param_group(group)
+
+    def _add_param_group(self, group, state=None):
+        optim_args = {k: v for k, v in group.items() if k != "params"}
+        if self.optim is None:
+            self.optim = self.pt_optim_constructor(group["params"], **optim_args)
+            group = self.optim.param_groups[0]
+        else:
+            # some optimizers, e.g. Adagrad, initialize the state of their params in __init__ rather
+            # than in step, so the state of the new params is taken from an optimizer built for them
+            group_optim = self.pt_optim_constructor(group["params"], **optim_args)
+            self.optim.add_param_group(group)
+            group = self.optim.param_groups[-1]
+            for p in group["params"]:
+                if group_optim.state.get(p):
+                    self.optim.state[p] = group_optim.state[p]
+        for p in group["params"]:
+            self.param_groups[p] = group
+        if state is not None:
+            self.optim.state[group["params"][0]] = state
 
     def get_state(self):
         """
         Get state associated with all the optimizers in the form of a dictionary with
         key-value pairs (parameter name, optim state dicts)
         """
-        state_dict = {}
-        for param in self.optim_objs:
-            param_name = pyro.get_param_store().param_name(param)
-            state_dict[param_name] = self.optim_objs[param].state_dict()
-        return state_dict
+        return {pyro.get_param_store().param_name(param): self._get_param_state(param)
+                for param in self.param_groups}
+
+    def _get_param_state(self, param):
+        # pack the state of the param as if it had an optimizer of its own
+        group = self.param_groups[param]
+        param_optim = self.pt_optim_constructor([param], **self._get_optim_args(param))
+        param_optim.param_groups[0].update((k, v) for k, v in group.items() if k != "params")
+        if param in self.optim.state:
+            param_optim.state[param] = self.optim.state[param]
+        return param_optim.state_dict()
 
     def set_state(self, state_dict):
         """
@@ -73,6 +154,7 @@ class PyroOptim(object):
         from a previous call to get_state()
         """
         self._state_waiting_to_be_consumed = state_dict
+        self._state_files_waiting_to_be_consumed = {}
 
     def save(self, filename):
         """
@@ -95,6 +177,57 @@ class PyroOptim(object):
             state = torch.load(input_file)
         self.set_state(state)
 
+    def save_checkpoint(self, dirname):
+        """
+        :param dirname: directory to save to
+        :type dirname: str
+
+        Save optimizer state to a checkpoint directory, with one file per parameter and a manifest.
+        This includes the state of parameters that has been loaded but not yet consumed.
+        """
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        manifest_path = os.path.join(dirname, _MANIFEST)
+        old_files = set()
+        if os.path.exists(manifest_path):
+            old_files = set(torch.load(manifest_path).values())
+
+        # write to new files, since pending state may still be read from the old ones
+        files = {}
+        new_files = _new_checkpoint_files(dirname, "state_{}.pt")
+        for param in self.param_groups:
+            files[pyro.get_param_store().param_name(param)] = filename = next(new_files)
+            torch.save(self._get_param_state(param), os.path.join(dirname, filename))
+        for param_name, state in self._state_waiting_to_be_consumed.items():
+            files[param_name] = filename = next(new_files)
+            torch.save(state, os.path.join(dirname, filename))
+        for param_name, path in self._state_files_waiting_to_be_consumed.items():
+            if os.path.abspath(os.path.dirname(path)) == os.path.abspath(dirname):
+                files[param_name] = os.path.basename(path)
+            else:
+                files[param_name] = filename = next(new_files)
+                shutil.copyfile(path, os.path.join(dirname, filename))
+
+        # replace the manifest before removing stale files, so the checkpoint is always complete
+        tmp_path = manifest_path + ".tmp"
+        torch.save(files, tmp_path)
+        _replace(tmp_path, manifest_path)
+        for filename in old_files - set(files.values()):
+            os.remove(os.path.join(dirname, filename))
+
+    def load_checkpoint(self, dirname):
+        """
+        :param dirname: directory to load from
+        :type dirname: str
+
+        Load optimizer state from a checkpoint directory written by `save_checkpoint`. The state of each
+        parameter is only read from disk once that parameter is seen.
+        """
+        files = torch.load(os.path.join(dirname, _MANIFEST))
+        self._state_waiting_to_be_consumed = {}
+        self._state_files_waiting_to_be_consumed = {param_name: os.path.join(dirname, filename)
+                                                    for param_name, filename in files.items()}
+
     # helper to fetch the optim args if callable (only used internally)
     def _get_optim_args(self, param):
         # if we were passed a fct, we call fct with param info
@@ -1,7 +1,9 @@
 from __future__ import absolute_import, division, print_function
 
+import os
 import weakref
 
+import numpy as np
 import torch
 from torch.distributions import constraints, transform_to
 
@@ -26,7 +28,8 @@ class ParamStoreDict(object):
       Pyro is prepended with the Pyro name of the module. so nothing prevents the user from having
       two different modules each of which contains a parameter named `weight`. by contrast, a user
       can only have one top-level parameter named `weight` (outside of any module).
-    - parameters can be saved and loaded from disk using `save` and `load`.
+    - parameters can be saved and loaded from disk using `save` and `load`, or using
+      `save_checkpoint` and `load_checkpoint`, which store one file per parameter.
     """
 
     def __init__(self):
@@ -37,6 +40,10 @@ class ParamStoreDict(object):
         self._param_to_name = {}  # dictionary from unconstrained param to param name
         self._active_params = set()  # set of all currently active params
         self._constraints = {}  # dictionary from param name to constraint object
+        self._constrained_cache = {}  # dictionary from param name to cached constrained value
+        self._shared_params = set()  # names of params in shared memory, whose values are never cached
+        self._checkpoint_dirname = None  # directory of the last checkpoint saved or loaded
+        self._checkpoint_versions = {}  # dictionary from param name to version in that checkpoint
 
     def clear(self):
         """
@@ -46,6 +53,10 @@ class ParamStoreDict(object):
         self._param_to_name = {}
         self._active_params = set()
         self._constraints = {}
+        self._constrained_cache = {}
+        self._shared_params = set()
+        self._checkpoint_dirname = None
+        self._checkpoint_versions = {}
 
     def named_parameters(self):
         """
@@ -87,6 +98,20 @@ class ParamStoreDict(object):
             "some of these parameters are not in the ParamStore"
         self._active_params.difference_update(set(params))
 
+    def mark_params_modified(self, params):
+        """
+        :param params: iterable of params that have been modified through ``.data``, e.g. by an
+            optimizer step. such modifications do not bump the version of a tensor, so this is
+            needed for `get_param` to recompute their constrained values, and for the params to
+            be rewritten by the next incremental `save_checkpoint`.
+            :class:`~pyro.optim.optim.PyroOptim` calls this for the params it steps.
+        """
+        for p in params:
+            param_name = self._param_to_name.get(p)
+            if param_name is not None:
+                self._checkpoint_versions.pop(param_name, None)
+                self._constrained_cache.pop(param_name, None)
+
     def replace_param(self, param_name, new_param, old_param):
         """
         Replace the param param_name with current value old_param with the new value new_param
@@ -101,8 +126,22 @@ class ParamStoreDict(object):
         assert self._params[param_name] is old_param.unconstrained()
         del self._params[param_name]
         del self._param_to_name[old_param.unconstrained()]
+        self._constrained_cache.pop(param_name, None)
         self.get_param(param_name, new_param, constraint=self._constraints[param_name])
 
+    def share_memory(self):
+        """
+        Move all parameters in the ParamStore to shared memory, so that their
+        values are shared with (and updated in place by) worker processes forked
+        after this call, e.g. for Hogwild training. Parameters created after this
+        call are not shared. The constrained values of shared parameters are not
+        cached, since other processes may update them at any time.
+        """
+        for param_name, param in self._params.items():
+            param.share_memory_()
+            self._shared_params.add(param_name)
+            self._constrained_cache.pop(param_name, None)
+
     def get_param(self, name, init_tensor=None, constraint=constraints.real):
         """
         Get parameter from its name. If it does not yet exist in the
@@ -115,6 +154,11 @@ class ParamStoreDict(object):
         :type init_tensor: torch.Tensor
         :returns: parameter
         :rtype: torch.Tensor
+
+        The constrained value is cached until the unconstrained tensor is replaced,
+        modified in place, or backpropagated through. Updates made through ``.data``
+        are not tracked otherwise, so code that makes such updates outside of
+        :class:`~pyro.optim.optim.PyroOptim` should call `mark_params_modified`.
         """
         if name not in self._params:
             # if not create the init tensor through
@@ -138,12 +182,37 @@ class ParamStoreDict(object):
         # get the guaranteed to exist param
         unconstrained_param = self._params[name]
 
+        # reuse the constrained value computed by a previous call, unless the unconstrained
+        # tensor has since been replaced or modified in place, or the grad mode differs
+        key = (id(unconstrained_param), unconstrained_param._version, torch.is_grad_enabled())
+        cached = self._constrained_cache.get(name)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+
         # compute the constrained value
         param = transform_to(self._constraints[name])(unconstrained_param)
         param.unconstrained = weakref.ref(unconstrained_param)
 
+        # only values with a graph are cached. The graph is freed by a backward pass through it,
+        # after which the optimizer may update the unconstrained tensor via .data without bumping
+        # its version, so the hook drops the cached value. Values computed without a graph could
+        # not be invalidated this way.
+        if param.grad_fn is not None and name not in self._shared_params:
+            param.grad_fn.register_hook(self._make_invalidate_hook(name, param))
+            self._constrained_cache[name] = key, param
+
         return param
 
+    def _make_invalidate_hook(self, name, param):
+        param_ref = weakref.ref(param)
+
+        def invalidate(grad_inputs, grad_outputs):
+            cached = self._constrained_cache.get(name)
+            if cached is not None and cached[1] is param_ref():
+                del self._constrained_cache[name]
+
+        return invalidate
+
     def param_name(self, p):
         """
         Get parameter name from parameter
@@ -177,12 +246,17 @@ class ParamStoreDict(object):
         for param_name, param in state['params'].items():
             self._params[param_name] = param
             self._param_to_name[param] = param_name
+            self._constrained_cache.pop(param_name, None)
 
         for param_name, constraint in state['constraints'].items():
-            if isinstance(constraint, type(constraints.real)):
-                # Work around lack of hash & equality comparison on constraints.
-                constraint = constraints.real
-            self._constraints[param_name] = constraint
+            self._set_constraint(param_name, constraint)
+
+    def _set_constraint(self, param_name, constraint):
+        if isinstance(constraint, type(constraints.real)):
+            # Work around lack of hash & equality comparison on constraints.
+            constraint = constraints.real
+        self._constraints[param_name] = constraint
+        self._constrained_cache.pop(param_name, None)
 
     def save(self, filename):
         """
@@ -204,3 +278,100 @@ class ParamStoreDict(object):
         with open(filename, "rb") as input_file:
             state = torch.load(input_file)
         self.set_state(state)
+
+    def save_checkpoint(self, dirname):
+        """
+        Save parameters to a checkpoint directory, with one ``.npy`` file per
+        parameter and a manifest. Saves are incremental: if the last checkpoint
+        saved or loaded was in the same directory, only the parameters that
+        have since been replaced, modified in place, or marked as modified
+        with `mark_params_modified` are rewritten.
+
+        Note that other modifications made through ``.data`` are not tracked, and
+        that parameters are always saved from (and loaded to) the CPU.
+
+        :param dirname: directory to save to
+        :type dirname: str
+        """
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        manifest_path = os.path.join(dirname, _MANIFEST)
+        old_files = {}
+        if os.path.exists(manifest_path):
+            old_files = torch.load(manifest_path)["params"]
+        if dirname != self._checkpoint_dirname:
+            self._checkpoint_dirname = dirname
+            self._checkpoint_versions = {}
+
+        files = {}
+        versions = {}
+        new_files = _new_checkpoint_files(dirname, "param_{}.npy")
+        for param_name, param in self._params.items():
+            version = self._checkpoint_versions.get(param_name)
+            if param_name in old_files and version is not None and \
+                    version[0]() is param and version[1] == param._version:
+                files[param_name] = old_files[param_name]
+            else:
+                # write to a new file, since the old one may be memory mapped by a loaded param
+                files[param_name] = next(new_files)
+                np.save(os.path.join(dirname, files[param_name]), param.detach().cpu().numpy())
+            versions[param_name] = weakref.ref(param), param._version
+
+        # replace the manifest before removing stale files, so the checkpoint is always complete
+        tmp_path = manifest_path + ".tmp"
+        torch.save({"params": files, "constraints": self._constraints}, tmp_path)
+        _replace(tmp_path, manifest_path)
+        self._checkpoint_versions = versions
+        for filename in set(old_files.values()) - set(files.values()):
+            os.remove(os.path.join(dirname, filename))
+
+    def load_checkpoint(self, dirname, param_names=None):
+        """
+        Load parameters from a checkpoint directory written by `save_checkpoint`.
+        Parameter values are memory mapped, so their data is only read from disk
+        as it is accessed.
+
+        :param dirname: directory to load from
+        :type dirname: str
+        :param param_names: optional names of the parameters to load; defaults to all
+        :type param_names: iterable of str
+        """
+        manifest = torch.load(os.path.join(dirname, _MANIFEST))
+        files = manifest["params"]
+        if param_names is None:
+            param_names = files.keys()
+        if dirname != self._checkpoint_dirname:
+            self._checkpoint_dirname = dirname
+            self._checkpoint_versions = {}
+
+        for param_name in param_names:
+            # copy-on-write mapping, so that updates to the param never modify the checkpoint
+            value = np.load(os.path.join(dirname, files[param_name]), mmap_mode="c")
+            param = torch.from_numpy(value).requires_grad_()
+            if param_name in self._params:
+                del self._param_to_name[self._params[param_name]]
+            self._params[param_name] = param
+            self._param_to_name[param] = param_name
+            self._constrained_cache.pop(param_name, None)
+            self._set_constraint(param_name, manifest["constraints"][param_name])
+            self._checkpoint_versions[param_name] = weakref.ref(param), param._version
+
+
+_MANIFEST = "manifest.pt"
+
+
+def _new_checkpoint_files(dirname, template):
+    existing = set(os.listdir(dirname))
+    i = 0
+    while True:
+        filename = template.format(i)
+        if filename not in existing:
+            yield filename
+        i += 1
+
+
+def _replace(src, dst):
+    try:
+        os.replace(src, dst)
+    except AttributeError:  # python 2
+        os.rename(src, dst)
@@ -35,6 +35,14 @@ class EnumerateMessenger(Messenger):
             value = dist.enumerate_support()
             assert len(value.shape) == 1 + len(dist.batch_shape) + len(dist.event_shape)
 
+            # Collapse enumeration dims of upstream sites along which the support is merely
+            # expanded, so that the value does not vary along dims it does not depend on.
+            batch_dim = len(dist.batch_shape)
+            index = tuple(slice(0, 1) if batch_dim - i >= self.first_available_dim and value.stride(i) == 0
+                          else slice(None)
+                          for i in range(1, 1 + batch_dim))
+            value = value[(slice(None),) + index]
+
             # Ensure enumeration happens at an available tensor dimension.
             # This allocates the next available dim for enumeration, to the left all other dims.
             actual_dim = len(dist.batch_shape)  # the leftmost dim of log_prob, counting from the right
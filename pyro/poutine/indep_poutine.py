@@ -3,6 +3,7 @@ from __future__ import absolute_import, division, print_function
 from collections import namedtuple
 
 from .poutine import Messenger
+from .util import site_is_subsample
 
 
 class CondIndepStackFrame(namedtuple("CondIndepStackFrame", ["name", "dim", "size", "counter"])):
@@ -20,19 +21,32 @@ class _DimAllocator(object):
     """
     def __init__(self):
         self._stack = []  # in reverse orientation of log_prob.shape
+        self._outermost = set()  # names of dims that are ignored by automatic allocation
 
-    def allocate(self, name, dim):
+    def allocate(self, name, dim, outermost=False):
         """
         Allocate a dimension to an :class:`iarange` with given name.
         Dim should be either None for automatic allocation or a negative
         integer for manual allocation.
+
+        If ``outermost`` is set, the dimension is reserved to the left of all
+        :class:`iarange` s, e.g. for vectorized particles, and automatic
+        allocation does not count it as an existing dim.
         """
         if name in self._stack:
             raise ValueError('duplicate iarange "{}"'.format(name))
         if dim is None:
             # Automatically allocate the rightmost dimension to the left of all existing dims.
-            self._stack.append(name)
-            dim = -len(self._stack)
+            existing = [i for i, other in enumerate(self._stack)
+                        if other is not None and other not in self._outermost]
+            dim = -2 - existing[-1] if existing else -1
+            if -dim <= len(self._stack) and self._stack[-1 - dim] is not None:
+                raise ValueError('\n'.join([
+                    'at iarange "{}", collides with "{}" at dim={}'.format(name, self._stack[-1 - dim], dim),
+                    '\nTry increasing max_iarange_nesting']))
+            while dim < -len(self._stack):
+                self._stack.append(None)
+            self._stack[-1 - dim] = name
         elif dim >= 0:
             raise ValueError('Expected dim < 0 to index from the right, actual {}'.format(dim))
         else:
@@ -44,6 +58,8 @@ class _DimAllocator(object):
                     'at iaranges "{}" and "{}", collide at dim={}'.format(name, self._stack[-1 - dim], dim),
                     '\nTry moving the dim of one iarange to the left, e.g. dim={}'.format(dim - 1)]))
             self._stack[-1 - dim] = name
+        if outermost:
+            self._outermost.add(name)
         return dim
 
     def free(self, name, dim):
@@ -52,6 +68,7 @@ class _DimAllocator(object):
         """
         assert self._stack[-1 - dim] == name
         self._stack[-1 - dim] = None
+        self._outermost.discard(name)
         while self._stack and self._stack[-1] is None:
             self._stack.pop()
 
@@ -87,3 +104,36 @@ class IndepMessenger(Messenger):
         frame = CondIndepStackFrame(self.name, self.dim, self.size, self.counter)
         msg["cond_indep_stack"] = (frame,) + msg["cond_indep_stack"]
         return None
+
+
+class ParticleMessenger(IndepMessenger):
+    """
+    This messenger draws a batch of ``size`` independent particles along
+    dimension ``dim``, which should be to the left of all :class:`~pyro.iarange`
+    dims. It declares the particles as an outermost vectorized independence
+    context and reshapes the distribution at each sample site so that its
+    batch shape includes the particle dim.
+
+    This is used by :class:`~pyro.infer.trace_elbo.Trace_ELBO` to vectorize
+    over ``num_particles``.
+    """
+    def __enter__(self):
+        self.dim = _DIM_ALLOCATOR.allocate(self.name, self.dim, outermost=True)
+        return super(ParticleMessenger, self).__enter__()
+
+    def __exit__(self, *args, **kwargs):
+        super(ParticleMessenger, self).__exit__(*args, **kwargs)
+        _DIM_ALLOCATOR.free(self.name, self.dim)
+
+    def _process_message(self, msg):
+        super(ParticleMessenger, self)._process_message(msg)
+        if msg["type"] == "sample" and not site_is_subsample(msg):
+            batch_shape = msg["fn"].batch_shape
+            if len(batch_shape) < -self.dim:
+                sample_shape = (self.size,) + (1,) * (-self.dim - 1 - len(batch_shape))
+                msg["fn"] = msg["fn"].reshape(sample_shape)
+            elif batch_shape[self.dim] != self.size:
+                raise ValueError('\n  '.join([
+                    'at site "{}", invalid batch_shape for vectorized particles'.format(msg["name"]),
+                    'Expected size {} at dim={}, actual batch_shape {}'.format(self.size, self.dim, batch_shape)]))
+        return None
@@ -3,6 +3,174 @@ from __future__ import absolute_import, division, print_function
 # the global pyro stack
 _PYRO_STACK = []
 
+# dispatch tables for the current contents of _PYRO_STACK, keyed by message type.
+# This is cleared whenever a Messenger is pushed onto or popped off the stack.
+_DISPATCH_CACHE = {}
+
+
+def _overrides(frame, method_name):
+    """
+    Checks whether the class of ``frame`` overrides a no-op method of :class:`Messenger`.
+    """
+    return getattr(type(frame), method_name) != getattr(Messenger, method_name)
+
+
+def get_dispatch_table(msg_type):
+    """
+    :param str msg_type: a message type, e.g. "sample" or "param"
+    :returns: a pair ``(process, postprocess)`` of tuples of
+        ``(stack_index, bound_method)`` pairs
+    :rtype: tuple
+
+    Returns the handlers that :func:`~pyro.util.apply_stack` needs to call
+    for a message of a given type, skipping frames whose handlers are the
+    no-op defaults of :class:`Messenger`. The result is computed once per
+    message type for each configuration of the stack.
+    """
+    try:
+        return _DISPATCH_CACHE[msg_type]
+    except KeyError:
+        pass
+    handler_name = "_pyro_{}".format(msg_type)
+    process = []
+    postprocess = []
+    for index, frame in enumerate(_PYRO_STACK):
+        if _overrides(frame, "_process_message"):
+            process.append((index, frame._process_message))
+        elif not hasattr(Messenger, handler_name) or _overrides(frame, handler_name):
+            process.append((index, getattr(frame, handler_name)))
+        if _overrides(frame, "_postprocess_message"):
+            postprocess.append((index, frame._postprocess_message))
+    result = tuple(process), tuple(reversed(postprocess))
+    _DISPATCH_CACHE[msg_type] = result
+    return result
+
+
+# fields that every message has
+_MESSAGE_FIELDS = ("type", "name", "fn", "is_observed", "args", "kwargs", "value", "infer", "scale",
+                   "cond_indep_stack", "done", "stop", "continuation")
+# fields that are memoized by Trace after a message has been recorded as a site
+_SITE_FIELDS = ("log_pdf", "batch_log_pdf", "score_parts")
+_MESSAGE_FIELD_SET = frozenset(_MESSAGE_FIELDS)
+_SITE_FIELD_SET = frozenset(_SITE_FIELDS)
+
+
+class Message(object):
+    """
+    Record passed up and down the stack at a :func:`pyro.sample` or
+    :func:`pyro.param` site, and stored as the site in a
+    :class:`~pyro.poutine.Trace`.
+
+    Fields live in ``__slots__``, so that a message costs a fixed small
+    allocation rather than a dict. For compatibility with code written against
+    dict messages, a :class:`Message` supports the usual mapping operations.
+    Keys other than the standard fields are kept in an auxiliary dict that is
+    only allocated when first needed.
+    """
+    __slots__ = _MESSAGE_FIELDS + _SITE_FIELDS + ("_extra",)
+
+    def __init__(self, type, name, fn=None, is_observed=False, args=(), kwargs=None, value=None,
+                 infer=None, scale=1.0, cond_indep_stack=(), done=False, stop=False, continuation=None):
+        self.type = type
+        self.name = name
+        self.fn = fn
+        self.is_observed = is_observed
+        self.args = args
+        self.kwargs = {} if kwargs is None else kwargs
+        self.value = value
+        self.infer = {} if infer is None else infer
+        self.scale = scale
+        self.cond_indep_stack = cond_indep_stack
+        self.done = done
+        self.stop = stop
+        self.continuation = continuation
+        self._extra = None
+
+    def __getitem__(self, key):
+        if key in _MESSAGE_FIELD_SET:
+            return getattr(self, key)
+        try:
+            if key in _SITE_FIELD_SET:
+                return getattr(self, key)
+            return self._extra[key]
+        except (AttributeError, TypeError):
+            raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key in _MESSAGE_FIELD_SET or key in _SITE_FIELD_SET:
+            setattr(self, key, value)
+        elif self._extra is None:
+            self._extra = {key: value}
+        else:
+            self._extra[key] = value
+
+    def __delitem__(self, key):
+        if key in _MESSAGE_FIELD_SET:
+            raise TypeError("cannot delete standard message field '{}'".format(key))
+        try:
+            if key in _SITE_FIELD_SET:
+                delattr(self, key)
+            else:
+                del self._extra[key]
+        except (AttributeError, TypeError):
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        if key in _MESSAGE_FIELD_SET:
+            return True
+        if key in _SITE_FIELD_SET:
+            return hasattr(self, key)
+        return self._extra is not None and key in self._extra
+
+    def __iter__(self):
+        for key in _MESSAGE_FIELDS:
+            yield key
+        for key in _SITE_FIELDS:
+            if hasattr(self, key):
+                yield key
+        if self._extra is not None:
+            for key in self._extra:
+                yield key
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return "Message({})".format(", ".join("{}={!r}".format(key, self[key]) for key in self))
+
+    def keys(self):
+        return list(self)
+
+    def values(self):
+        return [self[key] for key in self]
+
+    def items(self):
+        return [(key, self[key]) for key in self]
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def copy(self):
+        """
+        :returns: a shallow copy of this message
+        :rtype: Message
+        """
+        result = Message(self.type, self.name, self.fn, self.is_observed, self.args, self.kwargs, self.value,
+                         self.infer, self.scale, self.cond_indep_stack, self.done, self.stop, self.continuation)
+        for key in _SITE_FIELDS:
+            if hasattr(self, key):
+                setattr(result, key, getattr(self, key))
+        if self._extra is not None:
+            result._extra = self._extra.copy()
+        return result
+
 
 class Messenger(object):
     """
@@ -31,6 +199,7 @@ class Messenger(object):
             # if this poutine is not already installed,
             # put it on the bottom of the stack.
             _PYRO_STACK.insert(0, self)
+            _DISPATCH_CACHE.clear()
 
             # necessary to return self because the return value of __enter__
             # is bound to VAR in with EXPR as VAR.
@@ -75,6 +244,7 @@ class Messenger(object):
             # if not, raise a ValueError because something really weird happened.
             if _PYRO_STACK[0] == self:
                 _PYRO_STACK.pop(0)
+                _DISPATCH_CACHE.clear()
             else:
                 # should never get here, but just in case...
                 raise ValueError("This Messenger is not on the bottom of the stack")
@@ -87,6 +257,7 @@ class Messenger(object):
                 loc = _PYRO_STACK.index(self)
                 for i in range(0, loc + 1):
                     _PYRO_STACK.pop(0)
+                _DISPATCH_CACHE.clear()
 
     def _reset(self):
         pass
@@ -1,9 +1,8 @@
 from __future__ import absolute_import, division, print_function
 
-import collections
 import warnings
+from collections import OrderedDict
 
-import networkx
 import torch
 
 from pyro.distributions.util import scale_tensor
@@ -20,106 +19,175 @@ def _warn_if_nan(name, value):
     # Note that -inf log_pdf is fine: it is merely a zero-probability event.
 
 
-class DiGraph(networkx.DiGraph):
-    node_dict_factory = collections.OrderedDict
+class _SiteTable(OrderedDict):
+    """
+    Ordered table of trace sites, keyed by site name.
+
+    Calling the table returns the table itself, so that both the attribute
+    style ``trace.nodes[name]`` and the call style ``trace.nodes()`` work.
+    """
+    __slots__ = ()
+
+    def __call__(self):
+        return self
+
+
+class _EdgeList(list):
+    """
+    List of ``(parent, child)`` pairs. Like :class:`_SiteTable`, calling the
+    list returns the list itself.
+    """
+    __slots__ = ()
 
-    def fresh_copy(self):
-        return DiGraph()
+    def __call__(self):
+        return self
 
 
 class Trace(object):
     """
-    Execution trace data structure
+    Execution trace data structure.
+
+    Sites are stored in an ordered table mapping site name to a site dict.
+    Dependency edges are only materialized when the first edge is added,
+    so that flat traces pay nothing for the graph structure.
     """
+    __slots__ = ("nodes", "graph_type", "_succ", "_pred")
 
-    def __init__(self, *args, **kwargs):
+    def __init__(self, graph_type="flat"):
         """
         :param string graph_type: string specifying the kind of trace graph to construct
-
-        Constructor. Currently identical to networkx.``DiGraph(\*args, \**kwargs)``,
-        except for storing the graph_type attribute
         """
-        self._graph = DiGraph(*args, **kwargs)
-        graph_type = kwargs.pop("graph_type", "flat")
         assert graph_type in ("flat", "dense"), \
             "{} not a valid graph type".format(graph_type)
         self.graph_type = graph_type
-        super(Trace, self).__init__(*args, **kwargs)
-
-    def __del__(self):
-        # Work around cyclic reference bugs in networkx.DiGraph
-        # See https://github.com/uber/pyro/issues/798
-        self._graph.__dict__.clear()
-
-    @property
-    def nodes(self):
-        return self._graph.nodes
+        self.nodes = _SiteTable()
+        self._succ = None  # dict from site name to ordered dict of children, built lazily
+        self._pred = None  # dict from site name to ordered dict of parents, built lazily
 
     @property
     def edges(self):
-        return self._graph.edges
-
-    @property
-    def graph(self):
-        return self._graph.graph
-
-    @property
-    def remove_node(self):
-        return self._graph.remove_node
-
-    @property
-    def add_edge(self):
-        return self._graph.add_edge
-
-    @property
-    def is_directed(self):
-        return self._graph.is_directed
-
-    @property
-    def in_degree(self):
-        return self._graph.in_degree
-
-    @property
-    def successors(self):
-        return self._graph.successors
+        """
+        :returns: a list of ``(parent, child)`` site name pairs, in the order
+            of parent site insertion
+        """
+        if self._succ is None:
+            return _EdgeList()
+        return _EdgeList((parent, child)
+                         for parent, children in self._succ.items()
+                         for child in children)
 
     def __contains__(self, site_name):
-        return site_name in self._graph
+        return site_name in self.nodes
 
     def __iter__(self):
-        return iter(self._graph)
+        return iter(self.nodes)
 
     def __len__(self):
-        return len(self._graph)
+        return len(self.nodes)
 
-    def add_node(self, site_name, *args, **kwargs):
+    def add_node(self, site_name, **kwargs):
         """
         :param string site_name: the name of the site to be added
 
         Adds a site to the trace.
 
-        Identical to super(Trace, self).add_node,
-        but raises an error when attempting to add a duplicate node
+        Raises an error when attempting to add a duplicate node
         instead of silently overwriting.
         """
+        self.add_site(site_name, kwargs)
+
+    def add_site(self, site_name, site):
+        """
+        :param string site_name: the name of the site to be added
+        :param site: a site record, e.g. a :class:`~pyro.poutine.poutine.Message`
+            or a dict
+
+        Like :meth:`add_node`, but stores ``site`` itself rather than a copy.
+        The caller must not mutate ``site`` afterwards.
+        """
         # XXX should do more validation than this
-        if kwargs["type"] != "param":
-            assert site_name not in self, \
+        if site["type"] != "param":
+            assert site_name not in self.nodes, \
                 "site {} already in trace".format(site_name)
 
-        # XXX should copy in case site gets mutated, or dont bother?
-        self._graph.add_node(site_name, *args, **kwargs)
+        self.nodes[site_name] = site
+
+    def remove_node(self, site_name):
+        """
+        :param string site_name: the name of the site to be removed
+
+        Removes a site and all edges adjacent to it.
+        """
+        del self.nodes[site_name]
+        if self._succ is not None:
+            for child in self._succ.pop(site_name, ()):
+                del self._pred[child][site_name]
+            for parent in self._pred.pop(site_name, ()):
+                del self._succ[parent][site_name]
+
+    def add_edge(self, parent, child):
+        """
+        :param string parent: name of the upstream site
+        :param string child: name of the downstream site
+
+        Adds a dependency edge between two sites already in the trace.
+        """
+        if self._succ is None:
+            self._succ = {}
+            self._pred = {}
+        self._succ.setdefault(parent, OrderedDict())[child] = None
+        self._pred.setdefault(child, OrderedDict())[parent] = None
+
+    def successors(self, site_name):
+        """
+        :returns: an iterator over names of sites directly downstream of ``site_name``
+        """
+        if self._succ is None:
+            return iter(())
+        return iter(self._succ.get(site_name, ()))
+
+    def predecessors(self, site_name):
+        """
+        :returns: an iterator over names of sites directly upstream of ``site_name``
+        """
+        if self._pred is None:
+            return iter(())
+        return iter(self._pred.get(site_name, ()))
+
+    def topological_sort(self):
+        """
+        :returns: a list of site names in which every site precedes its successors.
+            Ties are broken by site insertion order.
+        :rtype: list
+        """
+        if self._succ is None:
+            return list(self.nodes)
+        in_degree = {name: len(self._pred.get(name, ())) for name in self.nodes}
+        ready = [name for name in self.nodes if not in_degree[name]]
+        ready.reverse()
+        result = []
+        while ready:
+            name = ready.pop()
+            result.append(name)
+            children = []
+            for child in self._succ.get(name, ()):
+                in_degree[child] -= 1
+                if not in_degree[child]:
+                    children.append(child)
+            ready.extend(reversed(children))
+        assert len(result) == len(self.nodes), "trace graph contains a cycle"
+        return result
 
     def copy(self):
         """
         Makes a shallow copy of self with nodes and edges preserved.
-        Identical to super(Trace, self).copy(), but preserves the type
-        and the self.graph_type attribute
+        Each site dict is copied, but site values are shared.
         """
-        trace = Trace()
-        trace._graph = self._graph.copy()
-        trace._graph.__class__ = DiGraph
-        trace.graph_type = self.graph_type
+        trace = Trace(graph_type=self.graph_type)
+        trace.nodes = _SiteTable((name, site.copy()) for name, site in self.nodes.items())
+        if self._succ is not None:
+            trace._succ = {name: children.copy() for name, children in self._succ.items()}
+            trace._pred = {name: parents.copy() for name, parents in self._pred.items()}
         return trace
 
     def log_pdf(self, site_filter=lambda name, site: True):
@@ -5,28 +5,78 @@ from .trace import Trace
 from .util import site_is_subsample
 
 
+class _DenseEdgeIndex(object):
+    """
+    Index of the sample sites recorded so far, used to find the dependencies of a
+    new site without comparing it against every earlier site.
+
+    Sites are stored in a trie keyed by the ``(name, counter)`` of each frame of
+    their ``cond_indep_stack``. An earlier site is a dependency unless the two
+    stacks share a frame position with the same name but a different counter,
+    so a query descends only into the matching counter of a frame's name and
+    never visits the other branches of that ``irange``.
+    """
+    __slots__ = ("_root", "_num_sites")
+
+    def __init__(self):
+        self._root = ([], {})  # (sites whose stack ends here, {name: {counter: child}})
+        self._num_sites = 0
+
+    def add(self, name, cond_indep_stack):
+        """
+        Adds a site to the index.
+
+        :returns: names of the earlier sites that the site depends on, in the order
+            they were added
+        :rtype: list
+        """
+        dependencies = []
+        frontier = [self._root]
+        for frame in cond_indep_stack:
+            next_frontier = []
+            for sites, children in frontier:
+                dependencies.extend(sites)
+                for child_name, branches in children.items():
+                    if child_name != frame.name:
+                        next_frontier.extend(branches.values())
+                    elif frame.counter in branches:
+                        next_frontier.append(branches[frame.counter])
+            frontier = next_frontier
+        # all sites below the frontier have stacks extending that of the new site
+        while frontier:
+            sites, children = frontier.pop()
+            dependencies.extend(sites)
+            for branches in children.values():
+                frontier.extend(branches.values())
+        dependencies.sort()
+
+        node = self._root
+        for frame in cond_indep_stack:
+            branches = node[1].setdefault(frame.name, {})
+            if frame.counter not in branches:
+                branches[frame.counter] = ([], {})
+            node = branches[frame.counter]
+        node[0].append((self._num_sites, name))
+        self._num_sites += 1
+        return [past_name for _, past_name in dependencies]
+
+
+def _add_dense_edges(trace, index, name, site):
+    dependencies = index.add(name, site["cond_indep_stack"])
+    if not site_is_subsample(site):
+        for past_name in dependencies:
+            trace.add_edge(past_name, name)
+
+
 def identify_dense_edges(trace):
     """
     Modifies a trace in-place by adding all edges based on the
     `cond_indep_stack` information stored at each site.
     """
+    index = _DenseEdgeIndex()
     for name, node in trace.nodes.items():
-        if site_is_subsample(node):
-            continue
         if node["type"] == "sample":
-            for past_name, past_node in trace.nodes.items():
-                if site_is_subsample(node):
-                    continue
-                if past_node["type"] == "sample":
-                    if past_name == name:
-                        break
-                    past_node_independent = False
-                    for query, target in zip(node["cond_indep_stack"], past_node["cond_indep_stack"]):
-                        if query.name == target.name and query.counter != target.counter:
-                            past_node_independent = True
-                            break
-                    if not past_node_independent:
-                        trace.add_edge(past_name, name)
+            _add_dense_edges(trace, index, name, node)
 
 
 class TraceMessenger(Messenger):
@@ -51,15 +101,9 @@ class TraceMessenger(Messenger):
             graph_type = "flat"
         assert graph_type in ("flat", "dense")
         self.graph_type = graph_type
-
-    def __exit__(self, *args, **kwargs):
-        """
-        Adds appropriate edges based on cond_indep_stack information
-        upon exiting the context.
-        """
-        if self.graph_type == "dense":
-            identify_dense_edges(self.trace)
-        return super(TraceMessenger, self).__exit__(*args, **kwargs)
+        # edges of a dense trace are added as sites are recorded, see identify_dense_edges
+        self._dense_index = None
+        self._dense_trace = None
 
     def get_trace(self):
         """
@@ -123,10 +167,13 @@ class TraceMessenger(Messenger):
         return None
 
     def _postprocess_message(self, msg):
-        val = msg["value"]
-        site = msg.copy()
-        site.update(value=val)
-        self.trace.add_node(msg["name"], **site)
+        # The message is not used after it leaves the stack, so it is stored without copying.
+        self.trace.add_site(msg["name"], msg)
+        if self.graph_type == "dense" and msg["type"] == "sample":
+            if self._dense_trace is not self.trace:
+                self._dense_index = _DenseEdgeIndex()
+                self._dense_trace = self.trace
+            _add_dense_edges(self.trace, self._dense_index, msg["name"], msg)
         return None
 
 
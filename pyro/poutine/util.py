@@ -67,7 +67,7 @@ def enum_extend(trace, msg, num_samples=None):
         msg_copy = msg.copy()
         msg_copy.update(value=s)
         tr_cp = trace.copy()
-        tr_cp.add_node(msg["name"], **msg_copy)
+        tr_cp.add_site(msg["name"], msg_copy)
         extended_traces.append(tr_cp)
     return extended_traces
 
@@ -92,7 +92,7 @@ def mc_extend(trace, msg, num_samples=None):
         msg_copy = msg.copy()
         msg_copy["value"] = msg_copy["fn"](*msg_copy["args"], **msg_copy["kwargs"])
         tr_cp = trace.copy()
-        tr_cp.add_node(msg_copy["name"], **msg_copy)
+        tr_cp.add_site(msg_copy["name"], msg_copy)
         extended_traces.append(tr_cp)
     return extended_traces
 
@@ -12,9 +12,13 @@ from six.moves import zip_longest
 from torch.nn import Parameter
 
 from pyro.params import _PYRO_PARAM_STORE
-from pyro.poutine.poutine import _PYRO_STACK
+from pyro.poutine.poutine import _PYRO_STACK, get_dispatch_table
 from pyro.poutine.util import site_is_subsample
 
+# dictionary from (name, size, subsample_size) of a subsampling iarange/irange to the state of its
+# epoch-based subsampling
+_SUBSAMPLE_EPOCHS = {}
+
 
 def validate_message(msg):
     """
@@ -122,10 +126,12 @@ def memoize(fn):
 
 def set_rng_seed(rng_seed):
     """
-    Sets seeds of torch and torch.cuda (if available).
+    Sets seeds of torch and torch.cuda (if available), and restarts the
+    subsampling epochs of all iaranges and iranges.
     :param int rng_seed: The seed value.
     """
     torch.manual_seed(rng_seed)
+    _SUBSAMPLE_EPOCHS.clear()
     random.seed(rng_seed)
     try:
         import numpy as np
@@ -202,29 +208,50 @@ def apply_stack(initial_msg):
            If the message field "stop" is True, stop;
            Otherwise, continue
     3. Return the updated message
-    """
-    stack = _PYRO_STACK
-    # TODO check at runtime if stack is valid
 
+    Frames whose handlers are the no-op defaults of
+    :class:`~pyro.poutine.poutine.Messenger` are skipped, using dispatch
+    tables that are precomputed whenever the stack changes. Messages are only
+    validated when Python runs in debug mode, i.e. without ``-O``.
+    """
     # msg is used to pass information up and down the stack
     msg = initial_msg
-
-    counter = 0
-    # go until time to stop?
-    for frame in stack:
+    if __debug__:
         validate_message(msg)
 
-        counter = counter + 1
+    msg_type = msg["type"]
+    process, postprocess = get_dispatch_table(msg_type)
 
-        frame._process_message(msg)
+    # go until time to stop?
+    counter = len(_PYRO_STACK)
+    for index, handler in process:
+        handler(msg)
 
         if msg["stop"]:
+            counter = index + 1
+            break
+
+        if msg["type"] != msg_type:
+            # A frame changed the message type (e.g. LiftMessenger turning a param into a sample),
+            # so the precomputed handlers no longer apply: walk the rest of the stack generically.
+            counter = index + 1
+            for frame in _PYRO_STACK[counter:]:
+                if __debug__:
+                    validate_message(msg)
+
+                counter = counter + 1
+
+                frame._process_message(msg)
+
+                if msg["stop"]:
+                    break
             break
 
     default_process_message(msg)
 
-    for frame in reversed(stack[0:counter]):
-        frame._postprocess_message(msg)
+    for index, handler in postprocess:
+        if index < counter:
+            handler(msg)
 
     cont = msg["continuation"]
     if cont is not None:
@@ -48,7 +48,6 @@ setup(
     author_email='pyro@uber.com',
     install_requires=[
         'graphviz>=0.8',
-        'networkx>=2.0.0',
         'six>=1.10.0',
         'torch',
     ],
@@ -56,6 +55,7 @@ setup(
         'extras': EXTRAS_REQUIRE,
         'test': EXTRAS_REQUIRE + [
             'nbval',
+            'networkx>=2.0.0',
             'pytest',
             'pytest-cov',
             'scipy>=0.19.0',
@@ -67,6 +67,7 @@ setup(
             'nbformat',
             'nbstripout',
             'nbval',
+            'networkx>=2.0.0',
             'pypandoc',
             'pytest',
             'pytest-xdist',
@@ -11,6 +11,7 @@ import pyro
 import pyro.distributions as dist
 from pyro.infer.mcmc.hmc import HMC
 from pyro.infer.mcmc.mcmc import MCMC
+from pyro.infer.mcmc.nuts import NUTS
 from tests.common import assert_equal
 
 logging.basicConfig(format='%(levelname)s %(message)s')
@@ -276,6 +277,178 @@ def test_bernoulli_beta_with_dual_averaging():
     assert_equal(posterior_mean, true_probs, prec=0.01)
 
 
+def test_bernoulli_beta_with_dual_averaging_num_chains():
+    def model(data):
+        alpha = torch.tensor([1.1, 1.1])
+        beta = torch.tensor([1.1, 1.1])
+        p_latent = pyro.sample('p_latent', dist.Beta(alpha, beta))
+        pyro.observe('obs', dist.Bernoulli(p_latent), data)
+        return p_latent
+
+    hmc_kernel = HMC(model, trajectory_length=1, adapt_step_size=True)
+    mcmc_run = MCMC(hmc_kernel, num_samples=400, warmup_steps=300, num_chains=2)
+    true_probs = torch.tensor([0.9, 0.1])
+    data = dist.Bernoulli(true_probs).sample(sample_shape=(torch.Size((1000,))))
+    chains = mcmc_run.get_chains(data)
+    assert len(chains) == 2
+    for chain in chains:
+        assert len(chain) == 400
+        posterior_mean = torch.mean(torch.stack([trace.nodes['p_latent']['value'] for trace in chain]), 0)
+        assert_equal(posterior_mean, true_probs, prec=0.02)
+
+
+@pytest.mark.parametrize('adapt_step_size', [False, True])
+def test_gaussian_vectorized_chains(adapt_step_size):
+    num_chains = 4
+    data = torch.randn(100, 2) + torch.tensor([1., -1.])
+
+    def model(data):
+        loc = pyro.sample('loc', dist.Normal(torch.zeros(2), 1.).reshape(extra_event_dims=1))
+        with pyro.iarange('data', len(data)):
+            pyro.sample('obs', dist.Normal(loc, 1.).reshape(extra_event_dims=1), obs=data)
+
+    hmc_kernel = HMC(model, step_size=0.1, num_steps=5, adapt_step_size=adapt_step_size,
+                     num_chains=num_chains, max_iarange_nesting=1)
+    mcmc_run = MCMC(hmc_kernel, num_samples=300, warmup_steps=100)
+    posterior = torch.stack([trace.nodes['loc']['value'] for trace, _ in mcmc_run._traces(data)])
+    assert posterior.shape == (300, num_chains, 1, 2)
+
+    # each chain samples the exact posterior
+    expected_mean = data.sum(0) / (len(data) + 1)
+    expected_std = (1. / (len(data) + 1)) ** 0.5
+    for chain in range(num_chains):
+        assert_equal(posterior[:, chain, 0].mean(0), expected_mean, prec=0.05)
+        assert_equal(posterior[:, chain, 0].std(0), torch.ones(2) * expected_std, prec=0.05)
+    assert not torch.equal(posterior[:, 0], posterior[:, 1])
+
+
+def test_vectorized_chains_require_max_iarange_nesting():
+    with pytest.raises(ValueError):
+        HMC(lambda: None, num_chains=2)
+
+
+@pytest.mark.parametrize('compile_potential', [False, True])
+def test_one_model_evaluation_per_step(compile_potential):
+    def model():
+        return pyro.sample('x', dist.Normal(torch.zeros(2), torch.ones(2)))
+
+    num_samples = 10
+    hmc_kernel = HMC(model, step_size=0.1, num_steps=5, compile_potential=compile_potential)
+    hmc_kernel.setup()
+    trace = hmc_kernel.initial_trace()
+    for _ in range(num_samples):
+        trace = hmc_kernel.sample(trace)
+    # the potential energy and its gradient at the initial state are computed once,
+    # and are then carried over between iterations
+    assert hmc_kernel._num_model_evals == 5 * num_samples + 1
+    assert 'Model evaluations per sample: 5.1' in hmc_kernel.diagnostics()
+
+    # without a recorded trace, the model is only run again for the samples that are read
+    assert not trace.nodes['x']['value'].requires_grad
+    assert hmc_kernel._num_model_evals == 5 * num_samples + 1 + compile_potential
+
+
+@pytest.mark.parametrize('num_chains', [1, 2])
+def test_compiled_potential_energy(num_chains):
+    data = torch.randn(100, 2) + torch.tensor([1., -1.])
+
+    def model(data):
+        loc = pyro.sample('loc', dist.Normal(torch.zeros(2), 1.).reshape(extra_event_dims=1))
+        scale = pyro.sample('scale', dist.Gamma(torch.ones(2), 1.).reshape(extra_event_dims=1))
+        with pyro.iarange('data', len(data), subsample_size=20) as ind:
+            pyro.sample('obs', dist.Normal(loc, scale).reshape(extra_event_dims=1), obs=data[ind])
+
+    hmc_kernel = HMC(model, num_chains=num_chains, max_iarange_nesting=1)
+    hmc_kernel.setup(data)
+    z = hmc_kernel._get_initial_z(hmc_kernel.initial_trace())
+    compiled_potential_energy = hmc_kernel._potential_energy(z)
+    assert hmc_kernel._compiled
+    hmc_kernel._compiled = False
+    assert_equal(compiled_potential_energy, hmc_kernel._potential_energy(z))
+
+
+def test_compiled_potential_energy_falls_back_on_new_sites():
+    structure = {'extra_site': False}
+
+    def model():
+        pyro.sample('x', dist.Normal(torch.zeros(1), torch.ones(1)))
+        if structure['extra_site']:
+            pyro.sample('y', dist.Normal(torch.zeros(1), torch.ones(1)))
+
+    hmc_kernel = HMC(model)
+    hmc_kernel.setup()
+    z = hmc_kernel._get_initial_z(hmc_kernel.initial_trace())
+    hmc_kernel._potential_energy(z)
+    assert hmc_kernel._compiled
+    structure['extra_site'] = True
+    hmc_kernel._potential_energy(z)
+    assert not hmc_kernel._compiled
+    assert 'y' in hmc_kernel._potential_trace
+
+
+@pytest.mark.parametrize('warmup_steps, window_ends', [
+    (10, []),
+    (100, [90]),
+    (1000, [100, 150, 250, 450, 950]),
+])
+def test_mass_matrix_adaptation_windows(warmup_steps, window_ends):
+    hmc_kernel = HMC(lambda: None, adapt_mass_matrix=True)
+    hmc_kernel.begin_warmup(warmup_steps)
+    assert hmc_kernel._adapt_window_ends == window_ends
+
+
+@pytest.mark.parametrize('full_mass', [False, True])
+def test_gaussian_with_mass_matrix_adaptation(full_mass):
+    scale_tril = torch.tensor([[10., 0.], [1., 0.1]])
+
+    def model():
+        pyro.sample('x', dist.MultivariateNormal(torch.zeros(2), scale_tril=scale_tril))
+
+    hmc_kernel = HMC(model, trajectory_length=1, adapt_step_size=True,
+                     adapt_mass_matrix=True, full_mass=full_mass)
+    mcmc_run = MCMC(hmc_kernel, num_samples=500, warmup_steps=400)
+    posterior = []
+    for trace, _ in mcmc_run._traces():
+        posterior.append(trace.nodes['x']['value'])
+        inverse_mass_matrix = hmc_kernel._inverse_mass_matrix
+    posterior = torch.stack(posterior)
+    # the inverse mass matrix estimates the posterior covariance
+    covariance = scale_tril.matmul(scale_tril.t())
+    if not full_mass:
+        covariance = covariance.diag()
+    assert_equal(inverse_mass_matrix / covariance, torch.ones(covariance.shape), prec=0.3)
+    assert_equal(posterior.std(0) / scale_tril.matmul(scale_tril.t()).diag().sqrt(), torch.ones(2), prec=0.2)
+
+
+@pytest.mark.parametrize('kernel', [HMC, NUTS])
+def test_rng_seed(kernel):
+    def model():
+        pyro.sample('x', dist.Normal(torch.zeros(2), torch.ones(2)))
+
+    def run(rng_seed):
+        mcmc_run = MCMC(kernel(model, step_size=0.1, rng_seed=rng_seed), num_samples=20)
+        return torch.stack([trace.nodes['x']['value'] for trace, _ in mcmc_run._traces()])
+
+    # the initial trace is drawn from the prior with the global generator
+    pyro.set_rng_seed(1)
+    samples = run(rng_seed=0)
+    pyro.set_rng_seed(1)
+    assert_equal(run(rng_seed=0), samples, prec=0)
+    pyro.set_rng_seed(1)
+    assert not torch.equal(run(rng_seed=2), samples)
+
+
+def test_rng_seed_num_chains():
+    def model():
+        pyro.sample('x', dist.Normal(torch.zeros(2), torch.ones(2)))
+
+    # chains that shared momenta and accept draws would couple, and end up at the same sample
+    mcmc_run = MCMC(HMC(model, step_size=0.1, num_steps=10, rng_seed=0), num_samples=100, num_chains=2)
+    chains = mcmc_run.get_chains()
+    last_samples = [chain[-1].nodes['x']['value'] for chain in chains]
+    assert (last_samples[0] - last_samples[1]).abs().max() > 1e-3
+
+
 @pytest.mark.xfail(reason='the model is sensitive to NaN log_pdf')
 def test_normal_gamma_with_dual_averaging():
     def model(data):
@@ -1,5 +1,7 @@
 import logging
+import os
 
+import pytest
 import torch
 
 import pyro
@@ -58,3 +60,45 @@ def test_mcmc_interface():
     sample_std = torch.std(torch.stack(samples), 0)
     assert_equal(sample_mean.data, torch.tensor([0.0]), prec=0.08)
     assert_equal(sample_std.data, torch.tensor([1.0]), prec=0.08)
+
+
+def test_mcmc_num_chains():
+    data = torch.tensor([1.0])
+    kernel = PriorKernel(normal_normal_model)
+    mcmc = MCMC(kernel=kernel, num_samples=400, warmup_steps=10, num_chains=3)
+    chains = mcmc.get_chains(data)
+    assert len(chains) == 3
+    chain_values = [torch.stack([trace.nodes["x"]["value"] for trace in chain]) for chain in chains]
+    for values in chain_values:
+        assert values.shape == (400, 1)
+        assert_equal(values.mean(), torch.tensor(0.0), prec=0.2)
+        assert_equal(values.std(), torch.tensor(1.0), prec=0.2)
+    # each chain has its own seed
+    assert not torch.equal(chain_values[0], chain_values[1])
+    # the rebuilt traces can be scored
+    assert chains[0][0].nodes["obs"]["value"] is data
+    chains[0][0].log_pdf()
+
+    marginal = Marginal(mcmc)
+    dist, values = marginal._dist_and_values(data)
+    assert_equal(len(values), 1200)
+
+
+def test_mcmc_num_chains_worker_error():
+    def model(data):
+        raise ValueError("bad model")
+
+    mcmc = MCMC(kernel=PriorKernel(model), num_samples=10, num_chains=2)
+    with pytest.raises(RuntimeError) as e:
+        mcmc.get_chains(torch.tensor([1.0]))
+    assert "ValueError: bad model" in str(e.value)
+
+
+def test_mcmc_num_chains_worker_dies():
+    def model(data):
+        os._exit(1)
+
+    mcmc = MCMC(kernel=PriorKernel(model), num_samples=10, num_chains=2)
+    with pytest.raises(RuntimeError) as e:
+        mcmc.get_chains(torch.tensor([1.0]))
+    assert "exited unexpectedly" in str(e.value)
@@ -32,6 +32,7 @@ TEST_CASES[3] = T3
     'fixture, num_samples, warmup_steps, hmc_params, expected_means, expected_precs, mean_tol, std_tol',
     TEST_CASES,
     ids=TEST_IDS)
+@pytest.mark.parametrize('use_multinomial_sampling', [False, True])
 @pytest.mark.init(rng_seed=34)
 @pytest.mark.disable_validation()
 def test_nuts_conjugate_gaussian(fixture,
@@ -41,8 +42,9 @@ def test_nuts_conjugate_gaussian(fixture,
                                  expected_means,
                                  expected_precs,
                                  mean_tol,
-                                 std_tol):
-    nuts_kernel = NUTS(fixture.model, hmc_params['step_size'])
+                                 std_tol,
+                                 use_multinomial_sampling):
+    nuts_kernel = NUTS(fixture.model, hmc_params['step_size'], use_multinomial_sampling=use_multinomial_sampling)
     mcmc_run = MCMC(nuts_kernel, num_samples, warmup_steps)
     pyro.get_param_store().clear()
     post_trace = defaultdict(list)
@@ -170,3 +172,47 @@ def test_bernoulli_beta_with_dual_averaging():
         posterior.append(trace.nodes['p_latent']['value'])
     posterior_mean = torch.mean(torch.stack(posterior), 0)
     assert_equal(posterior_mean.data, true_probs.data, prec=0.01)
+
+
+@pytest.mark.parametrize('use_multinomial_sampling', [False, True])
+@pytest.mark.parametrize('tree_depth', [0, 1, 3])
+def test_build_tree_proposal_is_uniform(tree_depth, use_multinomial_sampling):
+    def model():
+        pyro.sample('x', dist.Normal(torch.zeros(1), torch.ones(1)))
+
+    # with a small step size, the trajectory does not make a U-turn,
+    # and the weights of its states are almost equal
+    nuts_kernel = NUTS(model, step_size=0.01, use_multinomial_sampling=use_multinomial_sampling)
+    nuts_kernel.setup()
+    z = nuts_kernel._get_initial_z(nuts_kernel.initial_trace())
+    r = torch.ones(1)
+    energy_current = nuts_kernel._energy(z, r)
+    # all states are in the slice
+    log_slice = torch.tensor([-float('inf')])
+
+    num_draws = 800
+    counts = defaultdict(int)
+    for _ in range(num_draws):
+        tree = nuts_kernel._build_tree(z, r, None, log_slice, 1, tree_depth, energy_current)
+        assert not tree.turning and not tree.diverging
+        assert tree.size == tree.num_proposals == 2 ** tree_depth
+        counts[round(tree.z_proposal.item(), 6)] += 1
+    assert len(counts) == 2 ** tree_depth
+    for count in counts.values():
+        assert_equal(count / num_draws, 1. / 2 ** tree_depth, prec=0.05)
+
+
+def test_build_tree_stops_at_u_turn():
+    def model():
+        pyro.sample('x', dist.Normal(torch.zeros(1), torch.ones(1)))
+
+    nuts_kernel = NUTS(model, step_size=0.5)
+    nuts_kernel.setup()
+    z = nuts_kernel._get_initial_z(nuts_kernel.initial_trace())
+    r = torch.ones(1)
+    energy_current = nuts_kernel._energy(z, r)
+    log_slice = torch.tensor([-float('inf')])
+    # half a period of the oscillation takes about 2 * pi steps, so the tree turns before 16 steps
+    tree = nuts_kernel._build_tree(z, r, None, log_slice, 1, 4, energy_current)
+    assert tree.turning
+    assert tree.num_proposals < 16
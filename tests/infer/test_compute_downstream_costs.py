@@ -2,19 +2,30 @@ from __future__ import absolute_import, division, print_function
 
 import math
 
-import networkx
 import pytest
 import torch
 
 import pyro
 import pyro.distributions as dist
 import pyro.poutine as poutine
-from pyro.infer.tracegraph_elbo import _compute_downstream_costs
+from pyro.distributions.testing import fakes
+from pyro.infer.tracegraph_elbo import TraceGraph_ELBO, _compute_downstream_costs
 from pyro.infer.util import MultiFrameTensor, get_iarange_stacks
 from pyro.poutine.util import prune_subsample_sites
 from tests.common import assert_equal
 
 
+def _descendants(trace, node):
+    descendants = set()
+    frontier = [node]
+    while frontier:
+        for child in trace.successors(frontier.pop()):
+            if child not in descendants:
+                descendants.add(child)
+                frontier.append(child)
+    return descendants
+
+
 def _brute_force_compute_downstream_costs(model_trace, guide_trace,  #
                                           non_reparam_nodes):
 
@@ -28,7 +39,7 @@ def _brute_force_compute_downstream_costs(model_trace, guide_trace,  #
                                                    guide_trace.nodes[node]['batch_log_pdf']))
         downstream_guide_cost_nodes[node] = set([node])
 
-        descendants = networkx.descendants(guide_trace._graph, node)
+        descendants = _descendants(guide_trace, node)
 
         for desc in descendants:
             desc_mft = MultiFrameTensor((stacks[desc],
@@ -428,3 +439,31 @@ def test_compute_downstream_costs_iarange_reuse(dim1, dim2):
     expected_c1 += model_trace.nodes['c2']['batch_log_pdf'] - guide_trace.nodes['c2']['batch_log_pdf']
     expected_c1 += model_trace.nodes['obs']['batch_log_pdf']
     assert_equal(expected_c1, dc['c1'])
+
+
+@pytest.mark.parametrize("freeze_structure", [False, True])
+def test_downstream_structure_reused_across_steps(freeze_structure):
+    data = torch.tensor(0.5)
+
+    def model(num_latents):
+        z = torch.tensor(0.)
+        for i in range(num_latents):
+            z = pyro.sample("z_{}".format(i), fakes.NonreparameterizedNormal(z, 1.))
+        pyro.sample("obs", dist.Normal(z, 1.), obs=data)
+
+    def guide(num_latents):
+        loc = pyro.param("loc", torch.tensor(0., requires_grad=True))
+        for i in range(num_latents):
+            pyro.sample("z_{}".format(i), fakes.NonreparameterizedNormal(loc, 1.))
+
+    pyro.clear_param_store()
+    loc = pyro.param("loc", torch.tensor(0., requires_grad=True))
+    elbo = TraceGraph_ELBO(freeze_structure=freeze_structure)
+    for num_latents in [2, 2, 3, 1, 3]:
+        grads = []
+        for fresh_elbo in [elbo, TraceGraph_ELBO()]:
+            pyro.set_rng_seed(num_latents)
+            loc.grad = None
+            fresh_elbo.loss_and_grads(model, guide, num_latents)
+            grads.append(loc.grad.clone())
+        assert_equal(grads[0], grads[1])
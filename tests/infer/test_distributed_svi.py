@@ -0,0 +1,96 @@
+from __future__ import absolute_import, division, print_function
+
+import os
+
+import pytest
+import torch
+import torch.distributed as dist
+
+import pyro
+import pyro.distributions as dist_
+import pyro.optim as optim
+from pyro.infer import SVI, DistributedSVI
+from pyro.infer.distributed_svi import hogwild, spawn
+from tests.common import assert_equal
+
+pytestmark = pytest.mark.skipif(not dist.is_available(), reason="torch.distributed is not available")
+
+DATA = torch.tensor([[0., 1.], [1., 2.], [2., 3.], [3., 5.], [4., 4.], [5., 6.]])
+
+
+def model(data, ind):
+    # params are lazily created with a different random init in each worker
+    loc = pyro.param("loc", torch.randn(2))
+    with pyro.iarange("data", len(DATA), subsample=ind):
+        pyro.sample("obs", dist_.Normal(loc, 1.).reshape(extra_event_dims=1), obs=data)
+
+
+def guide(data, ind):
+    pass
+
+
+def train(svi, num_steps):
+    losses = []
+    for step in range(num_steps):
+        ind = torch.arange(svi.rank, len(DATA), svi.world_size).long()
+        losses.append(svi.step(DATA[ind], ind))
+    return losses, pyro.param("loc").detach()
+
+
+def train_worker(rank, num_steps):
+    torch.manual_seed(rank)
+    pyro.clear_param_store()
+    svi = DistributedSVI(model, guide, optim.Adam({"lr": 0.1}), loss="ELBO")
+    return train(svi, num_steps)
+
+
+def test_distributed_svi_matches_svi():
+    num_steps = 5
+    results = spawn(train_worker, 2, args=(num_steps,))
+
+    # the same steps, in a single process with worker 0's init
+    torch.manual_seed(0)
+    pyro.clear_param_store()
+    svi = SVI(model, guide, optim.Adam({"lr": 0.1}), loss="ELBO")
+    svi.rank, svi.world_size = 0, 1
+    expected_losses, expected_loc = train(svi, num_steps)
+
+    for losses, loc in results:
+        assert_equal(losses, expected_losses, prec=1e-4)
+        assert_equal(loc, expected_loc, prec=1e-5)
+
+
+def test_distributed_svi_requires_process_group():
+    with pytest.raises(RuntimeError):
+        DistributedSVI(model, guide, optim.Adam({"lr": 0.1}), loss="ELBO")
+
+
+def dying_worker(rank):
+    if rank == 1:
+        os._exit(1)
+    # blocks waiting for the dead worker
+    dist.all_reduce(torch.ones(1))
+
+
+def test_spawn_worker_dies():
+    with pytest.raises(RuntimeError):
+        spawn(dying_worker, 2)
+
+
+def hogwild_worker(rank, num_steps):
+    svi = SVI(model, guide, optim.Adam({"lr": 0.05}), loss="ELBO")
+    ind = torch.arange(len(DATA)).long()
+    for step in range(num_steps):
+        svi.step(DATA, ind)
+    return pyro.param("loc").detach().clone()
+
+
+def test_hogwild_updates_shared_params():
+    pyro.clear_param_store()
+    pyro.param("loc", torch.zeros(2))
+    results = hogwild(hogwild_worker, 2, args=(100,))
+
+    # the workers updated the params of this process, each seeing the other's updates
+    loc = pyro.param("loc").detach()
+    assert_equal(loc, DATA.mean(0), prec=0.1)
+    assert any(torch.equal(result, loc) for result in results)
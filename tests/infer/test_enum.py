@@ -77,6 +77,31 @@ def test_iter_discrete_traces_vector(graph_type):
     assert len(traces) == 2 * ps.size(-1)
 
 
+def test_iter_discrete_traces_shared_prefix():
+    num_calls = [0]
+
+    @config_enumerate
+    def model():
+        num_calls[0] += 1
+        z = pyro.sample("z", dist.Normal(torch.zeros(1), torch.ones(1)))
+        x = pyro.sample("x", dist.Bernoulli(torch.tensor([0.5])))
+        w = pyro.sample("w", dist.Normal(torch.zeros(1), torch.ones(1)))
+        y = pyro.sample("y", dist.Categorical(torch.ones(3) / 3))
+        return z, x, w, y
+
+    traces = list(iter_discrete_traces("flat", model))
+
+    assert num_calls[0] == len(traces) == 6
+    values = [tuple(tr.nodes[name]["value"].item() for name in "xy") for tr in traces]
+    assert sorted(values) == [(x, y) for x in range(2) for y in range(3)]
+    assert len(set(tr.nodes["z"]["value"].item() for tr in traces)) == 1
+    for x in range(2):
+        assert len(set(tr.nodes["w"]["value"].item() for tr, value in zip(traces, values) if value[0] == x)) == 1
+    for tr in traces:
+        assert tr.nodes["x"]["infer"]["_enum_total"] == 2
+        assert tr.nodes["y"]["infer"]["_enum_total"] == 3
+
+
 @pytest.mark.parametrize("enumerate1", [None, "sequential", "parallel"])
 def test_iter_discrete_traces_nan(enumerate1):
     pyro.clear_param_store()
@@ -794,7 +819,8 @@ def test_elbo_rsvi(enumerate1):
     ("parallel", 3),
     ("parallel", 10),
     ("parallel", 20),
-    pytest.param("parallel", 30, marks=pytest.mark.skip(reason="extremely expensive")),
+    ("parallel", 30),
+    ("parallel", 50),
 ])
 def test_elbo_hmm_in_model(enumerate1, num_steps):
     pyro.clear_param_store()
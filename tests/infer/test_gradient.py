@@ -17,12 +17,13 @@ from tests.common import assert_equal
 logger = logging.getLogger(__name__)
 
 
+@pytest.mark.parametrize("freeze_structure", [False, True], ids=["dynamic", "frozen"])
 @pytest.mark.parametrize("reparameterized", [True, False], ids=["reparam", "nonreparam"])
 @pytest.mark.parametrize("subsample", [False, True], ids=["full", "subsample"])
 @pytest.mark.parametrize("trace_graph,enum_discrete",
                          [(False, False), (True, False), (False, True)],
                          ids=["Trace", "TraceGraph", "TraceEnum"])
-def test_subsample_gradient(trace_graph, enum_discrete, reparameterized, subsample):
+def test_subsample_gradient(trace_graph, enum_discrete, reparameterized, subsample, freeze_structure):
     pyro.clear_param_store()
     data = torch.tensor([-0.5, 2.0])
     subsample_size = 1 if subsample else len(data)
@@ -48,7 +49,7 @@ def test_subsample_gradient(trace_graph, enum_discrete, reparameterized, subsamp
     optim = Adam({"lr": 0.1})
     inference = SVI(model, guide, optim, loss="ELBO",
                     trace_graph=trace_graph, enum_discrete=enum_discrete,
-                    num_particles=1)
+                    num_particles=1, freeze_structure=freeze_structure)
     if subsample_size == 1:
         inference.loss_and_grads(model, guide, subsample=torch.LongTensor([0]))
         inference.loss_and_grads(model, guide, subsample=torch.LongTensor([1]))
@@ -154,3 +155,37 @@ def test_subsample_gradient_sequential(trace_graph, enum_discrete, reparameteriz
         logger.info('expected {} = {}'.format(name, expected_grads[name]))
         logger.info('actual   {} = {}'.format(name, actual_grads[name]))
     assert_equal(actual_grads, expected_grads, prec=precision)
+
+
+@pytest.mark.parametrize("reparameterized", [True, False], ids=["reparam", "nonreparam"])
+def test_vectorize_particles(reparameterized):
+    pyro.clear_param_store()
+    data = torch.tensor([-0.5, 2.0])
+    num_particles = 200000
+    precision = 0.05 if reparameterized else 0.2
+    Normal = dist.Normal if reparameterized else fakes.NonreparameterizedNormal
+
+    def model():
+        z = pyro.sample("z", Normal(torch.zeros(1), torch.ones(1)))
+        with pyro.iarange("data", len(data)):
+            pyro.sample("x", Normal(z, 1), obs=data)
+
+    def guide():
+        mu = pyro.param("mu", lambda: torch.tensor([0.1], requires_grad=True))
+        sigma = pyro.param("sigma", lambda: torch.tensor([1.5], requires_grad=True))
+        pyro.sample("z", Normal(mu, sigma))
+
+    inference = SVI(model, guide, Adam({"lr": 0.1}), loss="ELBO", num_particles=num_particles,
+                    max_iarange_nesting=1, vectorize_particles=True)
+    inference.loss_and_grads(model, guide)
+    params = dict(pyro.get_param_store().named_parameters())
+    actual_grads = {name: param.grad.detach().cpu().numpy() for name, param in params.items()}
+
+    # gradients of -ELBO for the looped estimator, which has the same expectation
+    mu, sigma = 0.1, 1.5
+    expected_grads = {'mu': np.array([mu - (data - mu).sum().item()]),
+                      'sigma': np.array([3 * sigma - 1 / sigma])}
+    for name in sorted(params):
+        logger.info('expected {} = {}'.format(name, expected_grads[name]))
+        logger.info('actual   {} = {}'.format(name, actual_grads[name]))
+    assert_equal(actual_grads, expected_grads, prec=precision)
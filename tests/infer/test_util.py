@@ -1,11 +1,13 @@
 import math
 
+import pytest
 import torch
 
 import pyro
 import pyro.distributions as dist
 import pyro.poutine as poutine
-from pyro.infer.util import MultiFrameTensor
+from pyro.infer.util import MultiFrameDice, MultiFrameTensor, sum_product
+from pyro.poutine.indep_poutine import CondIndepStackFrame
 from tests.common import assert_equal
 
 
@@ -44,3 +46,47 @@ def test_multi_frame_tensor():
     for name, expected_sum in expected.items():
         actual_sum = actual.sum_to(stacks[name])
         assert_equal(actual_sum, expected_sum, msg=name)
+
+
+@pytest.mark.parametrize("shapes", [
+    [()],
+    [(2,), (2,)],
+    [(3, 1), (1, 4), (3, 4)],
+    [(2, 1, 1), (2, 3, 1), (3, 4), (4,)],
+    [(5, 1, 1, 1), (5, 2, 1, 1), (2, 3, 1), (3, 4), (1,)],
+])
+def test_sum_product(shapes):
+    tensors = [torch.randn(shape).exp() for shape in shapes] + [0.5]
+    expected = 0.5
+    for x in tensors[:-1]:
+        expected = expected * x
+    assert_equal(sum_product(tensors), expected.sum())
+
+    cache = {}
+    assert_equal(sum_product(tensors, cache), expected.sum())
+    assert_equal(sum_product(tensors[::-1], cache), expected.sum())
+
+
+def test_sum_product_long_chain():
+    # a chain with more dims than einsum has symbols, of which each contraction involves only a few
+    num_dims = 30
+    matrices = [torch.randn(2, 2).exp() for _ in range(num_dims - 1)]
+    tensors = []
+    for i, matrix in enumerate(matrices):
+        shape = [1] * num_dims
+        shape[i] = shape[i + 1] = 2
+        tensors.append(matrix.reshape(shape))
+    expected = torch.ones(1, 2)
+    for matrix in matrices:
+        expected = expected.matmul(matrix)
+    assert_equal(sum_product(tensors), expected.sum())
+
+
+def test_compute_expectation_iarange_broadcast():
+    # a cost in the iarange context that is singleton along the iarange dim must not be broadcast along it
+    dice = MultiFrameDice(poutine.trace(lambda: None).get_trace())
+    stack = (CondIndepStackFrame("data", -1, 3, 0),)
+    cost = torch.randn(3)
+    singleton_cost = torch.randn(1)
+    expected = cost.sum() + singleton_cost.sum()
+    assert_equal(dice.compute_expectation([(stack, cost), (stack, singleton_cost)]), expected)
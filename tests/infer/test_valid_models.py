@@ -132,6 +132,29 @@ def test_model_guide_shape_mismatch_error(trace_graph, enum_discrete):
     assert_error(model, guide, trace_graph=trace_graph, enum_discrete=enum_discrete)
 
 
+@pytest.mark.parametrize("trace_graph,enum_discrete",
+                         [(False, False), (True, False), (False, True)],
+                         ids=["Trace", "TraceGraph", "TraceEnum"])
+def test_freeze_structure_changed_shape_error(trace_graph, enum_discrete):
+    sizes = [1, 1, 2]
+
+    def model():
+        pyro.sample("x", dist.Normal(torch.zeros(1), torch.ones(1)))
+
+    def guide():
+        size = sizes.pop(0)
+        mu = pyro.param("mu", torch.zeros(1, requires_grad=True))
+        pyro.sample("x", dist.Normal(mu.expand(size), torch.ones(size)))
+
+    pyro.clear_param_store()
+    inference = SVI(model, guide, Adam({"lr": 1e-6}), "ELBO",
+                    trace_graph=trace_graph, enum_discrete=enum_discrete, freeze_structure=True)
+    inference.step()
+    inference.step()
+    with pytest.raises(ValueError):
+        inference.step()
+
+
 @pytest.mark.parametrize("trace_graph,enum_discrete",
                          [(False, False), (True, False), (False, True)],
                          ids=["Trace", "TraceGraph", "TraceEnum"])
@@ -786,3 +809,37 @@ def test_advi(advi_class):
 
     advi = advi_class(model)
     assert_ok(advi.model, advi.guide)
+
+
+@pytest.mark.parametrize('subsample_size', [None, 5], ids=['full', 'subsample'])
+def test_vectorize_particles_iarange_ok(subsample_size):
+
+    def model():
+        p = torch.tensor(0.5)
+        with pyro.iarange("outer", 10, subsample_size) as ind_outer:
+            z = pyro.sample("z", dist.Bernoulli(p).reshape([len(ind_outer)]))
+            with pyro.iarange("inner", 11, subsample_size) as ind_inner:
+                pyro.sample("x", dist.Bernoulli(z), obs=torch.zeros(len(ind_inner), len(ind_outer)))
+
+    def guide():
+        p = pyro.param("p", torch.tensor(0.5, requires_grad=True))
+        with pyro.iarange("outer", 10, subsample_size) as ind_outer:
+            pyro.sample("z", dist.Bernoulli(p).reshape([len(ind_outer)]))
+            with pyro.iarange("inner", 11, subsample_size):
+                pass
+
+    assert_ok(model, guide, num_particles=7, max_iarange_nesting=2, vectorize_particles=True)
+
+
+def test_vectorize_particles_iarange_nesting_error():
+
+    def model():
+        p = torch.tensor(0.5)
+        with pyro.iarange("outer", 10):
+            with pyro.iarange("inner", 11):
+                pyro.sample("x", dist.Bernoulli(p).reshape([11, 10]))
+
+    def guide():
+        pass
+
+    assert_error(model, guide, num_particles=7, max_iarange_nesting=1, vectorize_particles=True)
@@ -99,11 +99,11 @@ class QuarticOscillator(object):
 @pytest.mark.parametrize('example', TEST_EXAMPLES, ids=EXAMPLE_IDS)
 def test_trajectory(example):
     model, args = example
-    q_f, p_f = velocity_verlet(args.q_i,
-                               args.p_i,
-                               model.potential_fn,
-                               args.step_size,
-                               args.num_steps)
+    q_f, p_f, _, _ = velocity_verlet(args.q_i,
+                                     args.p_i,
+                                     model.potential_fn,
+                                     args.step_size,
+                                     args.num_steps)
     logger.info("initial q: {}".format(args.q_i))
     logger.info("final q: {}".format(q_f))
     assert_equal(q_f, args.q_f, args.prec)
@@ -113,11 +113,11 @@ def test_trajectory(example):
 @pytest.mark.parametrize('example', TEST_EXAMPLES, ids=EXAMPLE_IDS)
 def test_energy_conservation(example):
     model, args = example
-    q_f, p_f = velocity_verlet(args.q_i,
-                               args.p_i,
-                               model.potential_fn,
-                               args.step_size,
-                               args.num_steps)
+    q_f, p_f, _, _ = velocity_verlet(args.q_i,
+                                     args.p_i,
+                                     model.potential_fn,
+                                     args.step_size,
+                                     args.num_steps)
     energy_initial = model.energy(args.q_i, args.p_i)
     energy_final = model.energy(q_f, p_f)
     logger.info("initial energy: {}".format(energy_initial.item()))
@@ -128,15 +128,32 @@ def test_energy_conservation(example):
 @pytest.mark.parametrize('example', TEST_EXAMPLES, ids=EXAMPLE_IDS)
 def test_time_reversibility(example):
     model, args = example
-    q_forward, p_forward = velocity_verlet(args.q_i,
-                                           args.p_i,
-                                           model.potential_fn,
-                                           args.step_size,
-                                           args.num_steps)
+    q_forward, p_forward, _, _ = velocity_verlet(args.q_i,
+                                                 args.p_i,
+                                                 model.potential_fn,
+                                                 args.step_size,
+                                                 args.num_steps)
     p_reverse = {key: -val for key, val in p_forward.items()}
-    q_f, p_f = velocity_verlet(q_forward,
-                               p_reverse,
-                               model.potential_fn,
-                               args.step_size,
-                               args.num_steps)
+    q_f, p_f, _, _ = velocity_verlet(q_forward,
+                                     p_reverse,
+                                     model.potential_fn,
+                                     args.step_size,
+                                     args.num_steps)
     assert_equal(q_f, args.q_i, 1e-5)
+
+
+@pytest.mark.parametrize('example', TEST_EXAMPLES, ids=EXAMPLE_IDS)
+def test_flat_tensor_state(example):
+    model, args = example
+    names = sorted(args.q_i)
+
+    def flat_potential_fn(q):
+        return model.potential_fn({name: q[i:i + 1] for i, name in enumerate(names)})
+
+    q_f, p_f, _, _ = velocity_verlet(torch.cat([args.q_i[name] for name in names]),
+                                     torch.cat([args.p_i[name] for name in names]),
+                                     flat_potential_fn,
+                                     args.step_size,
+                                     args.num_steps)
+    assert_equal(q_f, torch.cat([args.q_f[name] for name in names]), args.prec)
+    assert_equal(p_f, torch.cat([args.p_f[name] for name in names]), args.prec)
@@ -0,0 +1,33 @@
+from __future__ import absolute_import, division, print_function
+
+import pytest
+import torch
+
+from pyro.ops.welford import WelfordCovariance
+from tests.common import assert_equal
+
+
+@pytest.mark.parametrize('diagonal', [True, False])
+def test_welford_covariance(diagonal):
+    samples = torch.randn(1000, 3).matmul(torch.tensor([[1., 0., 0.], [0.5, 2., 0.], [0., 1., 0.1]]))
+    estimator = WelfordCovariance(diagonal=diagonal)
+    for sample in samples:
+        estimator.update(sample)
+
+    centered = samples - samples.mean(0)
+    expected = centered.t().matmul(centered) / (len(samples) - 1)
+    if diagonal:
+        expected = expected.diag()
+    assert_equal(estimator.get_covariance(regularize=False), expected, prec=1e-4)
+
+
+def test_welford_reset():
+    estimator = WelfordCovariance()
+    for sample in torch.randn(10, 2):
+        estimator.update(sample)
+    estimator.reset()
+    samples = torch.randn(10, 2)
+    for sample in samples:
+        estimator.update(sample)
+    assert estimator.n_samples == 10
+    assert_equal(estimator.get_covariance(regularize=False), samples.var(0), prec=1e-5)
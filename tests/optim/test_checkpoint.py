@@ -0,0 +1,129 @@
+from __future__ import absolute_import, division, print_function
+
+import pytest
+import torch
+from torch.distributions import constraints
+
+import pyro
+import pyro.distributions as dist
+import pyro.optim as optim
+from pyro.infer import SVI
+
+
+def model(data):
+    loc = pyro.sample("loc", dist.Normal(torch.zeros(2), torch.ones(2)).reshape(extra_event_dims=1))
+    pyro.sample("obs", dist.Normal(loc, torch.ones(2)).reshape(extra_event_dims=1), obs=data)
+
+
+def guide(data):
+    loc = pyro.param("loc_q", torch.zeros(2))
+    scale = pyro.param("scale_q", torch.ones(2), constraint=constraints.positive)
+    pyro.sample("loc", dist.Normal(loc, scale).reshape(extra_event_dims=1))
+
+
+def _optim_states(adam):
+    # the state of each param, e.g. step, exp_avg and exp_avg_sq for Adam, cloned from the live tensors
+    return {name: {key: value.clone() if torch.is_tensor(value) else value
+                   for key, value in list(state["state"].values())[0].items()}
+            for name, state in adam.get_state().items()}
+
+
+def test_checkpoint_mid_training_round_trip(tmpdir):
+    param_filename = str(tmpdir.join("params.pt"))
+    optim_filename = str(tmpdir.join("optim.pt"))
+    data = torch.tensor([1., -1.])
+    pyro.clear_param_store()
+    adam = optim.Adam({"lr": 0.1})
+    svi = SVI(model, guide, adam, loss="ELBO")
+    with optim.AsyncCheckpointer(adam) as checkpointer:
+        for step in range(10):
+            if step == 5:
+                pyro.set_rng_seed(0)  # so that the step after restoring draws the same samples
+            svi.step(data)
+            if step == 4:
+                checkpointer.save(param_filename, optim_filename)
+                expected_params = {name: param.detach().clone()
+                                   for name, param in pyro.get_param_store().named_parameters()}
+                expected_states = _optim_states(adam)
+            if step == 5:
+                expected_next_params = {name: param.detach().clone()
+                                        for name, param in pyro.get_param_store().named_parameters()}
+
+    pyro.clear_param_store()
+    pyro.get_param_store().load(param_filename)
+    for name, param in pyro.get_param_store().named_parameters():
+        assert torch.equal(param.data, expected_params[name])
+        assert param.requires_grad
+    adam2 = optim.Adam({"lr": 0.1})
+    adam2.load(optim_filename)
+    for name, state in adam2._state_waiting_to_be_consumed.items():
+        state = list(state["state"].values())[0]
+        assert set(state) == set(expected_states[name])
+        for key, value in state.items():
+            if torch.is_tensor(value):
+                assert torch.equal(value, expected_states[name][key]), key
+            else:
+                assert value == expected_states[name][key], key
+
+    # training continues exactly as it did from the checkpoint
+    pyro.set_rng_seed(0)
+    SVI(model, guide, adam2, loss="ELBO").step(data)
+    for name, param in pyro.get_param_store().named_parameters():
+        assert torch.equal(param.data, expected_next_params[name])
+
+
+def test_incremental_checkpoint_after_svi_step(tmpdir):
+    dirname = str(tmpdir.join("checkpoint"))
+    data = torch.tensor([1., -1.])
+    pyro.clear_param_store()
+    store = pyro.get_param_store()
+    svi = SVI(model, guide, optim.Adam({"lr": 0.1}), loss="ELBO")
+    svi.step(data)
+    store.save_checkpoint(dirname)
+
+    # the optimizer updates params through .data, so it must mark them as modified
+    svi.step(data)
+    expected_params = {name: param.detach().clone() for name, param in store.named_parameters()}
+    store.save_checkpoint(dirname)
+    pyro.clear_param_store()
+    store.load_checkpoint(dirname)
+    for name, param in store.named_parameters():
+        assert torch.equal(param.data, expected_params[name])
+
+
+def test_optim_checkpoint_keeps_pending_state(tmpdir):
+    dirname = str(tmpdir.join("checkpoint"))
+    data = torch.tensor([1., -1.])
+    pyro.clear_param_store()
+    adam = optim.Adam({"lr": 0.1})
+    svi = SVI(model, guide, adam, loss="ELBO")
+    svi.step(data)
+    adam.save_checkpoint(dirname)
+
+    # step only one param after loading, so the state of the other is still waiting in the old files
+    adam2 = optim.Adam({"lr": 0.1})
+    adam2.load_checkpoint(dirname)
+    loc_q = pyro.param("loc_q").unconstrained()
+    loc_q.grad = torch.ones(2)
+    adam2([loc_q])
+    assert list(adam2._state_files_waiting_to_be_consumed) == ["scale_q"]
+    adam2.save_checkpoint(dirname)
+    adam2.save_checkpoint(str(tmpdir.join("other")))
+
+    for checkpoint in ["checkpoint", "other"]:
+        adam3 = optim.Adam({"lr": 0.1})
+        adam3.load_checkpoint(str(tmpdir.join(checkpoint)))
+        assert set(adam3._state_files_waiting_to_be_consumed) == {"loc_q", "scale_q"}
+        steps = {name: list(torch.load(path)["state"].values())[0]["step"]
+                 for name, path in adam3._state_files_waiting_to_be_consumed.items()}
+        assert steps == {"loc_q": 2, "scale_q": 1}
+
+
+def test_checkpoint_error_is_raised(tmpdir):
+    pyro.clear_param_store()
+    pyro.param("x", torch.zeros(1))
+    checkpointer = optim.AsyncCheckpointer()
+    checkpointer.save(str(tmpdir.join("missing", "params.pt")))
+    with pytest.raises(IOError):
+        checkpointer.wait()
+    checkpointer.close()
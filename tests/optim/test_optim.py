@@ -2,12 +2,14 @@ from __future__ import absolute_import, division, print_function
 
 from unittest import TestCase
 
+import pytest
 import torch
 
 import pyro
 import pyro.optim as optim
 from pyro.distributions import Normal
 from pyro.infer import SVI
+from tests.common import assert_equal
 
 
 class OptimTests(TestCase):
@@ -72,3 +74,107 @@ class OptimTests(TestCase):
         free_param_unchanged = torch.equal(pyro.param(free_param).data, torch.zeros(1))
         fixed_param_unchanged = torch.equal(pyro.param(fixed_param).data, torch.zeros(1))
         assert fixed_param_unchanged and not free_param_unchanged
+
+
+def test_single_optimizer_partial_step():
+    pyro.clear_param_store()
+    x = pyro.param("x", torch.zeros(1, requires_grad=True))
+    y = pyro.param("y", torch.zeros(1, requires_grad=True))
+    z = pyro.param("z", torch.zeros(2, requires_grad=True))
+
+    def optim_args(module_name, param_name):
+        return {"lr": 0.1 if param_name == "z" else 0.01}
+
+    adam = optim.Adam(optim_args)
+    for p in (x, y, z):
+        p.grad = torch.ones(p.shape)
+    adam([x, z])
+    adam([x, y, z])
+
+    # all params share one optimizer, with one param group per distinct args added at once
+    assert len(adam.optim.param_groups) == 3
+    assert adam.param_groups[x] is not adam.param_groups[z]
+    assert x.item() < y.item() < 0
+    assert (z.data < x.item()).all()
+
+    state = adam.get_state()
+    assert set(state) == {"x", "y", "z"}
+    assert list(state["x"]["state"].values())[0]["step"] == 2
+    assert list(state["y"]["state"].values())[0]["step"] == 1
+    assert state["z"]["param_groups"][0]["lr"] == 0.1
+
+    adam2 = optim.Adam(optim_args)
+    adam2.set_state(state)
+    adam2([x, y, z])
+    assert len(adam2.optim.param_groups) == 3
+    assert list(adam2.get_state()["x"]["state"].values())[0]["step"] == 3
+
+
+def test_save_and_load_checkpoint(tmpdir):
+    pyro.clear_param_store()
+    x = pyro.param("x", torch.zeros(1, requires_grad=True))
+    y = pyro.param("y", torch.zeros(2, requires_grad=True))
+    adam = optim.Adam({"lr": 0.1})
+    for p in (x, y):
+        p.grad = torch.ones(p.shape)
+    adam([x, y])
+    adam([x])
+    adam.save_checkpoint(str(tmpdir))
+
+    adam2 = optim.Adam({"lr": 0.1})
+    adam2.load_checkpoint(str(tmpdir))
+    adam2([y])
+    # only the state of the param seen so far has been read
+    assert list(adam2._state_files_waiting_to_be_consumed) == ["x"]
+    assert list(adam2.get_state()["y"]["state"].values())[0]["step"] == 2
+    adam2([x, y])
+    assert list(adam2.get_state()["x"]["state"].values())[0]["step"] == 3
+
+
+def test_clipped_adam_decays_lr_per_param():
+    pyro.clear_param_store()
+    x = pyro.param("x", torch.zeros(1, requires_grad=True))
+    y = pyro.param("y", torch.zeros(1, requires_grad=True))
+    adam = optim.ClippedAdam({"lr": 0.1, "lrd": 0.5})
+    for p in (x, y):
+        p.grad = torch.ones(p.shape)
+    adam([x, y])
+    adam([x])
+    adam([x])
+
+    # x and y share a param group, but only the param being stepped has its learning rate decayed
+    assert adam.param_groups[x] is adam.param_groups[y]
+    assert adam.optim.state[x]["lr_decay"] == 0.5 ** 3
+    assert adam.optim.state[y]["lr_decay"] == 0.5
+    assert adam.param_groups[x]["lr"] == 0.1
+
+
+def test_clipped_adam_group_lr_change():
+    pyro.clear_param_store()
+    x = pyro.param("x", torch.zeros(1, requires_grad=True))
+    adam = optim.ClippedAdam({"lr": 0.1, "lrd": 0.5})
+    x.grad = torch.ones(1)
+    adam([x])
+    before = x.item()
+    adam([x])
+    step = x.item() - before
+
+    # changes to the group learning rate, e.g. by a scheduler, still take effect after decay
+    adam.param_groups[x]["lr"] = 0.01
+    before = x.item()
+    adam([x])
+    assert_equal(x.item() - before, step * 0.1 * 0.5, prec=1e-6)
+
+
+@pytest.mark.parametrize("optim_constructor", [optim.Adagrad, optim.AdagradRMSProp])
+def test_params_added_after_first_step(optim_constructor):
+    pyro.clear_param_store()
+    x = pyro.param("x", torch.zeros(1, requires_grad=True))
+    y = pyro.param("y", torch.zeros(2, requires_grad=True))
+    pyro_optim = optim_constructor({})
+    for p in (x, y):
+        p.grad = torch.ones(p.shape)
+    pyro_optim([x])
+    # these optimizers create the state of their params in __init__, which add_param_group skips
+    pyro_optim([x, y])
+    assert (y.data != 0).all()
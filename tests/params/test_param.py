@@ -1,5 +1,6 @@
 from __future__ import absolute_import, division, print_function
 
+import os
 from copy import copy
 from unittest import TestCase
 
@@ -7,8 +8,10 @@ import numpy as np
 import torch
 import torch.optim
 from torch import nn as nn
+from torch.distributions import constraints
 
 import pyro
+import pyro.optim
 
 
 class ParamStoreDictTests(TestCase):
@@ -67,3 +70,115 @@ class ParamStoreDictTests(TestCase):
         assert sorted(param_store_params.keys()) == sorted(store._params.keys())
         assert sorted(param_store_param_to_name.values()) == sorted(store._param_to_name.values())
         assert sorted(store._params.keys()) == sorted(store._param_to_name.values())
+
+
+def test_constrained_value_cache():
+    pyro.clear_param_store()
+    init = torch.tensor([[2., 0.], [1., 3.]])
+    x = pyro.param("x", init, constraint=constraints.lower_cholesky)
+    assert pyro.param("x") is x
+    with torch.no_grad():
+        assert pyro.param("x").grad_fn is None
+    x = pyro.param("x")
+    assert x.grad_fn is not None
+
+    # a backward pass frees the graph of the cached value, so it must be recomputed
+    x.sum().backward()
+    unconstrained = x.unconstrained()
+    unconstrained.data.add_(1.)  # as done by torch optimizers, without bumping the version
+    y = pyro.param("y", torch.ones(2), constraint=constraints.positive)
+    x2 = pyro.param("x")
+    assert x2 is not x
+    assert x2[1, 0].item() == 2.
+    unconstrained.grad.zero_()
+    (x2.sum() + y.sum()).backward()
+    assert torch.equal(unconstrained.grad, torch.tril(torch.ones(2, 2)) + torch.diag(x2.diag()) - torch.eye(2))
+
+    # an in-place update of the unconstrained tensor bumps its version
+    x3 = pyro.param("x")
+    with torch.no_grad():
+        unconstrained.mul_(0.)
+    assert pyro.param("x") is not x3
+    assert torch.equal(pyro.param("x").data, torch.eye(2))
+
+
+def test_constrained_value_is_fresh_after_optimizer_step():
+    pyro.clear_param_store()
+    x = pyro.param("x", torch.ones(2), constraint=constraints.positive)
+    with torch.no_grad():
+        before = pyro.param("x")
+    assert torch.equal(before, torch.ones(2))
+
+    # torch optimizers update the unconstrained tensor via .data, which does not bump its version
+    adam = pyro.optim.Adam({"lr": 0.1})
+    x.sum().backward()
+    adam([x.unconstrained()])
+    with torch.no_grad():
+        after = pyro.param("x")
+    assert (after < 1.).all()
+    assert torch.equal(after, pyro.param("x").detach())
+
+
+def test_constrained_value_cache_write_paths(tmpdir):
+    pyro.clear_param_store()
+    store = pyro.get_param_store()
+    x = pyro.param("x", torch.ones(2), constraint=constraints.positive)
+
+    # a direct .data update is seen once the param is marked as modified
+    unconstrained = x.unconstrained()
+    unconstrained.data.copy_(torch.ones(2))
+    store.mark_params_modified([unconstrained])
+    assert torch.equal(pyro.param("x").data, torch.ones(2).exp())
+    store.save_checkpoint(str(tmpdir.join("checkpoint")))
+
+    # loading a state or a checkpoint replaces the cached value
+    x = pyro.param("x")
+    store.set_state({"params": {"x": torch.zeros(2, requires_grad=True)},
+                     "constraints": {"x": constraints.positive}})
+    assert torch.equal(pyro.param("x").data, torch.ones(2))
+    store.load_checkpoint(str(tmpdir.join("checkpoint")))
+    assert torch.equal(pyro.param("x").data, torch.ones(2).exp())
+    assert pyro.param("x") is not x
+
+    # shared params may be updated by other processes, so their values are never cached
+    pyro.clear_param_store()
+    y = pyro.param("y", torch.ones(2), constraint=constraints.positive)
+    store.share_memory()
+    y = pyro.param("y")
+    y.unconstrained().data.fill_(1.)
+    assert torch.equal(pyro.param("y").data, torch.ones(2).exp())
+
+
+def test_save_and_load_checkpoint(tmpdir):
+    dirname = str(tmpdir.join("checkpoint"))
+    pyro.clear_param_store()
+    store = pyro.get_param_store()
+    pyro.param("a", torch.ones(2, 3))
+    pyro.param("b", torch.tensor(2.), constraint=constraints.positive)
+    pyro.param("c", torch.zeros(4))
+    store.save_checkpoint(dirname)
+    files = dict(torch.load(str(tmpdir.join("checkpoint", "manifest.pt")))["params"])
+
+    # only the modified param is rewritten, to a new file
+    with torch.no_grad():
+        pyro.param("a").unconstrained().add_(1.)
+    store.save_checkpoint(dirname)
+    new_files = torch.load(str(tmpdir.join("checkpoint", "manifest.pt")))["params"]
+    assert new_files["b"] == files["b"] and new_files["c"] == files["c"]
+    assert new_files["a"] != files["a"]
+    assert sorted(os.listdir(dirname)) == sorted(["manifest.pt"] + list(new_files.values()))
+
+    pyro.clear_param_store()
+    store.load_checkpoint(dirname, param_names=["a", "b"])
+    assert sorted(store.get_all_param_names()) == ["a", "b"]
+    assert torch.equal(pyro.param("a").data, 2 * torch.ones(2, 3))
+    assert pyro.param("b").item() == 2.
+    assert pyro.param("a").requires_grad
+
+    # updates to a loaded param do not modify the checkpoint
+    with torch.no_grad():
+        pyro.param("a").unconstrained().add_(1.)
+    pyro.clear_param_store()
+    store.load_checkpoint(dirname)
+    assert torch.equal(pyro.param("a").data, 2 * torch.ones(2, 3))
+    assert torch.equal(pyro.param("c").data, torch.zeros(4))
@@ -8,16 +8,23 @@ from collections import namedtuple
 
 import pytest
 import re
+import time
 import torch
+from torch.distributions import constraints
 
 import pyro
 import pyro.distributions as dist
+import pyro.poutine as poutine
 from pyro.distributions.testing import fakes
-from pyro.infer import SVI
+from pyro.infer import SVI, config_enumerate
+from pyro.infer.distributed_svi import hogwild
+from pyro.infer.enum import iter_discrete_traces
 import pyro.optim as optim
 from pyro.infer.mcmc.hmc import HMC
 from pyro.infer.mcmc.mcmc import MCMC
 from pyro.infer.mcmc.nuts import NUTS
+from pyro.infer.traceenum_elbo import TraceEnum_ELBO
+from pyro.poutine.util import prune_subsample_sites
 
 
 Model = namedtuple('TestModel', ['model', 'model_args', 'model_id'])
@@ -107,6 +114,414 @@ def bernoulli_beta_hmc(**kwargs):
         posterior.append(trace.nodes['p_latent']['value'])
 
 
+@register_model(num_sites=10, num_steps=1000, id='FlatTrace::num_sites=10')
+@register_model(num_sites=1000, num_steps=100, id='FlatTrace::num_sites=1000')
+@register_model(num_sites=10000, num_steps=10, id='FlatTrace::num_sites=10000')
+def flat_trace(num_sites, num_steps):
+    # Measures per-step trace bookkeeping of a Trace_ELBO step: trace, replay, prune.
+    names = ["z_{}".format(i) for i in range(num_sites)]
+    loc, scale = torch.zeros(1), torch.ones(1)
+
+    def model():
+        for name in names:
+            pyro.sample(name, dist.Normal(loc, scale))
+
+    for _ in range(num_steps):
+        guide_trace = poutine.trace(model).get_trace()
+        model_trace = poutine.trace(poutine.replay(model, guide_trace)).get_trace()
+        prune_subsample_sites(guide_trace)
+        prune_subsample_sites(model_trace)
+
+
+@register_model(num_sites=10000, id='ApplyStack::num_sites=10000')
+def apply_stack(num_sites):
+    # Measures per-site overhead of the poutine stack seen by a model during an SVI step:
+    # trace, replay, enumerate and the scale and indep messengers of an iarange.
+    loc, scale = torch.zeros(1), torch.ones(1)
+
+    def model():
+        with pyro.iarange("data", 100, subsample_size=10):
+            for i in range(num_sites):
+                pyro.sample("z_{}".format(i), dist.Normal(loc, scale))
+
+    guide_trace = poutine.trace(model).get_trace()
+    model = poutine.trace(poutine.replay(poutine.EnumeratePoutine(model, 1), guide_trace))
+    model.get_trace()
+
+
+@register_model(num_data=2000, num_steps=5, id='IRangeSVI::num_data=2000')
+def irange_svi(num_data, num_steps):
+    # Measures an SVI step on a model with one observe site per datapoint.
+    data = torch.randn(num_data)
+
+    def model():
+        loc = pyro.sample("loc", dist.Normal(torch.zeros(1), torch.ones(1)))
+        for i in pyro.irange("data", num_data):
+            pyro.sample("obs_{}".format(i), dist.Normal(loc, torch.ones(1)), obs=data[i:i + 1])
+
+    def guide():
+        loc_q = pyro.param("loc_q", torch.zeros(1, requires_grad=True))
+        pyro.sample("loc", dist.Normal(loc_q, torch.ones(1)))
+
+    pyro.clear_param_store()
+    svi = SVI(model, guide, optim.Adam({"lr": 0.01}), loss="ELBO")
+    for _ in range(num_steps):
+        svi.step()
+
+
+@register_model(num_branches=1000, id='DenseTrace::num_branches=1000')
+def dense_trace(num_branches):
+    # Measures dense edge construction on a model with many independent irange branches.
+    loc, scale = torch.zeros(1), torch.ones(1)
+
+    def model():
+        z = pyro.sample("z", dist.Normal(loc, scale))
+        for i in pyro.irange("data", num_branches):
+            x = pyro.sample("x_{}".format(i), dist.Normal(z, scale))
+            pyro.sample("y_{}".format(i), dist.Normal(x, scale))
+
+    poutine.trace(model, graph_type="dense").get_trace()
+
+
+@register_model(freeze_structure=False, id='FrozenStructure::freeze_structure=False')
+@register_model(freeze_structure=True, id='FrozenStructure::freeze_structure=True')
+def frozen_structure_svi(freeze_structure, num_sites=300, num_steps=10):
+    # Measures the per-step validation and pruning of SVI on a subsampled model with many sites.
+    data = torch.randn(100)
+
+    def model():
+        with pyro.iarange("data", 100, subsample_size=10) as ind:
+            for i in range(num_sites):
+                z = pyro.sample("z_{}".format(i), dist.Normal(torch.zeros(10), 1))
+                pyro.sample("x_{}".format(i), dist.Normal(z, 1), obs=data[ind])
+
+    def guide():
+        loc = pyro.param("loc", torch.zeros(10, requires_grad=True))
+        with pyro.iarange("data", 100, subsample_size=10):
+            for i in range(num_sites):
+                pyro.sample("z_{}".format(i), dist.Normal(loc, 1))
+
+    pyro.clear_param_store()
+    svi = SVI(model, guide, optim.Adam({"lr": 0.01}), loss="ELBO", freeze_structure=freeze_structure)
+    with pyro.validation_enabled():
+        for _ in range(num_steps):
+            svi.step()
+
+
+@register_model(vectorize_particles=False, id='VectorizedParticles::vectorize_particles=False')
+@register_model(vectorize_particles=True, id='VectorizedParticles::vectorize_particles=True')
+def vectorized_particles_svi(vectorize_particles, num_particles=32, num_steps=20):
+    # Measures an SVI step with many particles on a model with a global latent and an iarange.
+    data = torch.randn(100)
+
+    def model():
+        loc = pyro.sample("loc", dist.Normal(torch.zeros(1), torch.ones(1)))
+        with pyro.iarange("data", len(data)):
+            pyro.sample("obs", dist.Normal(loc, 1), obs=data)
+
+    def guide():
+        loc_q = pyro.param("loc_q", torch.zeros(1, requires_grad=True))
+        pyro.sample("loc", dist.Normal(loc_q, torch.ones(1)))
+
+    pyro.clear_param_store()
+    svi = SVI(model, guide, optim.Adam({"lr": 0.01}), loss="ELBO", num_particles=num_particles,
+              max_iarange_nesting=1, vectorize_particles=vectorize_particles)
+    for _ in range(num_steps):
+        svi.step()
+
+
+@register_model(num_steps=10, id='EnumHMM::num_steps=10')
+@register_model(num_steps=20, id='EnumHMM::num_steps=20')
+def enum_hmm_elbo(num_steps, num_iters=5):
+    # Measures TraceEnum_ELBO on a hidden Markov model whose guide enumerates the chain in parallel.
+    data = torch.ones(num_steps)
+    init_probs = torch.tensor([0.5, 0.5])
+
+    def model():
+        transition_probs = pyro.param("transition_probs", torch.tensor([[0.75, 0.25], [0.25, 0.75]]),
+                                      constraint=constraints.simplex)
+        emission_probs = pyro.param("emission_probs", torch.tensor([[0.75, 0.25], [0.25, 0.75]]),
+                                    constraint=constraints.simplex)
+        x = None
+        for i, y in enumerate(data):
+            probs = init_probs if x is None else transition_probs[x]
+            x = pyro.sample("x_{}".format(i), dist.Categorical(probs))
+            pyro.sample("y_{}".format(i), dist.Categorical(emission_probs[x]), obs=y)
+
+    @config_enumerate(default="parallel")
+    def guide():
+        transition_probs = pyro.param("transition_probs", torch.tensor([[0.75, 0.25], [0.25, 0.75]]),
+                                      constraint=constraints.simplex)
+        x = None
+        for i in range(num_steps):
+            probs = init_probs if x is None else transition_probs[x]
+            x = pyro.sample("x_{}".format(i), dist.Categorical(probs))
+
+    pyro.clear_param_store()
+    elbo = TraceEnum_ELBO(max_iarange_nesting=0)
+    for _ in range(num_iters):
+        elbo.loss_and_grads(model, guide)
+
+
+@register_model(num_sites=5, id='SequentialEnum::num_sites=5')
+@register_model(num_sites=10, id='SequentialEnum::num_sites=10')
+def sequential_enum(num_sites, num_features=100):
+    # Measures iter_discrete_traces on a guide with many sequentially enumerated sites and continuous sites.
+    @config_enumerate(default="sequential")
+    def guide():
+        for i in range(num_sites):
+            pyro.sample("z_{}".format(i), dist.Normal(torch.zeros(num_features), 1))
+            pyro.sample("c_{}".format(i), dist.Categorical(torch.ones(2) / 2))
+
+    for _ in iter_discrete_traces("flat", guide):
+        pass
+
+
+@register_model(num_objects=10, id='AIRStyleTraceGraph::num_objects=10')
+def air_style_tracegraph(num_objects, num_iters=10, batch_size=16, latent_size=10):
+    # Measures TraceGraph_ELBO on an AIR-style model: a sequence of object steps, each with a
+    # non-reparameterized presence variable that masks the reparameterized variables after it.
+    data = torch.randn(64, latent_size)
+
+    def model(data):
+        with pyro.iarange("data", len(data), subsample_size=batch_size) as ind:
+            x = 0
+            z_pres = torch.ones(batch_size)
+            for t in range(num_objects):
+                z_pres = pyro.sample("z_pres_{}".format(t), dist.Bernoulli(0.5 * z_pres))
+                with poutine.scale(None, z_pres):
+                    z_what = pyro.sample("z_what_{}".format(t),
+                                         dist.Normal(torch.zeros(batch_size, latent_size), 1)
+                                             .reshape(extra_event_dims=1))
+                x = x + z_what * z_pres.unsqueeze(-1)
+            pyro.sample("obs", dist.Normal(x, 1).reshape(extra_event_dims=1), obs=data[ind])
+
+    def guide(data):
+        loc = pyro.param("loc", torch.zeros(latent_size, requires_grad=True))
+        logit = pyro.param("logit", torch.zeros(1, requires_grad=True))
+        with pyro.iarange("data", len(data), subsample_size=batch_size):
+            z_pres = torch.ones(batch_size)
+            for t in range(num_objects):
+                z_pres = pyro.sample("z_pres_{}".format(t), dist.Bernoulli(torch.sigmoid(logit) * z_pres),
+                                     infer=dict(baseline=dict(use_decaying_avg_baseline=True)))
+                with poutine.scale(None, z_pres):
+                    pyro.sample("z_what_{}".format(t),
+                                dist.Normal(loc.expand(batch_size, latent_size), 1).reshape(extra_event_dims=1))
+
+    pyro.clear_param_store()
+    svi = SVI(model, guide, optim.Adam({"lr": 0.01}), loss="ELBO", trace_graph=True)
+    for _ in range(num_iters):
+        svi.step(data)
+
+
+@register_model(num_params=200, id='PyroOptim::num_params=200')
+def many_params_optim(num_params, num_steps=20):
+    # Measures the optimizer overhead of a step over many small param tensors.
+    pyro.clear_param_store()
+    params = [pyro.param("p_{}".format(i), torch.zeros(3, requires_grad=True)) for i in range(num_params)]
+    adam = optim.Adam({"lr": 0.01})
+    for _ in range(num_steps):
+        for p in params:
+            p.grad = torch.ones(3)
+        adam(params)
+
+
+@register_model(size=500, num_reads=5, id='ConstrainedParam::size=500')
+def constrained_param_reads(size, num_reads, num_steps=20):
+    # Measures repeated pyro.param reads of a large lower_cholesky param within each step.
+    pyro.clear_param_store()
+    pyro.param("scale_tril", torch.eye(size), constraint=constraints.lower_cholesky)
+    adam = optim.Adam({"lr": 0.01})
+    for _ in range(num_steps):
+        loss = sum(pyro.param("scale_tril").sum() for _ in range(num_reads))
+        loss.backward()
+        params = [pyro.param("scale_tril").unconstrained()]
+        adam(params)
+        for p in params:
+            p.grad.zero_()
+
+
+@register_model(num_workers=1, id='HogwildSVI::num_workers=1')
+@register_model(num_workers=2, id='HogwildSVI::num_workers=2')
+@register_model(num_workers=4, id='HogwildSVI::num_workers=4')
+@register_model(num_workers=8, id='HogwildSVI::num_workers=8')
+def hogwild_bayesian_regression(num_workers, num_steps=400, num_data=1000, num_features=10):
+    # Measures Hogwild SVI on Bayesian regression data, with a fixed total number of steps
+    # split across workers that each train on their own data shard.
+    torch.manual_seed(0)
+    x = torch.rand(num_data, num_features)
+    y = x.matmul(torch.arange(num_features).float()) + 1 + 0.1 * torch.randn(num_data)
+
+    def model(x, y, ind):
+        w = pyro.sample("w", dist.Normal(torch.zeros(num_features), 2.).reshape(extra_event_dims=1))
+        b = pyro.sample("b", dist.Normal(torch.zeros(1), 2.).reshape(extra_event_dims=1))
+        with pyro.iarange("data", num_data, subsample=ind):
+            pyro.sample("obs", dist.Normal(x.matmul(w) + b, 1.), obs=y)
+
+    def guide(x, y, ind):
+        w_loc = pyro.param("w_loc", torch.zeros(num_features))
+        w_scale = pyro.param("w_scale", 0.1 * torch.ones(num_features), constraint=constraints.positive)
+        b_loc = pyro.param("b_loc", torch.zeros(1))
+        b_scale = pyro.param("b_scale", 0.1 * torch.ones(1), constraint=constraints.positive)
+        pyro.sample("w", dist.Normal(w_loc, w_scale).reshape(extra_event_dims=1))
+        pyro.sample("b", dist.Normal(b_loc, b_scale).reshape(extra_event_dims=1))
+
+    def worker(rank):
+        svi = SVI(model, guide, optim.Adam({"lr": 0.05}), loss="ELBO")
+        ind = torch.arange(rank, num_data, num_workers).long()
+        for _ in range(num_steps // num_workers):
+            svi.step(x[ind], y[ind], ind)
+
+    pyro.clear_param_store()
+    ind = torch.arange(num_data).long()
+    svi = SVI(model, guide, optim.Adam({"lr": 0.05}), loss="ELBO")
+    svi.evaluate_loss(x, y, ind)  # create the params before sharing them
+    start = time.time()
+    hogwild(worker, num_workers)
+    elapsed = time.time() - start
+    print("num_workers={} steps/sec={:.1f} final ELBO={:.1f}".format(
+        num_workers, num_steps / elapsed, -svi.evaluate_loss(x, y, ind)))
+
+
+@register_model(size=10000000, subsample_size=100, num_steps=100, id='IRangeSubsample::size=10000000')
+def iarange_subsample(size, subsample_size, num_steps):
+    # Measures subsampling a small minibatch from a large iarange at every step.
+    for _ in range(num_steps):
+        with pyro.iarange("data", size, subsample_size=subsample_size) as ind:
+            assert len(ind) == subsample_size
+
+
+@register_model(step_size=0.01, id='DeepTrees::NUTS')
+def nuts_deep_trees(step_size, num_samples=5):
+    # Measures building deep NUTS trees, as when high curvature forces a small step size.
+    def model():
+        pyro.sample('x', dist.Normal(torch.zeros(10), torch.ones(10)))
+
+    mcmc_run = MCMC(NUTS(model, step_size=step_size), num_samples=num_samples)
+    for _ in mcmc_run._traces():
+        pass
+
+
+@register_model(step_size=0.015, id='TreeDepth8::NUTS')
+def nuts_tree_depth_8(step_size, num_samples=10):
+    # Measures the per-leaf overhead of NUTS, with trees of depth 8 on a cheap model.
+    # The trajectory makes a U-turn after about pi / step_size ~ 200 leapfrog steps.
+    def model():
+        pyro.sample('x', dist.Normal(torch.zeros(1), torch.ones(1)))
+
+    mcmc_run = MCMC(NUTS(model, step_size=step_size), num_samples=num_samples)
+    for _ in mcmc_run._traces():
+        pass
+
+
+@register_model(kernel=NUTS, num_sites=50, id='ManySites::NUTS')
+@register_model(kernel=HMC, num_sites=50, id='ManySites::HMC')
+def many_latent_sites(kernel, num_sites, num_samples=20):
+    # Measures the per-step overhead of HMC and NUTS in models with many small latent sites.
+    data = torch.randn(num_sites)
+
+    def model(data):
+        for i in range(num_sites):
+            loc = pyro.sample('loc_{}'.format(i), dist.Normal(torch.zeros(1), torch.ones(1)))
+            pyro.sample('obs_{}'.format(i), dist.Normal(loc, torch.ones(1)), obs=data[i:i + 1])
+
+    kernel_args = {'num_steps': 10} if kernel is HMC else {}
+    mcmc_run = MCMC(kernel(model, step_size=0.1, **kernel_args), num_samples=num_samples)
+    for _ in mcmc_run._traces(data):
+        pass
+
+
+@register_model(compile_potential=False, id='CompiledPotential::compile_potential=False')
+@register_model(compile_potential=True, id='CompiledPotential::compile_potential=True')
+def compiled_potential_hmc(compile_potential, num_steps=20, num_samples=20):
+    # Measures leapfrog steps per second of HMC with and without recording a trace at each step.
+    data = torch.randn(100, 2)
+
+    def model(data):
+        loc = pyro.sample('loc', dist.Normal(torch.zeros(2), 1.).reshape(extra_event_dims=1))
+        scale = pyro.sample('scale', dist.Gamma(torch.ones(2), 1.).reshape(extra_event_dims=1))
+        with pyro.iarange('data', len(data)):
+            pyro.sample('obs', dist.Normal(loc, scale).reshape(extra_event_dims=1), obs=data)
+
+    hmc_kernel = HMC(model, step_size=0.05, num_steps=num_steps, compile_potential=compile_potential)
+    start = time.time()
+    for _ in MCMC(hmc_kernel, num_samples=num_samples)._traces(data):
+        pass
+    elapsed = time.time() - start
+    print("compile_potential={} steps/sec={:.1f}".format(compile_potential, num_steps * num_samples / elapsed))
+
+
+def _effective_sample_size(x):
+    # Geyer's initial positive sequence estimator, for each column of x
+    n = x.size(0)
+    x = x - x.mean(0)
+    var = (x * x).mean(0)
+    ess = []
+    for i in range(x.size(1)):
+        rho_sum = 0.
+        for lag in range(1, n):
+            rho = (x[lag:, i] * x[:-lag, i]).mean() / var[i]
+            if rho <= 0:
+                break
+            rho_sum += rho.item()
+        ess.append(n / (1 + 2 * rho_sum))
+    return min(ess)
+
+
+@register_model(adapt_mass_matrix=False, id='MassMatrix::adapt_mass_matrix=False')
+@register_model(adapt_mass_matrix=True, id='MassMatrix::adapt_mass_matrix=True')
+def mass_matrix_nuts(adapt_mass_matrix, num_samples=200, warmup_steps=200):
+    # Measures effective samples per second of NUTS on a badly scaled posterior.
+    scales = torch.tensor([100., 10., 1., 0.1, 0.01])
+
+    def model():
+        pyro.sample('x', dist.Normal(torch.zeros(5), scales))
+
+    nuts_kernel = NUTS(model, adapt_step_size=True, adapt_mass_matrix=adapt_mass_matrix)
+    start = time.time()
+    samples = torch.stack([trace.nodes['x']['value'] for trace, _ in
+                           MCMC(nuts_kernel, num_samples=num_samples, warmup_steps=warmup_steps)._traces()])
+    elapsed = time.time() - start
+    print("adapt_mass_matrix={} min ESS/sec={:.2f}".format(
+        adapt_mass_matrix, _effective_sample_size(samples / scales) / elapsed))
+
+
+@register_model(use_multinomial_sampling=False, id='NUTSSampling::use_multinomial_sampling=False')
+@register_model(use_multinomial_sampling=True, id='NUTSSampling::use_multinomial_sampling=True')
+def nuts_trajectory_sampling(use_multinomial_sampling, num_samples=300):
+    # Measures effective samples per model evaluation of NUTS with slice or multinomial sampling.
+    def model():
+        pyro.sample('x', dist.Normal(torch.zeros(5), torch.ones(5)))
+
+    nuts_kernel = NUTS(model, step_size=0.3, use_multinomial_sampling=use_multinomial_sampling)
+    samples = []
+    for trace, _ in MCMC(nuts_kernel, num_samples=num_samples)._traces():
+        samples.append(trace.nodes['x']['value'])
+        num_model_evals = nuts_kernel._num_model_evals
+    print("use_multinomial_sampling={} min ESS per model evaluation={:.4f}".format(
+        use_multinomial_sampling, _effective_sample_size(torch.stack(samples)) / num_model_evals))
+
+
+@register_model(vectorized=False, id='HMCChains::vectorized=False')
+@register_model(vectorized=True, id='HMCChains::vectorized=True')
+def hmc_chains(vectorized, num_chains=10, num_samples=50):
+    # Measures running several HMC chains of a small model, vectorized in one kernel or one after another.
+    data = torch.randn(100, 2)
+
+    def model(data):
+        loc = pyro.sample('loc', dist.Normal(torch.zeros(2), 1.).reshape(extra_event_dims=1))
+        with pyro.iarange('data', len(data)):
+            pyro.sample('obs', dist.Normal(loc, 1.).reshape(extra_event_dims=1), obs=data)
+
+    if vectorized:
+        kernels = [HMC(model, step_size=0.1, num_steps=5, num_chains=num_chains, max_iarange_nesting=1)]
+    else:
+        kernels = [HMC(model, step_size=0.1, num_steps=5) for _ in range(num_chains)]
+    for kernel in kernels:
+        for _ in MCMC(kernel, num_samples=num_samples)._traces(data):
+            pass
+
+
 @pytest.mark.parametrize('model, model_args, id', TEST_MODELS, ids=MODEL_IDS)
 @pytest.mark.benchmark(
     min_rounds=5,
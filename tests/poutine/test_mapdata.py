@@ -160,3 +160,42 @@ def test_model_guide_mismatch(behavior, model_size, guide_size, model):
     else:
         with pytest.raises(ValueError):
             poutine.replay(model, model.trace)(model_size)
+
+
+@pytest.mark.parametrize('model', [iarange_model, irange_model], ids=['iarange', 'irange'])
+def test_subsample_epochs(model):
+    pyro.set_rng_seed(0)
+    name = 'iarange' if model is iarange_model else 'irange'
+
+    # each epoch visits every index exactly once, with the leftover indices skipped
+    for epoch in range(3):
+        assert pyro.subsample_epoch(name) == epoch
+        batches = [set(int(i) for i in model(6)) for _ in range(3)]
+        assert len(set.union(*batches)) == 18
+    assert pyro.subsample_epoch(name) == 3
+
+    pyro.set_rng_seed(0)
+    assert pyro.subsample_epoch(name) == 0
+
+
+def test_full_subsample_is_not_aliased():
+    for _ in range(2):
+        with pyro.iarange('iarange', 20) as ind:
+            assert [int(i) for i in ind] == list(range(20))
+            ind.add_(1)
+
+
+def test_subsample_epochs_keyed_by_size():
+    pyro.set_rng_seed(0)
+    # ranges that share a name but not a size, e.g. in train and validation loops, do not interfere
+    for _ in range(3):
+        iarange_model(6)
+    with pyro.iarange('iarange', 10, 5):
+        pass
+    assert pyro.subsample_epoch('iarange', 20, 6) == 1
+    assert pyro.subsample_epoch('iarange', 10, 5) == 0
+    with pytest.raises(ValueError):
+        pyro.subsample_epoch('iarange')
+
+    pyro.clear_param_store()
+    assert pyro.subsample_epoch('iarange', 20, 6) == 0
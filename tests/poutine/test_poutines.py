@@ -669,3 +669,23 @@ def test_replay_enumerate_poutine(depth, first_available_dim):
         actual_shape = log_prob.shape
         expected_shape = (2,) * depth + (3,) + (2,) * depth + (1,) * first_available_dim
         assert actual_shape == expected_shape, 'error on iteration {}'.format(i)
+
+
+def test_dispatch_table_skips_default_handlers():
+    from pyro.poutine.poutine import Messenger, get_dispatch_table
+    from pyro.poutine.trace_poutine import TraceMessenger
+
+    trace_messenger = TraceMessenger()
+    trace_messenger.trace = poutine.Trace()
+    with trace_messenger, poutine.ScaleMessenger(2.0):
+        with Messenger():
+            process, postprocess = get_dispatch_table("sample")
+            # the plain Messenger at the bottom of the stack has no effect and is skipped
+            assert [index for index, _ in process] == [1, 2]
+            assert [index for index, _ in postprocess] == [2]
+        # the table is recomputed after the stack changes
+        process, postprocess = get_dispatch_table("sample")
+        assert [index for index, _ in process] == [0, 1]
+        assert [index for index, _ in postprocess] == [1]
+        process, postprocess = get_dispatch_table("param")
+        assert [index for index, _ in process] == [0, 1]
@@ -0,0 +1,109 @@
+from __future__ import absolute_import, division, print_function
+
+import torch
+
+import pyro
+import pyro.distributions as dist
+import pyro.poutine as poutine
+from pyro.poutine.trace import Trace
+from pyro.poutine.util import prune_subsample_sites
+
+
+def _add_sample(trace, name):
+    trace.add_node(name, name=name, type="sample", value=torch.zeros(1))
+
+
+def test_flat_trace_has_no_edges():
+    def model():
+        for i in range(5):
+            pyro.sample("x_{}".format(i), dist.Normal(torch.zeros(1), torch.ones(1)))
+
+    trace = poutine.trace(model).get_trace()
+    assert trace.edges == []
+    assert list(trace.successors("x_0")) == []
+    assert list(trace.nodes) == ["_INPUT"] + ["x_{}".format(i) for i in range(5)] + ["_RETURN"]
+
+
+def test_remove_node_removes_edges():
+    trace = Trace(graph_type="dense")
+    for name in "abc":
+        _add_sample(trace, name)
+    trace.add_edge("a", "b")
+    trace.add_edge("b", "c")
+    trace.add_edge("a", "c")
+
+    trace.remove_node("b")
+    assert "b" not in trace
+    assert len(trace) == 2
+    assert trace.edges == [("a", "c")]
+    assert list(trace.predecessors("c")) == ["a"]
+
+
+def test_topological_sort():
+    trace = Trace(graph_type="dense")
+    for name in "abcd":
+        _add_sample(trace, name)
+    trace.add_edge("c", "b")
+    trace.add_edge("b", "a")
+    trace.add_edge("d", "a")
+
+    order = trace.topological_sort()
+    assert sorted(order) == sorted("abcd")
+    for parent, child in trace.edges:
+        assert order.index(parent) < order.index(child)
+
+
+def test_copy_is_independent():
+    trace = Trace(graph_type="dense")
+    for name in "ab":
+        _add_sample(trace, name)
+    trace.add_edge("a", "b")
+
+    copy = trace.copy()
+    copy.nodes["a"]["log_pdf"] = 0.
+    copy.remove_node("b")
+
+    assert "log_pdf" not in trace.nodes["a"]
+    assert trace.edges == [("a", "b")]
+    assert copy.graph_type == "dense"
+    assert copy.nodes["a"]["value"] is trace.nodes["a"]["value"]
+
+
+def test_message_mapping_interface():
+    def model():
+        pyro.param("p", torch.zeros(1))
+        pyro.sample("x", dist.Normal(torch.zeros(1), torch.ones(1)), infer={"foo": 1})
+
+    trace = poutine.trace(model).get_trace()
+    site = trace.nodes["x"]
+    assert site["type"] == "sample"
+    assert site["infer"] == {"foo": 1}
+    assert "log_pdf" not in site
+    trace.log_pdf()
+    assert "log_pdf" in site
+
+    site["custom"] = "value"
+    assert site["custom"] == "value"
+    assert site.get("missing", 0) == 0
+    assert set(dict(site.items())) == set(site.keys())
+    copy = site.copy()
+    del copy["custom"]
+    assert "custom" in site and "custom" not in copy
+    assert trace.nodes["p"]["type"] == "param"
+
+
+def test_dense_edges_irange_branches():
+    def model():
+        z = pyro.sample("z", dist.Normal(torch.zeros(1), torch.ones(1)))
+        for i in pyro.irange("data", 3):
+            x = pyro.sample("x_{}".format(i), dist.Normal(z, torch.ones(1)))
+            pyro.sample("y_{}".format(i), dist.Normal(x, torch.ones(1)))
+        pyro.sample("w", dist.Normal(z, torch.ones(1)))
+
+    trace = poutine.trace(model, graph_type="dense").get_trace()
+    expected = set([("z", "x_{}".format(i)) for i in range(3)] +
+                   [("z", "y_{}".format(i)) for i in range(3)] +
+                   [("x_{}".format(i), "y_{}".format(i)) for i in range(3)] +
+                   [(name, "w") for name in ["z", "x_0", "y_0", "x_1", "y_1", "x_2", "y_2"]])
+    trace = prune_subsample_sites(trace)
+    assert set(trace.edges) == expected